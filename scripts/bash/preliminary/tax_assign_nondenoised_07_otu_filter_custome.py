@@ -2,6 +2,11 @@
 
 ## load modules
 import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'python'))
+from fasta_io import iter_fasta, write_fasta
+from vamp_extraction import extract_samples
 
 ## variables
 project = 'Jamy_2022'
@@ -21,41 +26,21 @@ def strip(file_path, output_path):
     '''
     Remove line breaks in FASTA files, so it will be easier to filter singeltons in the next step
     '''
-    seqs = []
-    # read a file and stripped it
-    with open(file_path, 'rt') as f:
-        lines = f.readlines()
-        for line in lines:
-            if line.startswith('>'):
-                seqs.append('\n' + line)
-            else:
-                line_cleaned = line.rstrip()
-                seqs.append(line_cleaned)
-        seqs[0] = seqs[0].lstrip()
-    # write the file into fasta
     # get sample name for our data:
     sample_name = file_path.split('/')[-1].lstrip('otu_').rstrip('.fasta')
-    with open(f'{output_path}/otu_{sample_name}.fasta', 'w') as fp:
-        for seq in seqs:
-            fp.write(seq)
+    output_file = f'{output_path}/otu_{sample_name}.fasta'
+    # stream the records into a temporary file (the output may overwrite the input)
+    write_fasta(iter_fasta(file_path), output_file + '.tmp')
+    os.replace(output_file + '.tmp', output_file)
 
 
 def filter_rare(path, threshold=1):
-    seqs_nonsingl = []
-    with open(path, 'rt') as f:
-        lines = f.readlines()
-        for line in lines[::-1]:
-            if not line.startswith('>'):
-                seq_ = line
-            if ('>' in line) and (not line.endswith(f'seqs={threshold}\n')):
-                seqs_nonsingl.append(line)
-                seqs_nonsingl.append(seq_)
-    # write the file into fasta
     # get sample name for our data:
     sample_name = path.split('/')[-1].lstrip('otu_').rstrip('.fasta')
-    with open(f'{filt_otu_dir}/nonrare_otu_{sample_name}.fasta', 'w') as fp:
-        for seq in seqs_nonsingl:
-            fp.write(seq)
+    # keep only the records that are not below the abundance threshold
+    nonrare_seqs = (record for record in iter_fasta(path)
+                    if not record[0].endswith(f'seqs={threshold}'))
+    write_fasta(nonrare_seqs, f'{filt_otu_dir}/nonrare_otu_{sample_name}.fasta')
 
 
 ## code
@@ -77,29 +62,11 @@ all_files = os.listdir(filt_otu_dir)
 all_files = [sample for sample in all_files if "nonrare_otu_" in sample]
 all_paths = [filt_otu_dir + '/' + path for path in all_files]
 
-# getting vampyrellid-specific ids
-for path in all_paths:
-    sample_name = path.split('/')[-1].lstrip('nonrare_otu_').rstrip('.fasta')
-    tax_assign_path = f'{tax_assign_dir}/blast6_{sample_name}.tab'
-    with open(tax_assign_path, 'rt') as f:
-        # get vamp ids from the tax assignment
-        vamp_ids = []
-        for line in f:
-            if 'Vampyrellida' in line:
-                vamp_ids.append(line.split('\t')[0])
-        # use the vamp ids to extract the vamp-specific sequences from the fasta file
-        filtered_seqs = []
-        with open(path, 'rt') as f:
-            lines = f.readlines()
-            for line in lines[::-1]:
-                if not line.startswith('>'):
-                    sequence = line
-                else:
-                    if any([x in line for x in vamp_ids]):
-                        filtered_seqs.append(line)
-                        filtered_seqs.append(sequence)
-        # write the filtered vampyrellid sequences into a fasta file
-        with open(f'{vamp_spec_dir}/nonrare_otu_{sample_name}.fasta',
-                  'w') as fp:
-            for seq in filtered_seqs:
-                fp.write(seq)
+# vampyrellid-specific sequences of all samples: one hash map of the vamp ids from the blast6
+# tables, then every FASTA file is streamed once (pooled file as in percentage_similarity_tables)
+sample_names = [path.split('/')[-1].lstrip('nonrare_otu_').rstrip('.fasta') for path in all_paths]
+extract_samples(dict(zip(sample_names, all_paths)),
+                {sample_name: f'{tax_assign_dir}/blast6_{sample_name}.tab' for sample_name in sample_names},
+                {sample_name: f'{vamp_spec_dir}/nonrare_otu_{sample_name}.fasta' for sample_name in sample_names},
+                pooled_file=f'{vamp_spec_dir}/nonrare_otu_all_samples.fasta',
+                label_pooled=False, pool_exclude=())
@@ -5,6 +5,10 @@ import os
 import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+from read_counts import count_reads_parallel
 
 # Variables
 project = 'Suthaus_2022'
@@ -29,21 +33,11 @@ all_files = os.listdir(denoise_path)
 all_asv_files = [file for file in all_files if '.fasta' in file]
 all_asv_paths = [denoise_path + '/' + file_name for file_name in all_asv_files]
 
-dict_counter = {}
-
-for i in all_asv_files:
-    dict_counter[i] = None
-
-dict_counter
-
-for asv_path in all_asv_files:
-    with open(denoise_path + '/' + asv_path, 'rt') as f:
-        counter_ = 0
-        lines = f.readlines()
-        for line in lines:
-            if line.startswith('>'):
-                counter_ += 1
-        dict_counter[asv_path] = counter_
+path_counts = count_reads_parallel(all_asv_paths, file_format='fasta')
+dict_counter = {
+    asv_file: path_counts[asv_path]
+    for asv_file, asv_path in zip(all_asv_files, all_asv_paths)
+}
 
 stats2 = pd.DataFrame.from_dict(dict_counter,
                                 orient='index',
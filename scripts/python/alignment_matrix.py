@@ -0,0 +1,161 @@
+# NumPy-backed container for multiple sequence alignments
+#
+# The alignment is loaded once into an (n_seqs x n_cols) uint8 array of ASCII codes
+# (upper case), so gap, identity, conservation and entropy statistics are computed
+# with array operations over all columns at once.
+
+# Imports
+import numpy as np
+
+from fasta_io import iter_fasta, write_fasta
+
+# Constants
+GAP = ord('-')
+
+
+class AlignmentMatrix:
+    '''
+    Multiple sequence alignment stored as an (n_seqs x n_cols) uint8 array.
+
+    Attributes:
+    - ids (list): Sequence headers (without '>') in alignment order.
+    - matrix (np.ndarray): uint8 array of upper-case ASCII codes, one row per sequence.
+    '''
+
+    def __init__(self, ids, matrix):
+        self.ids = list(ids)
+        self.matrix = matrix
+
+    @classmethod
+    def from_fasta(cls, alignment_file):
+        '''
+        Load an aligned FASTA file into a matrix.
+
+        Raises:
+        - ValueError: If the sequences do not all have the same length.
+        '''
+        ids = []
+        rows = []
+        for header, sequence in iter_fasta(alignment_file, as_bytes=True):
+            ids.append(header.decode())
+            # Gblocks output is written in blocks of 10 characters separated by spaces
+            rows.append(sequence.replace(b' ', b''))
+
+        n_cols = len(rows[0]) if rows else 0
+        if any(len(row) != n_cols for row in rows):
+            raise ValueError(f'Sequences in {alignment_file} are not aligned (different lengths).')
+
+        matrix = np.frombuffer(b''.join(rows).upper(), dtype=np.uint8)
+        return cls(ids, matrix.reshape(len(rows), n_cols).copy())
+
+    @property
+    def n_seqs(self):
+        return self.matrix.shape[0]
+
+    @property
+    def n_cols(self):
+        return self.matrix.shape[1]
+
+    def __len__(self):
+        return self.n_seqs
+
+    def to_fasta(self, output_path, line_width=None):
+        '''
+        Write the alignment to a FASTA file.
+        '''
+        records = ((header, row.tobytes().decode()) for header, row in zip(self.ids, self.matrix))
+        return write_fasta(records, output_path, line_width=line_width)
+
+    def select_columns(self, columns):
+        '''
+        Return a new alignment with only the given columns (boolean mask or indices).
+        '''
+        return AlignmentMatrix(self.ids, self.matrix[:, columns])
+
+    def select_rows(self, ids):
+        '''
+        Return a new alignment with only the given sequences (in the given order).
+        '''
+        row_index = {header: i for i, header in enumerate(self.ids)}
+        rows = [row_index[header] for header in ids]
+        return AlignmentMatrix([self.ids[i] for i in rows], self.matrix[rows])
+
+    # Gaps
+
+    def gap_mask(self):
+        return self.matrix == GAP
+
+    def gaps_per_sequence(self):
+        return self.gap_mask().sum(axis=1)
+
+    def gaps_per_column(self):
+        return self.gap_mask().sum(axis=0)
+
+    # Residue composition
+
+    def symbols(self, include_gaps=False):
+        '''
+        Return the ASCII codes of the symbols occurring in the alignment.
+        '''
+        present = np.flatnonzero(np.bincount(self.matrix.ravel(), minlength=256))
+        if not include_gaps:
+            present = present[present != GAP]
+        return present.astype(np.uint8)
+
+    def symbol_counts(self, include_gaps=False):
+        '''
+        Count every symbol in every column.
+
+        Returns:
+        - symbols (np.ndarray): The ASCII codes of the counted symbols.
+        - counts (np.ndarray): (n_symbols x n_cols) array of counts.
+        '''
+        symbols = self.symbols(include_gaps=include_gaps)
+        counts = np.empty((len(symbols), self.n_cols), dtype=np.int64)
+        for i, symbol in enumerate(symbols):
+            counts[i] = (self.matrix == symbol).sum(axis=0)
+        return symbols, counts
+
+    def identity_counts(self):
+        '''
+        Per column, the number of sequences that have the same character as the
+        first sequence (gaps included).
+        '''
+        return (self.matrix == self.matrix[0]).sum(axis=0)
+
+    def conservation(self):
+        '''
+        Per column, the fraction of all sequences that carry the most frequent residue
+        (gaps are not counted as residues).
+        '''
+        _, counts = self.symbol_counts()
+        if counts.size == 0:
+            return np.zeros(self.n_cols)
+        return counts.max(axis=0) / self.n_seqs
+
+    def column_entropy(self):
+        '''
+        Per column Shannon entropy (in bits) of the residue frequencies, ignoring gaps.
+        Columns consisting only of gaps have an entropy of 0.
+        '''
+        _, counts = self.symbol_counts()
+        totals = counts.sum(axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            freqs = np.where(totals > 0, counts / totals, 0.0)
+            entropy = -np.where(freqs > 0, freqs * np.log2(freqs), 0.0).sum(axis=0)
+        return entropy
+
+    # Summary
+
+    def stats(self):
+        '''
+        Return the summary statistics used by create_phyl_tree.alignment_stats.
+
+        Returns:
+        - tuple: (num_sequences, alignment_length, average_gaps, percentage_gaps, percentage_identity)
+        '''
+        total_gaps = int(self.gaps_per_sequence().sum())
+        average_gaps = total_gaps / self.n_seqs
+        percentage_gaps = (average_gaps / self.n_cols) * 100
+        percentage_identity = int(self.identity_counts().sum()) / (self.n_cols * self.n_seqs) * 100
+        return self.n_seqs, self.n_cols, average_gaps, percentage_gaps, percentage_identity
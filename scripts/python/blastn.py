@@ -1,10 +1,24 @@
+import asyncio
+import io
 import requests
 import time
 import xml.etree.ElementTree as ET
 import os
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
 
+from fasta_io import iter_fasta
+
+BASE_URL = 'https://blast.ncbi.nlm.nih.gov/blast/Blast.cgi'
 MAX_RETRIES = 50
 TIME_BETWEEN_RETRIES = 150  # in seconds
+MAX_IN_FLIGHT = 5  # number of RIDs polled at the same time
+SUBMIT_INTERVAL = 10  # minimal time between two submissions, in seconds
+MIN_POLL_DELAY = 60  # NCBI asks not to poll a single RID more than once a minute
+MAX_POLL_DELAY = 600  # in seconds
+POLL_BACKOFF = 1.5  # factor by which the poll delay grows while a search is waiting
+CHECKPOINT_FILE = 'blast_checkpoint.tsv'
+HSP_TABLE_FILE = 'blast_hits_hsps.tsv'
 RAW_DATA = os.path.join('..', '..', 'raw_data')
 OUTPUT_PATH = os.path.join(RAW_DATA, 'blast_results')
 PROJECT = 'Suthaus_2022'
@@ -20,26 +34,14 @@ OUTPUT_DIR = os.path.join(LOW_SIMLARITY_DIR, 'BLASTn')
 
 
 def read_fasta(file_path):
-    with open(file_path, 'r') as file:
-        sequences = {}
-        sequence = ''
-        header = None
-        for line in file:
-            if line.startswith('>'):
-                if header:
-                    sequences[header] = sequence
-                header = line.strip().replace('>', '')
-                sequence = ''
-            else:
-                sequence += line.strip()
-        if header:
-            sequences[header] = sequence
-    return sequences
+    return dict(iter_fasta(file_path))
 
 
-def run_blast(sequence):
-    base_url = 'https://blast.ncbi.nlm.nih.gov/blast/Blast.cgi'
-
+def submit_blast(sequence, base_url=BASE_URL):
+    '''
+    Submit a blastn search (CMD=Put) and return the request ID (RID) and the
+    estimated time to completion (RTOE, in seconds) reported by the server.
+    '''
     params = {
         'CMD': 'Put',
         'PROGRAM': 'blastn',
@@ -50,14 +52,49 @@ def run_blast(sequence):
     response.raise_for_status()
 
     rid = None
+    rtoe = 0
     for line in response.text.split('\n'):
         if 'RID = ' in line:
             rid = line.split('RID = ')[1].split(' ')[0].strip()
-            break
+        elif 'RTOE = ' in line:
+            rtoe = int(line.split('RTOE = ')[1].split(' ')[0].strip())
 
     if not rid:
         raise ValueError('Failed to retrieve RID from BLAST response.')
 
+    return rid, rtoe
+
+
+def check_blast_status(rid, base_url=BASE_URL):
+    '''
+    Return the status of a submitted search: 'WAITING', 'READY', 'FAILED' or 'UNKNOWN'
+    (an unknown RID has expired or never existed).
+    '''
+    params = {'CMD': 'Get', 'FORMAT_OBJECT': 'SearchInfo', 'RID': rid}
+    response = requests.get(base_url, params=params)
+    response.raise_for_status()
+
+    for status in ('WAITING', 'READY', 'FAILED', 'UNKNOWN'):
+        if f'Status={status}' in response.text:
+            return status
+    return 'UNKNOWN'
+
+
+def fetch_blast_xml(rid, base_url=BASE_URL):
+    '''
+    Download the XML results of a finished search.
+    '''
+    params = {'CMD': 'Get', 'FORMAT_TYPE': 'XML', 'RID': rid}
+    result = requests.get(base_url, params=params)
+    result.raise_for_status()
+
+    if '<BlastOutput_iterations>' not in result.text:
+        raise ValueError(f'No BLAST XML results for RID {rid}.')
+    return result.text
+
+
+def run_blast(sequence, base_url=BASE_URL):
+    rid, _ = submit_blast(sequence, base_url)
     print(f'RID: {rid}')
 
     for attempt in range(MAX_RETRIES):
@@ -74,30 +111,271 @@ def run_blast(sequence):
         f'Failed to retrieve BLAST results after {MAX_RETRIES} attempts.')
 
 
-def extract_blast_details_from_xml_to_tsv(xml_content):
-    root = ET.fromstring(xml_content)
-
-    # Prepare the header for the TSV file
-    rows = ['Score\tE_value\tMax_Ident\tHit_accession\tOrganism']
-
-    # Iterate over the top 20 hits
-    for hit in root.findall('.//Hit')[:20]:
-        hit_accession = hit.find('Hit_accession').text
-        hit_def = hit.find('Hit_def').text
-        score = hit.find('.//Hsp_bit-score').text
-        e_value = hit.find('.//Hsp_evalue').text
-        identities = float(hit.find('.//Hsp_identity').text)
-        align_len = float(hit.find('.//Hsp_align-len').text)
+def read_checkpoint(checkpoint_path):
+    '''
+    Read a BLAST checkpoint file (header <tab> RID <tab> status per line; later lines win).
+
+    Returns:
+    - done (set): Headers whose XML results were written.
+    - pending (dict): Header -> RID of searches that were submitted but not finished.
+    '''
+    done = set()
+    pending = {}
+    if not os.path.exists(checkpoint_path):
+        return done, pending
+    with open(checkpoint_path, 'r') as checkpoint:
+        for line in checkpoint:
+            parts = line.rstrip('\n').split('\t')
+            if len(parts) != 3:
+                continue  # partially written line from a crash
+            header, rid, status = parts
+            if status == 'done':
+                done.add(header)
+                pending.pop(header, None)
+            elif status == 'submitted':
+                pending[header] = rid
+            else:
+                pending.pop(header, None)
+    return done, pending
+
+
+def _write_checkpoint(checkpoint_path, header, rid, status):
+    with open(checkpoint_path, 'a') as checkpoint:
+        checkpoint.write(f'{header}\t{rid}\t{status}\n')
+
+
+async def _blast_job(header, sequence, output_dir, checkpoint_path, base_url, rid,
+                     in_flight, submit_lock, submit_interval, min_poll_delay, max_poll_delay):
+    async with in_flight:
+        for _ in range(2):  # a resumed RID may have expired, then the sequence is submitted again
+            if rid is None:
+                async with submit_lock:
+                    rid, rtoe = await asyncio.to_thread(submit_blast, sequence, base_url)
+                    _write_checkpoint(checkpoint_path, header, rid, 'submitted')
+                    print(f'{header}: submitted (RID {rid}, estimated {rtoe} s)')
+                    await asyncio.sleep(submit_interval)
+                delay = max(min_poll_delay, rtoe)
+            else:
+                print(f'{header}: resuming RID {rid}')
+                delay = min_poll_delay
+
+            # Poll with a growing delay while the search is waiting
+            for _ in range(MAX_RETRIES):
+                await asyncio.sleep(delay)
+                status = await asyncio.to_thread(check_blast_status, rid, base_url)
+                if status != 'WAITING':
+                    break
+                delay = min(delay * POLL_BACKOFF, max_poll_delay)
+            else:
+                raise TimeoutError(f'{header}: no BLAST results for RID {rid} after {MAX_RETRIES} polls.')
+
+            if status == 'READY':
+                xml_content = await asyncio.to_thread(fetch_blast_xml, rid, base_url)
+                output_file_path = os.path.join(output_dir, f'{header}.xml')
+                with open(output_file_path + '.tmp', 'w') as file:
+                    file.write(xml_content)
+                os.replace(output_file_path + '.tmp', output_file_path)
+                _write_checkpoint(checkpoint_path, header, rid, 'done')
+                print(f'{header} saved to {header}.xml...')
+                return output_file_path
+
+            _write_checkpoint(checkpoint_path, header, rid, status.lower())
+            if status == 'FAILED':
+                raise ValueError(f'{header}: BLAST search {rid} failed.')
+            rid = None
+
+        raise ValueError(f'{header}: BLAST search could not be completed.')
+
+
+async def run_blast_batch_async(sequences,
+                                output_dir,
+                                max_in_flight=MAX_IN_FLIGHT,
+                                base_url=BASE_URL,
+                                submit_interval=SUBMIT_INTERVAL,
+                                min_poll_delay=MIN_POLL_DELAY,
+                                max_poll_delay=MAX_POLL_DELAY):
+    '''
+    BLAST many sequences with up to max_in_flight searches running at the same time.
+
+    Each search is submitted (submissions are spaced by submit_interval seconds), polled
+    with an adaptive delay (starting at the server's estimate, growing by POLL_BACKOFF up
+    to max_poll_delay) and its XML is written to output_dir as soon as it is ready.
+    Progress is appended to a checkpoint file in output_dir, so a restarted batch skips
+    finished headers and resumes polling the RIDs that were still running.
+
+    Parameters:
+    - sequences (dict): Header -> sequence.
+    - output_dir (str): Directory for the '<header>.xml' files and the checkpoint file.
+    - max_in_flight (int, optional): Number of concurrent searches.
+    - base_url (str, optional): URL of the BLAST URL API (e.g. a local test server).
+    - submit_interval (int, optional): Minimal time between two submissions, in seconds.
+    - min_poll_delay (int, optional): Minimal delay between two polls of one RID, in seconds.
+    - max_poll_delay (int, optional): Maximal delay between two polls of one RID, in seconds.
+
+    Returns:
+    - dict: Header -> path of the XML file, or the exception raised for that header.
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    checkpoint_path = os.path.join(output_dir, CHECKPOINT_FILE)
+    done, pending = read_checkpoint(checkpoint_path)
+    if os.path.exists(checkpoint_path) and os.path.getsize(checkpoint_path) > 0:
+        with open(checkpoint_path, 'rb+') as checkpoint:
+            # Terminate a line cut off by a crash, so it does not run into the next one
+            checkpoint.seek(-1, os.SEEK_END)
+            if checkpoint.read(1) != b'\n':
+                checkpoint.write(b'\n')
+
+    in_flight = asyncio.Semaphore(max_in_flight)
+    submit_lock = asyncio.Lock()
+    headers = [header for header in sequences if header not in done]
+    print(f'{len(sequences) - len(headers)} sequences already done, {len(headers)} to BLAST.')
+
+    results = await asyncio.gather(*(
+        _blast_job(header, sequences[header], output_dir, checkpoint_path, base_url,
+                   pending.get(header), in_flight, submit_lock, submit_interval,
+                   min_poll_delay, max_poll_delay)
+        for header in headers), return_exceptions=True)
+
+    for header, result in zip(headers, results):
+        if isinstance(result, Exception):
+            print(f'{header}: {result}')
+    return dict(zip(headers, results))
+
+
+def run_blast_batch(sequences, output_dir, **kwargs):
+    '''
+    Synchronous wrapper around run_blast_batch_async (see there for the parameters).
+    '''
+    return asyncio.run(run_blast_batch_async(sequences, output_dir, **kwargs))
+
+
+TOP_HITS_HEADER = 'Score\tE_value\tMax_Ident\tHit_accession\tOrganism'
+HSP_COLUMNS = ['Query', 'Query_def', 'Hit_num', 'Hit_id', 'Hit_accession', 'Hit_def', 'Hit_len',
+               'Hsp_num', 'Score', 'E_value', 'Identity', 'Align_len', 'Max_Ident', 'Gaps',
+               'Query_from', 'Query_to', 'Hit_from', 'Hit_to']
+
+
+def iter_blast_hsps(xml_source):
+    '''
+    Stream all hits and HSPs from a BLAST XML file.
+
+    The XML is parsed incrementally with ET.iterparse and every <Hit> and <Iteration>
+    element is cleared once it has been processed, so the memory use does not depend
+    on the size of the result file.
+
+    Parameters:
+    - xml_source (str or file object): Path to the BLAST XML file (or an open file).
+
+    Yields:
+    - tuple: One row per HSP with the values of HSP_COLUMNS (without 'Query').
+    '''
+    query_def = None
+    for _, elem in ET.iterparse(xml_source, events=('end',)):
+        if elem.tag == 'Iteration_query-def':
+            query_def = elem.text
+        elif elem.tag == 'Hit':
+            hit_values = (int(elem.findtext('Hit_num')),
+                          elem.findtext('Hit_id'),
+                          elem.findtext('Hit_accession'),
+                          elem.findtext('Hit_def'),
+                          int(elem.findtext('Hit_len')))
+            for hsp in elem.iter('Hsp'):
+                identity = int(hsp.findtext('Hsp_identity'))
+                align_len = int(hsp.findtext('Hsp_align-len'))
+                yield (query_def,) + hit_values + (
+                    int(hsp.findtext('Hsp_num')),
+                    float(hsp.findtext('Hsp_bit-score')),
+                    float(hsp.findtext('Hsp_evalue')),
+                    identity,
+                    align_len,
+                    round(identity / align_len * 100, 2),
+                    int(hsp.findtext('Hsp_gaps', default='0')),
+                    int(hsp.findtext('Hsp_query-from')),
+                    int(hsp.findtext('Hsp_query-to')),
+                    int(hsp.findtext('Hsp_hit-from')),
+                    int(hsp.findtext('Hsp_hit-to')))
+            elem.clear()
+        elif elem.tag == 'Iteration':
+            elem.clear()
+
+
+def blast_xml_to_dataframe(xml_path):
+    '''
+    Return all hits and HSPs of one BLAST XML file as a dataframe (columns HSP_COLUMNS).
+    The 'Query' column holds the file name without extension (the FASTA header).
+    '''
+    query = os.path.splitext(os.path.basename(xml_path))[0]
+    df = pd.DataFrame(iter_blast_hsps(xml_path), columns=HSP_COLUMNS[1:])
+    df.insert(0, 'Query', query)
+    return df
+
+
+def combine_blast_xml_files(xml_dir, output_file=None, processes=None):
+    '''
+    Convert every BLAST XML file in a directory into one combined table of all hits and HSPs.
+
+    The files are parsed in parallel on a process pool, each with the streaming parser.
+
+    Parameters:
+    - xml_dir (str): Directory with the '<header>.xml' files.
+    - output_file (str, optional): If given, the combined table is saved there as TSV.
+    - processes (int, optional): Number of worker processes. Default is os.cpu_count().
+
+    Returns:
+    - pd.DataFrame: The combined table (columns HSP_COLUMNS).
+    '''
+    xml_paths = [os.path.join(xml_dir, filename) for filename in sorted(os.listdir(xml_dir))
+                 if filename.endswith('.xml')]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        tables = list(executor.map(blast_xml_to_dataframe, xml_paths))
+
+    combined = pd.concat(tables, ignore_index=True) if tables else pd.DataFrame(columns=HSP_COLUMNS)
+    if output_file:
+        combined.to_csv(output_file, sep='\t', index=False)
+    return combined
+
+
+def iter_top_hit_rows(xml_source, num_hits=20):
+    '''
+    Stream the rows of the per query TSV files (see TOP_HITS_HEADER) from a BLAST XML file:
+    the first HSP of the first num_hits hits. Score and E_value are the raw XML text, so the
+    files are identical to the ones of the former DOM parser.
+
+    Yields:
+    - str: One tab separated row per hit.
+    '''
+    n_hits = 0
+    for _, elem in ET.iterparse(xml_source, events=('end',)):
+        if elem.tag != 'Hit':
+            continue
+        identities = float(elem.find('.//Hsp_identity').text)
+        align_len = float(elem.find('.//Hsp_align-len').text)
         max_ident_percentage = (identities / align_len) * 100
+        yield (f'{elem.find(".//Hsp_bit-score").text}\t{elem.find(".//Hsp_evalue").text}\t'
+               f'{max_ident_percentage:.2f}%\t{elem.find("Hit_accession").text}\t{elem.find("Hit_def").text}')
+        elem.clear()
+        n_hits += 1
+        if n_hits == num_hits:
+            break
 
-        # Construct the row for this hit
-        row = f'{score}\t{e_value}\t{max_ident_percentage:.2f}%\t{hit_accession}\t{hit_def}'
-        rows.append(row)
 
-    # Convert the list of rows to a single string with new line separation
-    tsv_content = '\n'.join(rows)
+def extract_blast_details_from_xml_to_tsv(xml_content):
+    return '\n'.join([TOP_HITS_HEADER, *iter_top_hit_rows(io.StringIO(xml_content))])
+
 
-    return tsv_content
+def write_top_hits_tsv(xml_path, tsv_path, num_hits=20):
+    '''
+    Write the per query TSV file of a BLAST XML file, streaming the rows from the XML file
+    (same content as extract_blast_details_from_xml_to_tsv).
+
+    Returns:
+    - str: tsv_path.
+    '''
+    with open(tsv_path, 'w') as tsv_file:
+        tsv_file.write(TOP_HITS_HEADER)
+        for row in iter_top_hit_rows(xml_path, num_hits=num_hits):
+            tsv_file.write(f'\n{row}')
+    return tsv_path
 
 
 if __name__ == '__main__':
@@ -106,25 +384,13 @@ if __name__ == '__main__':
     sequences = read_fasta(INPUT_PATH)
 
     # BLASTing the FASTA files and saving them as the XML files
-    for header, sequence in sequences.items():
-        time.sleep(10)
-        print(f'Running BLAST for {header}...')
-        blast_output = run_blast(sequence)
-        output_file_path = os.path.join(OUTPUT_DIR, f'{header}.xml')
-        with open(output_file_path, 'w') as file:
-            file.write(blast_output)
-            print(f'{header} saved to {header}.xml...')
-
-    # Extracting BLAST results from XML to TSV files:
-    filenames = os.listdir(OUTPUT_DIR)
-    for filename in filenames:
-        if filename.endswith(".xml"):
-            with open(os.path.join(OUTPUT_DIR, filename), 'r') as xml_file:
-                xml_content = xml_file.read()
-
-            tsv_content = extract_blast_details_from_xml_to_tsv(xml_content)
-            file_name_without_ext = os.path.splitext(filename)[0]
-
-            with open(os.path.join(OUTPUT_DIR, f'{file_name_without_ext}.tsv'),
-                      'w') as tsv_file:
-                tsv_file.write(tsv_content)
+    run_blast_batch(sequences, OUTPUT_DIR)
+
+    # Extracting all hits and HSPs from the XML files into one table
+    combine_blast_xml_files(OUTPUT_DIR, output_file=os.path.join(OUTPUT_DIR, HSP_TABLE_FILE))
+
+    # Per query TSV files with the top hits (used by the low_similarity_otus notebook)
+    for filename in sorted(os.listdir(OUTPUT_DIR)):
+        if filename.endswith('.xml'):
+            write_top_hits_tsv(os.path.join(OUTPUT_DIR, filename),
+                               os.path.join(OUTPUT_DIR, f'{os.path.splitext(filename)[0]}.tsv'))
@@ -2,14 +2,37 @@
 # ../../notebooks/create_phyl_tree.ipynb
 
 # Import modules
-from Bio import AlignIO
+import asyncio
 import subprocess
 import os
 import re
 import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import pandas as pd
+
+from fasta_io import iter_fasta, count_fasta_records
+from alignment_matrix import AlignmentMatrix
+from gblocks_engine import gblocks_grid, write_trimmed_alignments
 
 # Constants
 GBLOCKS_PATH = os.path.join('..', 'raw_data', 'packages', 'Gblocks_0.91b', 'Gblocks')
+TREE_VARIANTS = {
+    'mafft': 'vamp_mafft.fasta',
+    'gblocks_medium': 'vamp_mafft_gblocks_medium.fasta',
+    'gblocks_strong': 'vamp_mafft_gblocks_strong.fasta'
+}
+# 'Parameters used' block of the Gblocks HTML output (and of the .log files)
+GBLOCKS_PARAMETERS = {
+    'b1': 'Minimum Number Of Sequences For A Conserved Position',
+    'b2': 'Minimum Number Of Sequences For A Flanking Position',
+    'b3': 'Maximum Number Of Contiguous Nonconserved Positions',
+    'b4': 'Minimum Length Of A Block',
+    'b5': 'Allowed Gap Positions'
+}
+GBLOCKS_GAP_OPTIONS = {'None': 'n', 'With Half': 'h', 'All': 'a'}
+# Grid search columns where a lower value ranks first (all others: higher is better)
+LOWER_IS_BETTER = {'percentage_gaps'}
 
 
 # Function definitions
@@ -58,111 +81,166 @@ def alignment_stats(alignment_file):
     phylogenetic relationships or alignment quality.
     '''
 
-    # Load the alignment
-    alignment = AlignIO.read(alignment_file, "fasta")
-
-    # Number of sequences
-    num_sequences = len(alignment)
+    # Load the alignment into a (sequences x columns) matrix
+    alignment = AlignmentMatrix.from_fasta(alignment_file)
 
-    # Alignment length
-    alignment_length = alignment.get_alignment_length()
-
-    if alignment_length == 0:
+    if alignment.n_cols == 0:
         raise ValueError(f"The alignment in {alignment_file} has a length of zero. Please check the file.")
 
-    # Calculate the total number of gaps across all sequences
-    total_gaps = sum(str(record.seq).count('-') for record in alignment)
+    return alignment.stats()
 
-    # Average number of gaps per sequence
-    average_gaps = total_gaps / num_sequences
 
-    # Percentage of gaps across the sequences
-    percentage_gaps = (average_gaps / alignment_length) * 100
+def gblocks_grid_stats(grid_search_path, b5_value=None):
+    '''
+    Calculate alignment statistics for every Gblocks grid search alignment in a directory.
 
-    # Percentage identity (for simplicity, we'll just calculate this for pairwise comparisons)
-    total_columns = alignment_length * num_sequences
-    identical_columns = sum(col.count(col[0]) for col in zip(*alignment))
-    percentage_identity = (identical_columns / total_columns) * 100
+    The alignments produced by run_gblocks_grid_search (files named
+    '<alignment>_gblocks_grid_<b5>_<iteration>.fasta') are loaded as AlignmentMatrix
+    objects, so each file is parsed once and all statistics are computed column-wise.
 
-    return num_sequences, alignment_length, average_gaps, percentage_gaps, percentage_identity
+    Parameters:
+    - grid_search_path (str): Directory containing the grid search alignments.
+    - b5_value (str, optional): Only evaluate alignments produced with this b5 value (e.g. 'h').
 
+    Returns:
+    - pd.DataFrame: One row per alignment with the columns b5_value, iteration_num, num_sequences,
+      alignment_length, avg_num_gaps, percentage_gaps, avg_percentage_identity,
+      mean_conservation and mean_entropy, sorted by b5_value and iteration_num.
+    '''
+    results = []
+    for fasta_file in os.listdir(grid_search_path):
+        if not fasta_file.endswith('.fasta') or '_grid_' not in fasta_file:
+            continue
+        grid_b5, iteration_num = fasta_file[:-len('.fasta')].split('_grid_')[1].split('_')[:2]
+        if b5_value is not None and grid_b5 != b5_value:
+            continue
+        alignment = AlignmentMatrix.from_fasta(os.path.join(grid_search_path, fasta_file))
+        if alignment.n_cols == 0:
+            metrics = (alignment.n_seqs, 0, 0.0, 0.0, 0.0, 0.0, 0.0)
+        else:
+            metrics = alignment.stats() + (alignment.conservation().mean(),
+                                           alignment.column_entropy().mean())
+        results.append((grid_b5, int(iteration_num)) + metrics)
+
+    grid_df = pd.DataFrame(results, columns=['b5_value',
+                                             'iteration_num',
+                                             'num_sequences',
+                                             'alignment_length',
+                                             'avg_num_gaps',
+                                             'percentage_gaps',
+                                             'avg_percentage_identity',
+                                             'mean_conservation',
+                                             'mean_entropy'])
+    return grid_df.sort_values(by=['b5_value', 'iteration_num']).reset_index(drop=True)
+
+
+async def run_command_async(cmd, log_file=None, echo=True):
+    '''
+    Run a command as an asyncio subprocess and stream its output line by line (stdout and
+    stderr combined) to the console and/or a log file while it runs.
 
+    Returns:
+    - int: The return code (zero).
 
-def run_raxmlng_check(alignment, output_dir, model='GTR+G', prefix='T1'):
+    Raises:
+    - subprocess.CalledProcessError: If the command exits with a non-zero return code.
     '''
-    Run raxml-ng to check the alignment and save the output in the specified directory.
+    process = await asyncio.create_subprocess_exec(*cmd,
+                                                   stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.STDOUT)
+    log_f = open(log_file, 'a') if log_file else None
+    try:
+        async for line in process.stdout:
+            line = line.decode(errors='replace')
+            if echo:
+                print(line, end='')
+            if log_f:
+                log_f.write(line)
+                log_f.flush()
+    finally:
+        returncode = await process.wait()
+        if log_f:
+            log_f.close()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
+    return returncode
+
+
+async def run_raxmlng_async(args, output_dir, prefix, log_file=None, echo=True):
     '''
-    # Specify command for raxm-ng
-    cmd = [
-        'raxml-ng', '--check',
-        '--msa', alignment,
-        '--model', model,
-        '--prefix', prefix
-    ]
-    # Run the command via the subrocess module
-    results = subprocess.run(cmd,
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE,
-                                text=True,
-                                check=True)
-
-    # Print output and error messages (if any)
-    print(results.stdout)
-    if results.stderr:
-        print(results.stderr)
+    Run raxml-ng with the given arguments in a private output directory.
+
+    raxml-ng writes its files to <private dir>/<prefix>.raxml.*, a fresh directory inside
+    output_dir, so calls with the same or overlapping prefixes (T2, T2_gblocks, ...) never
+    see each other's files and can run at the same time. When raxml-ng has finished, its
+    files are moved to output_dir.
 
+    Returns:
+    - int: The return code of raxml-ng (zero).
+
+    Raises:
+    - subprocess.CalledProcessError: An error occurred in RAxML-NG (the private directory is kept).
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    private_dir = tempfile.mkdtemp(prefix=f'.{prefix}_', dir=output_dir)
+    cmd = ['raxml-ng', *args, '--prefix', os.path.join(private_dir, prefix)]
+    returncode = await run_command_async(cmd, log_file=log_file, echo=echo)
 
     # Move files to the output directory
-    for file in os.listdir():
-        if file.startswith(prefix):
-            os.rename(file, os.path.join(output_dir, file))
-    if results.returncode == 0:
-        print(f'Output files were moved to: {output_dir}')
+    for file in os.listdir(private_dir):
+        os.replace(os.path.join(private_dir, file), os.path.join(output_dir, file))
+    os.rmdir(private_dir)
+    print(f'Output files were moved to: {output_dir}')
+    return returncode
+
+
+def _run_sync(coroutine):
+    # Run a coroutine to completion, also from a running event loop (e.g. a Jupyter notebook)
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+def raxmlng_check_args(alignment, model='GTR+G'):
+    return ['--check', '--msa', alignment, '--model', model]
 
-    return results.returncode
 
+def raxmlng_tree_args(alignment, num_threads=3, model='GTR+G'):
+    return ['--msa', alignment, '--model', model, '--threads', str(num_threads),
+            '--seed', '2', '--tree', 'pars{25},rand{25}']
 
-def run_raxmlng_tree(alignment, output_dir, num_threads=3, model='GTR+G', prefix='T2'):
+
+def raxmlng_bootstrap_args(alignment, num_threads=3, model='GTR+G'):
+    return ['--bootstrap', '--msa', alignment, '--model', model, '--threads', str(num_threads),
+            '--seed', '2']
+
+
+def raxmlng_support_args(tree, bootstraps, num_threads=3):
+    return ['--support', '--tree', tree, '--bs-trees', bootstraps, '--threads', str(num_threads)]
+
+
+def run_raxmlng_check(alignment, output_dir, model='GTR+G', prefix='T1', log_file=None):
     '''
-    Run raxml-ng to compute the maximum likelihood tree and save the output in the specified directory.
+    Run raxml-ng to check the alignment and save the output in the specified directory.
     '''
+    return _run_sync(run_raxmlng_async(raxmlng_check_args(alignment, model),
+                                       output_dir, prefix, log_file=log_file))
 
-    # Specify command for raxm-ng
-    cmd = [
-        'raxml-ng',
-        '--msa', alignment,
-        '--model', model,
-        '--prefix', prefix,
-        '--threads', str(num_threads),
-        '--seed', '2',
-        '--tree', 'pars{25},rand{25}'
-    ]
-
-    # Run the command via the subrocess module
-    results = subprocess.run(cmd,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE,
-                             text=True,
-                             check=True)
-
-    # Print output and error messages (if any)
-    print(results.stdout)
-    if results.stderr:
-        print(results.stderr)
-
-    # Move files to the output directory
-    for file in os.listdir():
-        if file.startswith(prefix):
-            os.rename(file, os.path.join(output_dir, file))
-    if results.returncode == 0:
-        print(f'Output files were moved to: {output_dir}')
 
-    return results.returncode
+def run_raxmlng_tree(alignment, output_dir, num_threads=3, model='GTR+G', prefix='T2', log_file=None):
+    '''
+    Run raxml-ng to compute the maximum likelihood tree and save the output in the specified directory.
+    '''
+    return _run_sync(run_raxmlng_async(raxmlng_tree_args(alignment, num_threads, model),
+                                       output_dir, prefix, log_file=log_file))
 
 
-def run_raxmlng_bootstrap(alignment, output_dir, num_threads=3, model='GTR+G', prefix='T3'):
+def run_raxmlng_bootstrap(alignment, output_dir, num_threads=3, model='GTR+G', prefix='T3',
+                          log_file=None):
     '''
-    """
     Runs RAxML-NG to perform a bootstrap analysis on a given sequence alignment.
 
     RAxML-NG is called with bootstrap mode enabled, using the specified number of threads,
@@ -175,6 +253,7 @@ def run_raxmlng_bootstrap(alignment, output_dir, num_threads=3, model='GTR+G', p
     num_threads (int, optional): Number of threads RAxML-NG will use for the computation. Defaults to 3.
     model (str, optional): The substitution model used for RAxML-NG. Defaults to 'GTR+G'.
     prefix (str, optional): The prefix for output files from RAxML-NG. Defaults to 'T3'.
+    log_file (str, optional): File to which the output of RAxML-NG is streamed as well.
 
     Returns:
     int: The return code from the RAxML-NG process. Zero indicates success, while non-zero indicates an error.
@@ -182,42 +261,11 @@ def run_raxmlng_bootstrap(alignment, output_dir, num_threads=3, model='GTR+G', p
     Raises:
     CalledProcessError: An error occurred in RAxML-NG.
     '''
+    return _run_sync(run_raxmlng_async(raxmlng_bootstrap_args(alignment, num_threads, model),
+                                       output_dir, prefix, log_file=log_file))
 
-    # Specify command for raxm-ng
-    cmd = [
-        'raxml-ng',
-        '--bootstrap',
-        '--msa', alignment,
-        '--model', model,
-        '--prefix', prefix,
-        '--threads', str(num_threads),
-        '--seed', '2'
-    ]
-
-    # Run the command via the subrocess module
-    results = subprocess.run(cmd,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE,
-                             text=True,
-                             check=True)
-
-    # Print output and error messages (if any)
-    print(results.stdout)
-    if results.stderr:
-        print(results.stderr)
 
-    # Move files to the output directory
-    for file in os.listdir():
-        if file.startswith(prefix):
-            os.rename(file, os.path.join(output_dir, file))
-    if results.returncode == 0:
-        print(f'Output files were moved to: {output_dir}')
-
-    return results.returncode
-
-
-
-def run_raxmlng_support(tree, output_dir, bootstraps, num_threads=3, prefix='T4'):
+def run_raxmlng_support(tree, output_dir, bootstraps, num_threads=3, prefix='T4', log_file=None):
     '''
     Runs RAxML-NG to map bootstrap support values onto the best-scoring ML tree.
 
@@ -231,6 +279,7 @@ def run_raxmlng_support(tree, output_dir, bootstraps, num_threads=3, prefix='T4'
     bootstraps (str): Path to the bootstrap trees file.
     num_threads (int, optional): Number of threads RAxML-NG will use for the computation. Defaults to 3.
     prefix (str, optional): The prefix for output files from RAxML-NG. Defaults to 'T4'.
+    log_file (str, optional): File to which the output of RAxML-NG is streamed as well.
 
     Returns:
     int: The return code from the RAxML-NG process. Zero indicates success, while non-zero indicates an error.
@@ -238,46 +287,105 @@ def run_raxmlng_support(tree, output_dir, bootstraps, num_threads=3, prefix='T4'
     Raises:
     CalledProcessError: An error occurred in RAxML-NG.
     '''
+    return _run_sync(run_raxmlng_async(raxmlng_support_args(tree, bootstraps, num_threads),
+                                       output_dir, prefix, log_file=log_file))
 
-    # Specify command for raxm-ng
-    cmd = [
-        'raxml-ng',
-        '--support',
-        '--tree', tree,
-        '--bs-trees', bootstraps,
-        '--prefix', prefix,
-        '--threads', str(num_threads),
-    ]
-
-    # Run the command via the subrocess module
-    results = subprocess.run(cmd,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE,
-                             text=True,
-                             check=True)
-
-    # Print output and error messages (if any)
-    print(results.stdout)
-    if results.stderr:
-        print(results.stderr)
 
-    # Move files to the output directory
-    for file in os.listdir():
-        if file.startswith(prefix):
-            os.rename(file, os.path.join(output_dir, file))
-    if results.returncode == 0:
-        print(f'Output files were moved to: {output_dir}')
+class RaxmlngJob:
+    '''
+    One raxml-ng invocation for run_raxmlng_jobs.
+
+    Parameters:
+    - name (str): Job name used in the report.
+    - args (list): raxml-ng arguments (e.g. from raxmlng_tree_args), without --prefix.
+    - output_dir (str): Output directory.
+    - prefix (str): raxml-ng prefix.
+    - threads (int): Threads used by the job (must match --threads in args).
+    '''
+
+    def __init__(self, name, args, output_dir, prefix, threads=1):
+        self.name = name
+        self.args = list(args)
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.threads = threads
+
+
+async def run_raxmlng_jobs_async(jobs, max_threads=None):
+    '''
+    Run raxml-ng jobs concurrently; a job starts only when its threads fit into max_threads.
+    The output of each job is streamed to <output_dir>/<prefix>.stdout.log.
+
+    Returns:
+    - dict: Job name -> return code, or the exception raised by the job.
+    '''
+    max_threads = max_threads or os.cpu_count() or 1
+    free = [max_threads]
+    condition = asyncio.Condition()
+
+    async def run(job):
+        threads = min(job.threads, max_threads)
+        async with condition:
+            await condition.wait_for(lambda: free[0] >= threads)
+            free[0] -= threads
+        print(f'Starting {job.name} ({threads} threads)')
+        try:
+            os.makedirs(job.output_dir, exist_ok=True)
+            return await run_raxmlng_async(job.args, job.output_dir, job.prefix,
+                                           log_file=os.path.join(job.output_dir,
+                                                                 f'{job.prefix}.stdout.log'),
+                                           echo=False)
+        finally:
+            async with condition:
+                free[0] += threads
+                condition.notify_all()
+
+    results = await asyncio.gather(*(run(job) for job in jobs), return_exceptions=True)
+    for job, result in zip(jobs, results):
+        print(f'{job.name}: {"failed (" + str(result) + ")" if isinstance(result, Exception) else "done"}')
+    return {job.name: result for job, result in zip(jobs, results)}
+
+
+def run_raxmlng_jobs(jobs, max_threads=None):
+    '''
+    Synchronous version of run_raxmlng_jobs_async (also usable in a notebook).
+    '''
+    return _run_sync(run_raxmlng_jobs_async(jobs, max_threads))
+
 
-    return results.returncode
+def tree_build_jobs(alignments_dir, output_root, variants=TREE_VARIANTS, prefix='T2',
+                    num_threads=3, model='GTR+G'):
+    '''
+    Create the ML tree jobs for the alignment variants of a run, e.g.
+    results/phyl_trees/<project>/<marker>/<denoise_method>/<sim>/alignments/vamp_mafft.fasta
+    -> results/phyl_trees/<project>/<marker>/<denoise_method>/<sim>/T2_mafft/T2.raxml.*
+
+    Parameters:
+    - alignments_dir (str): Directory with the alignments.
+    - output_root (str): Directory in which the <prefix>_<variant> directories are created.
+    - variants (dict, optional): Variant name -> alignment file name. Default is TREE_VARIANTS
+      (mafft, gblocks_medium, gblocks_strong).
+
+    Returns:
+    - list: RaxmlngJob objects, see run_raxmlng_jobs.
+    '''
+    return [RaxmlngJob(f'{prefix}_{variant}',
+                       raxmlng_tree_args(os.path.join(alignments_dir, file_name), num_threads, model),
+                       os.path.join(output_root, f'{prefix}_{variant}'),
+                       prefix,
+                       threads=num_threads)
+            for variant, file_name in variants.items()]
 
 
 def filter_fasta_file(file_path, exclude_pattern='XXXXXXXX'):
     '''
     Reads a FASTA file and filters out sequences whose headers contain a specified pattern.
 
-    This function processes a FASTA file line by line. If a header line (starting with '>')
-    contains the specified pattern, the function skips this line and its associated sequence.
-    Lines not matching the exclusion pattern are retained.
+    The FASTA file is streamed record by record (see fasta_io.iter_fasta). If a header
+    contains the specified pattern, the record is skipped. The retained records are
+    yielded as FASTA lines (header line and unwrapped sequence line), so the result
+    can be passed to shorten_sequence_names or directly to file.writelines without
+    holding the whole file in memory.
 
     Args:
     file_path (str): The path to the FASTA file to be processed.
@@ -285,67 +393,56 @@ def filter_fasta_file(file_path, exclude_pattern='XXXXXXXX'):
                                      Defaults to 'XXXXXXXX'. If a header contains this pattern,
                                      the function excludes the entire sequence (header and sequence data).
 
-    Returns:
-    list: A list of strings, where each string is a line from the original FASTA file that
-          does not include the exclusion pattern in its header.
+    Yields:
+    str: Lines of the FASTA records that do not include the exclusion pattern in their header.
 
     '''
-    with open(file_path, 'r') as infile:
-        lines = infile.readlines()
-
-    filtered_lines = []
-    skip = False
-
-    for line in lines:
-        if line.startswith('>'):
-            skip = exclude_pattern in line
-        if not skip:
-            filtered_lines.append(line)
-    return filtered_lines
+    for header, sequence in iter_fasta(file_path):
+        if exclude_pattern in header:
+            continue
+        yield f'>{header}\n'
+        yield f'{sequence}\n'
 
 
 def shorten_sequence_names(alignment):
-    shorten_seq_names = []
     for line in alignment:
         if line.startswith('>'):
             tax_name = line.split('|')[-1].strip()
             gi = line.split('|')[0].strip('>').strip()
-            new_name = '>' + tax_name + '_' + gi + '\n'
-            shorten_seq_names.append(new_name)
+            yield '>' + tax_name + '_' + gi + '\n'
         else:
-            shorten_seq_names.append(line)
-
-    return shorten_seq_names
+            yield line
 
 
 def num_seqs(alignment_path):
     '''
     Returns number sequences from FASTA file that is provide as an input (alignment_path)
     '''
-    with open(alignment_path, 'r') as infile:
-        count_ = 0
-        for line in infile:
-            if line.startswith('>'):
-                count_ += 1
-    return count_
+    return count_fasta_records(alignment_path)
 
 
-def run_gblocks(input_alignment, b1, b2, b3, b4, b5, name_specifier='', gblocks_path = GBLOCKS_PATH):
+def _run_gblocks_isolated(input_alignment, b1, b2, b3, b4, b5, gblocks_path=GBLOCKS_PATH):
+    '''
+    Run Gblocks on a copy of the alignment in a private temp directory.
 
-    # Variables
-    directory_path = os.path.dirname(input_alignment)
-    input_file_name, _ = os.path.splitext(os.path.basename(input_alignment))
-    # Specify the original and desired output names
-    original_fasta_output = input_alignment + ".gb"
-    fasta_output = os.path.join(directory_path, f'{input_file_name}_gblocks{name_specifier}.fasta')
-    original_html_output = input_alignment + ".gb.htm"
-    html_output = os.path.join(directory_path, f'{input_file_name}_gblocks{name_specifier}.fasta.html')
-    # Path for the output .log file
-    log_file_path = os.path.join(directory_path, f'{input_file_name}_gblocks{name_specifier}.log')
+    Gblocks writes its output next to the input file (<input>.gb, <input>.gb.htm), so every
+    run gets its own directory and runs cannot overwrite each other.
+
+    Returns:
+    - workdir (str): The temp directory (to be removed by the caller).
+    - fasta_output, html_output (str): Paths to the Gblocks output files in workdir.
+    - result (subprocess.CompletedProcess): The Gblocks process (stdout and stderr).
+
+    Raises:
+    - RuntimeError: If Gblocks did not write an output alignment.
+    '''
+    workdir = tempfile.mkdtemp(prefix='gblocks_')
+    alignment_copy = os.path.join(workdir, 'alignment.fasta')
+    shutil.copyfile(input_alignment, alignment_copy)
 
     # Gblocks parameters
-    cmd = [gblocks_path,
-           input_alignment,
+    cmd = [os.path.abspath(gblocks_path),
+           alignment_copy,
            '-t=d',
            f'-b1={b1}',
            f'-b2={b2}',
@@ -354,32 +451,141 @@ def run_gblocks(input_alignment, b1, b2, b3, b4, b5, name_specifier='', gblocks_
            f'-b5={b5}',
            '-e=.gb']
 
-    result = subprocess.run(cmd, capture_output=True, text=True)
+    # Gblocks does not return 0 on success, the output file is checked instead
+    result = subprocess.run(cmd, capture_output=True, text=True, cwd=workdir)
+    fasta_output = alignment_copy + '.gb'
+    if not os.path.exists(fasta_output):
+        shutil.rmtree(workdir, ignore_errors=True)
+        raise RuntimeError(f'Gblocks failed for b1={b1} b2={b2} b3={b3} b4={b4} b5={b5}:\n'
+                           f'{result.stdout}{result.stderr}')
+    return workdir, fasta_output, alignment_copy + '.gb.htm', result
 
-    # Rename the files
-    os.rename(original_fasta_output, fasta_output)
-    os.rename(original_html_output, html_output)
 
+def _write_gblocks_log(log_file_path, result, html_output, input_alignment):
     # Grab info from the gblocks HTML file and save it to the log file
-    # Open the HTML file and read its content
     with open(html_output, 'r') as file:
         content = file.read()
 
-        # Using regex to find content between <pre> and </pre>
-        match = re.search(r'<pre>.*?<b>Parameters used</b>(.*?)</pre>', content, re.DOTALL)
+    # Using regex to find content between <pre> and </pre>
+    match = re.search(r'<pre>.*?<b>Parameters used</b>(.*?)</pre>', content, re.DOTALL)
+
+    # Start with the Gblocks stdout content (with the original alignment path)
+    stdout = result.stdout.replace(os.path.join(os.path.dirname(html_output), 'alignment.fasta'),
+                                   input_alignment)
+    log_content = f"stdout:\n{stdout}\nstderr:\n{result.stderr}\n\n\nParameters used:\n"
 
-        # Start with the Gblocks stdout content
-        log_content = f"stdout:\n{result.stdout}\nstderr:\n{result.stderr}\n\n\nParameters used:\n"
+    if match:
+        log_content += match.group(1).strip()  # Append the extracted info to the log content
+    else:
+        log_content += "Pattern not found in the HTML file!"
 
+    # Write the combined content to the .log file
+    with open(log_file_path, 'w') as log_file:
+        log_file.write(log_content)
+
+
+def read_gblocks_parameters(log_file_path):
+    '''
+    The parameters Gblocks actually used (it resets invalid values to its defaults), from
+    the 'Parameters used' block of a log file written by run_gblocks.
+
+    Returns:
+    - dict: b1 - b4 (int) and b5 ('n', 'h' or 'a'); parameters not found are missing.
+    '''
+    with open(log_file_path, 'r') as log_file:
+        block = log_file.read().rpartition('Parameters used:')[2]
+    parameters = {}
+    for name, label in GBLOCKS_PARAMETERS.items():
+        match = re.search(rf'^{label}: (.+)$', block, re.MULTILINE)
         if match:
-            extracted_info = match.group(1).strip()  # Extract the content
-            log_content += extracted_info  # Append the extracted info to the log content
-        else:
-            log_content += "Pattern not found in the HTML file!"
+            value = match.group(1).strip()
+            parameters[name] = GBLOCKS_GAP_OPTIONS.get(value, value) if name == 'b5' else int(value)
+    return parameters
+
+
+def run_gblocks(input_alignment, b1, b2, b3, b4, b5, name_specifier='', gblocks_path=GBLOCKS_PATH,
+                output_dir=None, keep_html=True):
+    '''
+    Run Gblocks (DNA) with the parameters b1 - b5 in a private temp directory and save
+    <alignment>_gblocks<name_specifier>.fasta, .fasta.html and .log in output_dir
+    (default: the directory of the input alignment).
+
+    Returns:
+    - str: Path to the trimmed alignment.
+    '''
+    # Variables
+    output_dir = output_dir or os.path.dirname(input_alignment)
+    input_file_name, _ = os.path.splitext(os.path.basename(input_alignment))
+    fasta_output = os.path.join(output_dir, f'{input_file_name}_gblocks{name_specifier}.fasta')
+    html_output = os.path.join(output_dir, f'{input_file_name}_gblocks{name_specifier}.fasta.html')
+    # Path for the output .log file
+    log_file_path = os.path.join(output_dir, f'{input_file_name}_gblocks{name_specifier}.log')
+
+    workdir, gb_fasta, gb_html, result = _run_gblocks_isolated(input_alignment, b1, b2, b3, b4, b5,
+                                                               gblocks_path)
+    try:
+        _write_gblocks_log(log_file_path, result, gb_html, input_alignment)
+        shutil.move(gb_fasta, fasta_output)
+        if keep_html:
+            shutil.move(gb_html, html_output)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return fasta_output
+
+
+def score_trimmed_alignment(trimmed, original_length):
+    '''
+    Score a trimmed alignment.
+
+    Columns:
+    - retained_positions, percentage_retained: columns kept (of original_length).
+    - percentage_gaps: gaps in the trimmed alignment.
+    - avg_percentage_identity: identity to the first sequence (see AlignmentMatrix.stats).
+    - mean_conservation: mean fraction of the most frequent residue per column.
+    - score: geometric mean of the retained, non-gap and identity fractions (0 - 1). It
+      rewards keeping many columns while penalizing gappy and poorly conserved ones.
+    '''
+    if trimmed.n_cols == 0:
+        return {'retained_positions': 0, 'percentage_retained': 0.0, 'percentage_gaps': 0.0,
+                'avg_percentage_identity': 0.0, 'mean_conservation': 0.0, 'score': 0.0}
+    _, _, _, percentage_gaps, percentage_identity = trimmed.stats()
+    retained = trimmed.n_cols / original_length
+    score = (retained * (1 - percentage_gaps / 100) * (percentage_identity / 100)) ** (1 / 3)
+    return {'retained_positions': trimmed.n_cols,
+            'percentage_retained': retained * 100,
+            'percentage_gaps': percentage_gaps,
+            'avg_percentage_identity': percentage_identity,
+            'mean_conservation': float(trimmed.conservation().mean()),
+            'score': score}
+
+
+def _gblocks_grid_point(input_alignment, b1, b2, b3, b4, b5, name_specifier, gblocks_path,
+                        output_dir, original_length):
+    # One grid point on the process pool: run Gblocks, keep the alignment and log, score it.
+    # The row holds the parameters Gblocks used; 'reset' lists the requested values it replaced.
+    fasta_output = run_gblocks(input_alignment, b1, b2, b3, b4, b5,
+                               name_specifier=name_specifier, gblocks_path=gblocks_path,
+                               output_dir=output_dir, keep_html=False)
+    requested = dict(b1=b1, b2=b2, b3=b3, b4=b4, b5=b5)
+    used = dict(requested, **read_gblocks_parameters(os.path.splitext(fasta_output)[0] + '.log'))
+    reset = ','.join(f'{name}={value}' for name, value in requested.items() if used[name] != value)
+    scores = score_trimmed_alignment(AlignmentMatrix.from_fasta(fasta_output), original_length)
+    return dict(used, reset=reset, alignment=fasta_output, **scores)
+
+
+def rank_grid_points(grid_df, rank_by='score'):
+    '''
+    Sort the grid points best first by rank_by (ascending for the LOWER_IS_BETTER columns,
+    e.g. percentage_gaps, descending otherwise), then by b5_value and iteration_num, and
+    number them in a 'rank' column.
 
-        # Write the combined content to the .log file
-        with open(log_file_path, 'w') as log_file:
-            log_file.write(log_content)
+    Returns:
+    - pd.DataFrame: The ranked grid points.
+    '''
+    grid_df = grid_df.sort_values(by=[rank_by, 'b5_value', 'iteration_num'],
+                                  ascending=[rank_by in LOWER_IS_BETTER, True, True]).reset_index(drop=True)
+    grid_df.insert(0, 'rank', range(1, len(grid_df) + 1))
+    return grid_df
 
 
 def run_gblocks_grid_search(mafft_alignment,
@@ -388,10 +594,16 @@ def run_gblocks_grid_search(mafft_alignment,
                             b3_values,
                             b4_values,
                             b5_values,
-                            gblocks_path):
+                            gblocks_path=GBLOCKS_PATH,
+                            output_dir=None,
+                            processes=None,
+                            rank_by='score'):
     '''
     Execute Gblocks using a grid of parameter settings to fine-tune the alignment process.
 
+    Every grid point (b1[i], b2[i], b3[i], b4[i]) x b5 runs on a process pool in its own temp
+    directory and is scored automatically (see score_trimmed_alignment).
+
     Parameters:
     - mafft_alignment (str): Path to the alignment file generated using MAFFT.
     - b1_values (list): List of values for b1 parameter.
@@ -400,53 +612,87 @@ def run_gblocks_grid_search(mafft_alignment,
     - b4_values (list): List of values for b4 parameter.
     - b5_values (list): List of values for b5 parameter.
     - gblocks_path (str): Path to the Gblocks executable.
+    - output_dir (str, optional): Directory for the grid alignments and logs
+      (<alignment>_gblocks_grid_<b5>_<i>.fasta/.log). Default is 'grid_search' next to the alignment.
+    - processes (int, optional): Number of worker processes. Default is os.cpu_count().
+    - rank_by (str, optional): Column used to rank the grid points (see rank_grid_points).
+      Default is 'score'.
 
     Returns:
-    None. However, the function will produce alignment files with various parameters settings based on the grid search.
-    '''
-    for b5_value in b5_values:
-        for i in range(len(b1_values)):
-            b1 = b1_values[i]
-            b2 = b2_values[i]
-            b3 = b3_values[i]
-            b4 = b4_values[i]
-            b5 = b5_value
-            run_gblocks(input_alignment = mafft_alignment,
-                        b1 = b1,
-                        b2 = b2,
-                        b3 = b3,
-                        b4 = b4,
-                        b5 = b5,
-                        name_specifier=f'_grid_{b5_value}_{i}',
-                        gblocks_path = gblocks_path)
-
-def move_search_grid_files(directory_path, grid_search_path):
-    '''
-    Transfer Gblocks output files to a designated 'grid_search' directory and delete all associated .html files.
+    - pd.DataFrame: One row per grid point (b5_value, iteration_num, b1 - b5 as Gblocks used
+      them, reset (the requested values Gblocks replaced, e.g. 'b1=119,b2=119'), alignment and
+      the scores), ranked by rank_by (best first). It is also saved as
+      <alignment>_gblocks_grid_scores.tsv in output_dir.
+    '''
+    output_dir = output_dir or os.path.join(os.path.dirname(mafft_alignment), 'grid_search')
+    os.makedirs(output_dir, exist_ok=True)
+    original_length = AlignmentMatrix.from_fasta(mafft_alignment).n_cols
+
+    grid = [(b5_value, i) for b5_value in b5_values for i in range(len(b1_values))]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(_gblocks_grid_point, mafft_alignment,
+                                   b1_values[i], b2_values[i], b3_values[i], b4_values[i], b5_value,
+                                   f'_grid_{b5_value}_{i}', gblocks_path, output_dir, original_length)
+                   for b5_value, i in grid]
+        rows = []
+        for (b5_value, i), future in zip(grid, futures):
+            try:
+                rows.append(dict(b5_value=b5_value, iteration_num=i, **future.result()))
+            except Exception as e:
+                print(f'Grid point b5={b5_value} iteration {i} failed: {e}')
+
+    grid_df = pd.DataFrame(rows)
+    if not grid_df.empty:
+        grid_df = rank_grid_points(grid_df, rank_by)
+    input_file_name, _ = os.path.splitext(os.path.basename(mafft_alignment))
+    grid_df.to_csv(os.path.join(output_dir, f'{input_file_name}_gblocks_grid_scores.tsv'),
+                   sep='\t', index=False)
+    return grid_df
+
+
+def gblocks_grid_search_native(mafft_alignment,
+                               b1_values,
+                               b2_values,
+                               b3_values,
+                               b4_values,
+                               b5_values,
+                               output_dir=None,
+                               rank_by='score'):
+    '''
+    Evaluate the same grid as run_gblocks_grid_search in-process with the NumPy Gblocks engine
+    (gblocks_engine.py) instead of one Gblocks run per grid point. The column states are
+    computed once. Invalid b1 / b2 values are reset to the Gblocks defaults as Gblocks 0.91b
+    resets them, so the selected columns match Gblocks for any grid (the b1 / b2 columns hold
+    the values used, 'reset' the requested values that were replaced).
 
     Parameters:
-    - directory_path (str): Path to the directory containing the output files from Gblocks.
-    - grid_search_path (str): Destination path for the 'grid_search' directory where output files will be moved.
+    - mafft_alignment (str): Path to the alignment file generated using MAFFT.
+    - b1_values - b5_values (list): Grid values, see run_gblocks_grid_search.
+    - output_dir (str, optional): If given, the trimmed alignments
+      (<alignment>_gblocks_grid_<b5>_<i>.fasta) and the score table are written there.
+      Default is to keep everything in memory (interactive exploration).
+    - rank_by (str, optional): Column used to rank the grid points (see rank_grid_points).
+      Default is 'score'.
 
     Returns:
-    None. However, the function will move the specified files and delete any .html files in the target directory.
+    - pd.DataFrame: One row per grid point (rank, b5_value, iteration_num, b1 - b5, reset,
+      positions, blocks, alignment (None if not written) and the scores of score_trimmed_alignment),
+      ranked by rank_by (best first).
     '''
-    # Move all the output files to the separate 'grid_search' directory
-    files_to_move = [os.path.join(directory_path, f) for f in os.listdir(directory_path) if 'grid' in f.lower() and os.path.isfile(os.path.join(directory_path, f))]
-
-    grid_search_path = os.path.join(directory_path, 'grid_search')
-
-    # Check if directory already exists, if not, create it
-    if not os.path.exists(grid_search_path):
-        os.mkdir(grid_search_path)
-
-    for file in files_to_move:
-        file_name = os.path.basename(file)  # Extract just the filename from the full path
-        destination_path = os.path.join(grid_search_path, file_name)  # Construct the destination path
-        shutil.move(file, destination_path)
-
-    # delete all the html files
-    for file in os.listdir(grid_search_path):
-        if file.endswith('.html'):
-            file_path = os.path.join(grid_search_path, file)
-            os.remove(file_path)
+    alignment = AlignmentMatrix.from_fasta(mafft_alignment)
+    grid_df, masks = gblocks_grid(alignment, b1_values, b2_values, b3_values, b4_values, b5_values)
+
+    input_file_name, _ = os.path.splitext(os.path.basename(mafft_alignment))
+    grid_df['alignment'] = None
+    if output_dir:
+        grid_df['alignment'] = write_trimmed_alignments(alignment, grid_df, masks, output_dir,
+                                                        name=input_file_name)
+    scores = pd.DataFrame([score_trimmed_alignment(alignment.select_columns(mask), alignment.n_cols)
+                           for mask in masks], index=grid_df.index)
+    grid_df = pd.concat([grid_df, scores], axis=1)
+
+    grid_df = rank_grid_points(grid_df, rank_by)
+    if output_dir:
+        grid_df.to_csv(os.path.join(output_dir, f'{input_file_name}_gblocks_grid_scores.tsv'),
+                       sep='\t', index=False)
+    return grid_df
@@ -0,0 +1,212 @@
+# Indexed random access to large FASTA files (PR2 and other reference databases)
+#
+# build_fasta_index writes a samtools-compatible .fai index (NAME, LENGTH, OFFSET,
+# LINEBASES, LINEWIDTH) next to the FASTA file plus a .hdx file holding a hash of
+# the full header lines and their byte offsets. IndexedFasta memory-maps the FASTA
+# file and uses both indices to fetch records without parsing the file. Records of UTAX
+# files (PR2: '<accession>;tax=k:...') can also be fetched by their accession.
+
+# Imports
+import mmap
+import os
+import pickle
+
+# Constants
+FAI_SUFFIX = '.fai'
+HEADER_INDEX_SUFFIX = '.hdx'
+TAX_SEPARATOR = ';tax='  # UTAX headers: '<accession>;tax=<taxonomy>'
+
+
+def build_fasta_index(fasta_path):
+    '''
+    Build the .fai and .hdx indices for a (non-compressed) FASTA file.
+
+    Parameters:
+    - fasta_path (str): Path to the FASTA file.
+
+    Returns:
+    - int: The number of indexed records.
+
+    Raises:
+    - ValueError: If a record has lines of different lengths (other than its last line)
+      or a record name occurs more than once, as faidx cannot index such files.
+    '''
+    fai_rows = []
+    header_offsets = {}
+    record = None
+
+    def close_record():
+        name, length, seq_offset, linebases, linewidth, _ = record
+        fai_rows.append(f'{name}\t{length}\t{seq_offset}\t{linebases}\t{linewidth}\n')
+
+    with open(fasta_path, 'rb') as handle:
+        offset = 0
+        for line in handle:
+            line_length = len(line)
+            if line.startswith(b'>'):
+                if record is not None:
+                    close_record()
+                header = line[1:].rstrip().decode()
+                name = header.split(maxsplit=1)[0] if header.strip() else header
+                if header in header_offsets:
+                    raise ValueError(f'Duplicate FASTA header in {fasta_path}: {header}')
+                header_offsets[header] = offset
+                # [name, length, sequence offset, line bases, line width, last line was short]
+                record = [name, 0, offset + line_length, 0, 0, False]
+            elif record is not None:
+                bases = len(line.rstrip(b'\r\n'))
+                if record[5] and bases:
+                    raise ValueError(f'Different line lengths in record {record[0]} of {fasta_path}.')
+                if record[3] == 0:
+                    record[3], record[4] = bases, line_length
+                elif bases != record[3]:
+                    record[5] = True
+                record[1] += bases
+            offset += line_length
+        if record is not None:
+            close_record()
+
+    names = [row.split('\t', 1)[0] for row in fai_rows]
+    if len(set(names)) != len(names):
+        raise ValueError(f'Duplicate sequence names in {fasta_path}, cannot build a faidx index.')
+
+    with open(fasta_path + FAI_SUFFIX, 'w') as fai_file:
+        fai_file.writelines(fai_rows)
+    with open(fasta_path + HEADER_INDEX_SUFFIX, 'wb') as hdx_file:
+        pickle.dump(header_offsets, hdx_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    return len(fai_rows)
+
+
+def index_is_current(fasta_path):
+    '''
+    Return True if both index files exist and are newer than the FASTA file.
+    '''
+    fasta_mtime = os.path.getmtime(fasta_path)
+    for suffix in (FAI_SUFFIX, HEADER_INDEX_SUFFIX):
+        index_path = fasta_path + suffix
+        if not os.path.exists(index_path) or os.path.getmtime(index_path) < fasta_mtime:
+            return False
+    return True
+
+
+class IndexedFasta:
+    '''
+    Memory-mapped, random-access view of an indexed FASTA file.
+
+    The index is (re)built automatically if it is missing or older than the FASTA file.
+    Records are addressed by their name (first word of the header, as in faidx). For UTAX
+    headers the name is the whole 'AB000001.1.1795_U;tax=k:...,s:...' string, so the
+    accession before ';tax=' is accepted as an alias (unless it names two records).
+
+    Usage:
+        with IndexedFasta(pr2_fasta) as pr2:
+            sequence = pr2.fetch('AB000001.1.1795_U')
+            vamp_records = pr2.fetch_records(pr2.find_headers('o:Vampyrellida'))
+    '''
+
+    def __init__(self, fasta_path, rebuild=False):
+        self.fasta_path = fasta_path
+        if rebuild or not index_is_current(fasta_path):
+            build_fasta_index(fasta_path)
+
+        self.index = {}
+        with open(fasta_path + FAI_SUFFIX, 'r') as fai_file:
+            for line in fai_file:
+                name, length, offset, linebases, linewidth = line.rstrip('\n').split('\t')
+                self.index[name] = (int(length), int(offset), int(linebases), int(linewidth))
+
+        with open(fasta_path + HEADER_INDEX_SUFFIX, 'rb') as hdx_file:
+            self.header_offsets = pickle.load(hdx_file)
+        self.headers = {header.split(maxsplit=1)[0] if header.strip() else header: header
+                        for header in self.header_offsets}
+        self.aliases = {}
+        ambiguous = set()
+        for name in self.index:
+            accession, separator, _ = name.partition(TAX_SEPARATOR)
+            if separator and accession not in self.index:
+                if accession in self.aliases:
+                    ambiguous.add(accession)
+                self.aliases[accession] = name
+        for accession in ambiguous:
+            del self.aliases[accession]
+
+        self._file = open(fasta_path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) \
+            if os.path.getsize(fasta_path) else b''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if isinstance(self._mmap, mmap.mmap):
+            self._mmap.close()
+        self._file.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, name):
+        return name in self.index or name in self.aliases
+
+    def resolve(self, name):
+        '''
+        Return the record name of a name or accession alias.
+
+        Raises:
+        - KeyError: If neither a record name nor an accession alias.
+        '''
+        return name if name in self.index else self.aliases[name]
+
+    def names(self):
+        '''
+        Return the record names in file order.
+        '''
+        return list(self.index)
+
+    def fetch(self, name, start=0, end=None):
+        '''
+        Return the sequence (or the 0-based, end-exclusive sub-sequence) of a record
+        (by name or accession).
+
+        Raises:
+        - KeyError: If the record name is not in the index.
+        '''
+        length, offset, linebases, linewidth = self.index[self.resolve(name)]
+        end = length if end is None else min(end, length)
+        if start >= end:
+            return ''
+        if linebases == 0:
+            return ''
+        first = offset + (start // linebases) * linewidth + start % linebases
+        last = offset + ((end - 1) // linebases) * linewidth + (end - 1) % linebases + 1
+        return self._mmap[first:last].translate(None, b'\r\n').decode()
+
+    def fetch_record(self, name):
+        '''
+        Return the (full header, sequence) tuple of a record (by name or accession).
+        '''
+        name = self.resolve(name)
+        return self.headers[name], self.fetch(name)
+
+    def fetch_records(self, names):
+        '''
+        Return (full header, sequence) tuples for a batch of record names.
+
+        The records are read from the memory map in file order (sequential access)
+        and returned in the order of the requested names.
+        '''
+        names = list(names)
+        by_offset = sorted(set(names), key=lambda name: self.index[self.resolve(name)][1])
+        fetched = {name: self.fetch_record(name) for name in by_offset}
+        return [fetched[name] for name in names]
+
+    def find_headers(self, pattern):
+        '''
+        Return the names of records whose full header contains the pattern
+        (e.g. 'o:Vampyrellida' or 'g:Vampyrella'). Only the header hash is scanned.
+        '''
+        return [name for name, header in self.headers.items() if pattern in header]
@@ -0,0 +1,94 @@
+# Shared streaming FASTA reader and writer used by the python scripts and notebooks
+
+# Imports
+import gzip
+
+# Constants
+BUFFER_SIZE = 1024 * 1024  # 1 MB read/write buffer
+
+
+def open_fasta(file_path, mode='rb'):
+    '''
+    Open a (optionally gzipped) FASTA file in binary mode with a large buffer.
+    Files ending with '.gz' are opened with gzip.
+    '''
+    if str(file_path).endswith('.gz'):
+        return gzip.open(file_path, mode)
+    return open(file_path, mode, buffering=BUFFER_SIZE)
+
+
+def iter_fasta(file_path, as_bytes=False):
+    '''
+    Stream the records of a FASTA file one at a time.
+
+    The file is read at the bytes level and the sequence lines of each record are
+    collected into a list and joined once, so long (multi-line) sequences are not
+    built by repeated string concatenation. Only one record is held in memory.
+
+    Parameters:
+    - file_path (str): Path to the FASTA file (plain or gzipped).
+    - as_bytes (bool, optional): Yield bytes instead of str. Default is False.
+
+    Yields:
+    - tuple: (header, sequence) with the header stripped of the leading '>'.
+    '''
+    with open_fasta(file_path) as handle:
+        header = None
+        chunks = []
+        for line in handle:
+            if line.startswith(b'>'):
+                if header is not None:
+                    yield _make_record(header, chunks, as_bytes)
+                header = line[1:].rstrip()
+                chunks = []
+            elif header is not None:
+                chunks.append(line.rstrip())
+        if header is not None:
+            yield _make_record(header, chunks, as_bytes)
+
+
+def _make_record(header, chunks, as_bytes):
+    sequence = b''.join(chunks)
+    if as_bytes:
+        return header, sequence
+    return header.decode(), sequence.decode()
+
+
+def format_fasta(header, sequence, line_width=None):
+    '''
+    Return a single FASTA record as a string (header + sequence, newline terminated).
+    If line_width is given, the sequence is wrapped to lines of that width.
+    '''
+    if line_width:
+        sequence = '\n'.join(sequence[i:i + line_width]
+                             for i in range(0, len(sequence), line_width))
+    return f'>{header}\n{sequence}\n'
+
+
+def write_fasta(records, output_path, mode='w', line_width=None):
+    '''
+    Write (header, sequence) records to a FASTA file through a buffered writer.
+
+    Parameters:
+    - records (iterable): Iterable of (header, sequence) tuples, e.g. from iter_fasta.
+    - output_path (str): Path to the output FASTA file.
+    - mode (str, optional): 'w' to overwrite or 'a' to append. Default is 'w'.
+    - line_width (int, optional): Wrap sequences to this width. Default is no wrapping.
+
+    Returns:
+    - int: The number of records written.
+    '''
+    count_ = 0
+    with open(output_path, mode, buffering=BUFFER_SIZE) as outfile:
+        for header, sequence in records:
+            outfile.write(format_fasta(header, sequence, line_width))
+            count_ += 1
+    return count_
+
+
+def count_fasta_records(file_path):
+    '''
+    Return the number of records in a FASTA file without keeping any sequence data.
+    '''
+    with open_fasta(file_path) as handle:
+        return sum(1 for line in handle if line.startswith(b'>'))
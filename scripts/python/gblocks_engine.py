@@ -0,0 +1,219 @@
+# In-process Gblocks (0.91b) block selection for DNA alignments
+#
+# The per-column states (number of sequences with the most frequent residue and number
+# of gaps) are computed once per alignment. A grid of b1 - b5 settings is then evaluated
+# as (n_grid x n_cols) array operations, following the Gblocks rules:
+# 1. Positions are nonconserved (< b1 identical residues), conserved (>= b1) or highly
+#    conserved / flank positions (>= b2). Gap positions (b5) count as nonconserved.
+# 2. Stretches of more than b3 contiguous nonconserved positions are rejected.
+# 3. The remaining blocks are trimmed until both flanks are highly conserved positions.
+# 4. Gap positions are removed together with the nonconserved positions next to them.
+# 5. Blocks shorter than b4 are rejected.
+#
+# Gap positions (b5): 'n' any gap, 'h' gaps in half or more of the sequences, 'a' none.
+#
+# Invalid b1 / b2 values are reset to the Gblocks defaults as Gblocks does (see
+# effective_parameters), e.g. b1 = b2 = 119 runs as 59 / 98 with 116 sequences.
+
+# Imports
+import os
+
+import numpy as np
+import pandas as pd
+
+from alignment_matrix import AlignmentMatrix
+
+# Constants
+GAP_OPTIONS = ('n', 'h', 'a')
+B2_DEFAULT_FRACTION = 0.85  # default b2: 85 % of the sequences (rounded down)
+
+
+def effective_parameters(b1, b2, n_seqs):
+    '''
+    The b1 and b2 values Gblocks 0.91b runs with. Gblocks checks -b1 before -b2 and resets
+    an invalid value to its default (with a warning):
+    - b1 must be more than half of the sequences and at most b2 (still the default b2 when
+      -b1 is checked); default n_seqs // 2 + 1.
+    - b2 must be at least b1 and at most n_seqs; default 85 % of n_seqs.
+
+    Returns:
+    - b1, b2 (int): The values used.
+    - reset (list): The names of the reset parameters ('b1', 'b2').
+    '''
+    b1_default = n_seqs // 2 + 1
+    b2_default = int(B2_DEFAULT_FRACTION * n_seqs)
+    reset = []
+    if not b1_default <= b1 <= b2_default:
+        b1 = b1_default
+        reset.append('b1')
+    if not b1 <= b2 <= n_seqs:
+        b2 = b2_default
+        reset.append('b2')
+    return b1, b2, reset
+
+
+def column_states(alignment):
+    '''
+    Compute the column states used by all grid points.
+
+    Returns:
+    - identical (np.ndarray): Per column, the number of sequences with the most frequent residue.
+    - gaps (np.ndarray): Per column, the number of gaps.
+    '''
+    _, counts = alignment.symbol_counts()
+    identical = counts.max(axis=0) if counts.size else np.zeros(alignment.n_cols, dtype=np.int64)
+    return identical, alignment.gaps_per_column()
+
+
+def _grid_arrays(grid, n_seqs):
+    # (b1, b2, b3, b4, b5) tuples -> one column vector per parameter (b1 / b2 as Gblocks uses them)
+    grid = [effective_parameters(point[0], point[1], n_seqs)[:2] + tuple(point[2:]) for point in grid]
+    for point in grid:
+        if point[4] not in GAP_OPTIONS:
+            raise ValueError(f'Invalid b5 value {point[4]!r} (allowed: {", ".join(GAP_OPTIONS)}).')
+    b1, b2, b3, b4 = (np.array([point[i] for point in grid], dtype=np.int64)[:, None] for i in range(4))
+    b5 = np.array([point[4] for point in grid])[:, None]
+    return b1, b2, b3, b4, b5
+
+
+def _run_ids(mask):
+    # Label the runs of True values of a flat mask (1, 2, ...; 0 outside runs)
+    starts = mask & ~np.concatenate([[False], mask[:-1]])
+    return np.where(mask, np.cumsum(starts), 0)
+
+
+def _run_lengths(mask):
+    # Length of the run every True position belongs to (0 outside runs)
+    run_ids = _run_ids(mask)
+    return np.where(mask, np.bincount(run_ids)[run_ids], 0)
+
+
+def _flanked(mask, flank):
+    # Positions of each run of mask that lie between its first and last flank position
+    run_ids = _run_ids(mask)
+    hits = (mask & flank).astype(np.int64)
+    per_run = np.bincount(run_ids, weights=hits).astype(np.int64)
+    # Flank positions of the run up to and from each position (both inclusive)
+    up_to = np.cumsum(hits) - (np.cumsum(per_run) - per_run)[run_ids]
+    from_here = per_run[run_ids] - up_to + hits
+    return mask & (up_to > 0) & (from_here > 0)
+
+
+def select_blocks(identical, gaps, n_seqs, grid):
+    '''
+    Apply the Gblocks rules for every grid point.
+
+    Parameters:
+    - identical, gaps (np.ndarray): Column states from column_states.
+    - n_seqs (int): Number of sequences in the alignment.
+    - grid (iterable): (b1, b2, b3, b4, b5) tuples; invalid b1 / b2 values are reset as
+      Gblocks resets them (effective_parameters).
+
+    Returns:
+    - masks (np.ndarray): (n_grid x n_cols) boolean array of the selected columns.
+    - n_blocks (np.ndarray): Number of selected blocks per grid point.
+    '''
+    b1, b2, b3, b4, b5 = _grid_arrays(grid, n_seqs)
+    n_grid, n_cols = len(b1), len(identical)
+
+    gap_position = np.where(b5 == 'n', gaps > 0, np.where(b5 == 'h', 2 * gaps >= n_seqs, False))
+    nonconserved = identical < b1
+    flank = (identical >= b2) & ~gap_position
+
+    # The grid rows are padded with one False column and flattened, so the run
+    # operations never join positions of two grid points
+    def flat(array):
+        padded = np.zeros((n_grid, n_cols + 1), dtype=bool)
+        padded[:, :n_cols] = array
+        return padded.ravel()
+
+    def flat_param(param):
+        return np.repeat(param[:, 0], n_cols + 1)
+
+    columns = flat(np.ones((n_grid, n_cols), dtype=bool))
+    rejected = flat(nonconserved | gap_position)
+    candidate = columns & (~rejected | (_run_lengths(rejected) <= flat_param(b3)))
+    blocks = _flanked(candidate, flat(flank))
+
+    # Gap positions take the nonconserved positions next to them with them
+    flat_gap_position = flat(gap_position)
+    removable = flat(nonconserved | gap_position)
+    removable_ids = _run_ids(removable)
+    with_gaps = np.bincount(removable_ids, weights=flat_gap_position) > 0
+    with_gaps[0] = False
+    blocks &= ~with_gaps[removable_ids]
+
+    blocks &= _run_lengths(blocks) >= flat_param(b4)
+    masks = blocks.reshape(n_grid, n_cols + 1)[:, :n_cols]
+    starts = masks & ~np.concatenate([np.zeros((n_grid, 1), dtype=bool), masks[:, :-1]], axis=1)
+    return masks, starts.sum(axis=1)
+
+
+def gblocks_trim(alignment, b1, b2, b3, b4, b5):
+    '''
+    Trim an alignment with one Gblocks setting.
+
+    Parameters:
+    - alignment (str or AlignmentMatrix): Path to an aligned FASTA file or a loaded alignment.
+
+    Returns:
+    - trimmed (AlignmentMatrix): The selected columns.
+    - n_blocks (int): Number of selected blocks.
+    '''
+    if not isinstance(alignment, AlignmentMatrix):
+        alignment = AlignmentMatrix.from_fasta(alignment)
+    identical, gaps = column_states(alignment)
+    masks, n_blocks = select_blocks(identical, gaps, alignment.n_seqs, [(b1, b2, b3, b4, b5)])
+    return alignment.select_columns(masks[0]), int(n_blocks[0])
+
+
+def gblocks_grid(alignment, b1_values, b2_values, b3_values, b4_values, b5_values):
+    '''
+    Evaluate a Gblocks parameter grid, laid out as in create_phyl_tree.run_gblocks_grid_search:
+    every (b1[i], b2[i], b3[i], b4[i]) combined with every b5 value.
+
+    Parameters:
+    - alignment (str or AlignmentMatrix): Path to an aligned FASTA file or a loaded alignment.
+
+    Returns:
+    - grid_df (pd.DataFrame): One row per grid point (b5_value, iteration_num, b1 - b5 as
+      Gblocks uses them, reset, positions, blocks). reset lists the requested values Gblocks
+      would have reset (e.g. 'b1=119,b2=119'), empty if none.
+    - masks (np.ndarray): (n_grid x n_cols) boolean array of the selected columns, in the
+      row order of grid_df.
+    '''
+    if not isinstance(alignment, AlignmentMatrix):
+        alignment = AlignmentMatrix.from_fasta(alignment)
+    points = [(b5_value, i) for b5_value in b5_values for i in range(len(b1_values))]
+    grid = [(b1_values[i], b2_values[i], b3_values[i], b4_values[i], b5_value) for b5_value, i in points]
+
+    identical, gaps = column_states(alignment)
+    masks, n_blocks = select_blocks(identical, gaps, alignment.n_seqs, grid)
+    effective = [effective_parameters(b1, b2, alignment.n_seqs) for b1, b2, *_ in grid]
+    grid_df = pd.DataFrame([(b1, b2) + point[2:] for (b1, b2, _), point in zip(effective, grid)],
+                           columns=['b1', 'b2', 'b3', 'b4', 'b5'])
+    grid_df['reset'] = [','.join(f'{name}={point[int(name[1]) - 1]}' for name in reset)
+                        for (_, _, reset), point in zip(effective, grid)]
+    grid_df.insert(0, 'iteration_num', [i for _, i in points])
+    grid_df.insert(0, 'b5_value', [b5_value for b5_value, _ in points])
+    grid_df['positions'] = masks.sum(axis=1)
+    grid_df['blocks'] = n_blocks
+    return grid_df, masks
+
+
+def write_trimmed_alignments(alignment, grid_df, masks, output_dir, name=None):
+    '''
+    Write the trimmed alignment of every grid point as
+    <name>_gblocks_grid_<b5>_<i>.fasta in output_dir.
+
+    Returns:
+    - list: The written paths, in the row order of grid_df.
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    name = name or 'alignment'
+    paths = []
+    for (b5_value, i), mask in zip(grid_df[['b5_value', 'iteration_num']].itertuples(index=False), masks):
+        path = os.path.join(output_dir, f'{name}_gblocks_grid_{b5_value}_{i}.fasta')
+        alignment.select_columns(mask).to_fasta(path)
+        paths.append(path)
+    return paths
@@ -0,0 +1,370 @@
+# Compact reader for jplace files (epa-ng placement results)
+#
+# The reference tree (Newick with {edge} numbers) is parsed into flat arrays in postorder
+# (JplaceTree): parent index, branch length and edge number per node, so the subtree of a
+# node is a contiguous index range. The placements are scanned from a memory map of the file
+# and collected into columnar NumPy arrays (one row per placement, one array per jplace
+# field), without building a Python dict per placement.
+#
+# Usage:
+#   jplace = Jplace.from_file('epa_result_NH1_18S.jplace')
+#   jplaces = read_jplace_dir('../../results/phyl_placement/jplace/.../vampyrellida')
+
+# Imports
+import json
+import mmap
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+# Constants
+JPLACE_PATTERN = re.compile(r'^epa_result_(?P<sample>.+)\.jplace$')
+NEWICK_TOKENS = re.compile(r"'(?:[^']|'')*'|\{\d+\}|\[[^\]]*\]|:[^,(){};\[]*|[(),;]|[^,(){}:;\[\]']+")
+STRING = rb'"(?:[^"\\]|\\.)*"'
+TOP_LEVEL_KEY = re.compile(rb'"(tree|fields|version|metadata)"\s*:\s*')
+PLACEMENTS_KEY = re.compile(rb'"placements"\s*:\s*\[')
+VALUE_TOKEN = re.compile(STRING + rb'|[\[\]{},]')
+PLACEMENT_TOKEN = re.compile(
+    rb'"p"\s*:\s*(?P<p>\[[^"]*?\]\s*\])'
+    rb'|"(?P<key>nm?)"\s*:\s*(?P<named>\[(?:' + STRING + rb'|[^"\[\]]+|\[(?:' + STRING + rb'|[^"\]])*\])*\])'
+    rb'|' + STRING + rb'|(?P<bracket>[{}\]])')
+PLACEMENT_BATCH = 10000  # pqueries decoded at once
+BRACKETS = bytes.maketrans(b'[]', b'  ')
+
+
+class JplaceTree:
+    '''
+    Rooted tree stored as arrays in postorder (children before their parent, root last).
+
+    Attributes:
+    - names (list): Node labels ('' for unlabeled inner nodes).
+    - parent (np.ndarray): Index of the parent node (-1 for the root).
+    - branch_length (np.ndarray): Length of the branch above each node (nan if missing).
+    - edge_num (np.ndarray): jplace edge number of the branch above each node (-1 if missing).
+    - subtree_size (np.ndarray): Number of nodes in the subtree of each node; the subtree of
+      node i is the index range [i - subtree_size[i] + 1, i].
+    '''
+
+    def __init__(self, names, parent, branch_length, edge_num):
+        self.names = list(names)
+        self.parent = np.asarray(parent, dtype=np.int64)
+        self.branch_length = np.asarray(branch_length, dtype=np.float64)
+        self.edge_num = np.asarray(edge_num, dtype=np.int64)
+        self.subtree_size = np.ones(len(self.names), dtype=np.int64)
+        for node in range(len(self.names) - 1):
+            self.subtree_size[self.parent[node]] += self.subtree_size[node]
+
+    @classmethod
+    def from_newick(cls, newick):
+        '''
+        Parse a Newick string with optional {edge} numbers (jplace format).
+
+        Raises:
+        - ValueError: If the parentheses are not balanced.
+        '''
+        names, parent, branch_length, edge_num = [], [], [], []
+        open_nodes = [[]]  # children of the inner nodes that are still open
+        current = None  # the last completed node (labels, lengths and edges refer to it)
+
+        def new_node():
+            names.append('')
+            parent.append(-1)
+            branch_length.append(np.nan)
+            edge_num.append(-1)
+            return len(names) - 1
+
+        for token in NEWICK_TOKENS.findall(newick):
+            if token == '(':
+                open_nodes.append([])
+                current = None
+            elif token == ',':
+                current = None
+            elif token == ')':
+                if len(open_nodes) < 2:
+                    raise ValueError('Unbalanced parentheses in Newick string.')
+                children = open_nodes.pop()
+                current = new_node()
+                for child in children:
+                    parent[child] = current
+                open_nodes[-1].append(current)
+            elif token == ';':
+                break
+            elif token.startswith(':'):
+                branch_length[current] = float(token[1:]) if token[1:].strip() else np.nan
+            elif token.startswith('{'):
+                edge_num[current] = int(token[1:-1])
+            elif token.startswith('['):
+                continue  # comment
+            else:
+                if current is None:
+                    current = new_node()
+                    open_nodes[-1].append(current)
+                names[current] = (token[1:-1].replace("''", "'") if token.startswith("'")
+                                  else token.strip())
+
+        if len(open_nodes) != 1 or len(open_nodes[0]) != 1:
+            raise ValueError('Unbalanced parentheses in Newick string.')
+        return cls(names, parent, branch_length, edge_num)
+
+    @property
+    def n_nodes(self):
+        return len(self.names)
+
+    @property
+    def is_leaf(self):
+        return self.subtree_size == 1
+
+    @property
+    def leaf_names(self):
+        return [name for name, leaf in zip(self.names, self.is_leaf) if leaf]
+
+    def nodes_of_edges(self, edge_nums):
+        '''
+        Map jplace edge numbers to node indices (the node below each edge).
+        '''
+        lookup = np.full(self.edge_num.max(initial=-1) + 1, -1, dtype=np.int64)
+        has_edge = self.edge_num >= 0
+        lookup[self.edge_num[has_edge]] = np.flatnonzero(has_edge)
+        return lookup[np.asarray(edge_nums, dtype=np.int64)]
+
+    def descendant_leaves(self, node):
+        '''
+        Return the indices of the leaves in the subtree of node.
+        '''
+        subtree = np.arange(node - self.subtree_size[node] + 1, node + 1)
+        return subtree[self.is_leaf[subtree]]
+
+
+class Jplace:
+    '''
+    Placements of a jplace file in columnar form.
+
+    Attributes:
+    - tree (JplaceTree): The reference tree.
+    - fields (list): The jplace fields (e.g. edge_num, likelihood, like_weight_ratio,
+      distal_length, pendant_length).
+    - columns (dict): Field -> np.ndarray with one value per placement (edge_num as int).
+    - pquery (np.ndarray): Index of the placed query (pquery) of each placement.
+    - names (list): Query names; a pquery can have several names.
+    - name_pquery (np.ndarray): The pquery of each name.
+    - multiplicity (np.ndarray): Multiplicity of each name (1 for 'n' names).
+    - version, metadata: As in the file.
+    '''
+
+    def __init__(self, tree, fields, columns, pquery, names, name_pquery, multiplicity,
+                 version=None, metadata=None):
+        self.tree = tree
+        self.fields = list(fields)
+        self.columns = columns
+        self.pquery = pquery
+        self.names = names
+        self.name_pquery = name_pquery
+        self.multiplicity = multiplicity
+        self.version = version
+        self.metadata = metadata
+
+    @classmethod
+    def from_file(cls, jplace_path):
+        '''
+        Read a jplace file through a memory map.
+
+        Raises:
+        - ValueError: If the file has no tree, fields or placements.
+        '''
+        with open(jplace_path, 'rb') as jplace_file:
+            if os.fstat(jplace_file.fileno()).st_size == 0:
+                raise ValueError(f'{jplace_path} is empty.')
+            with mmap.mmap(jplace_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                placements_key = PLACEMENTS_KEY.search(data)
+                if placements_key is None:
+                    raise ValueError(f'No placements in {jplace_path}.')
+                placements = _scan_placements(data, placements_key.end())
+                values = _top_level_values(data, placements_key.start(), placements[-1])
+        if 'tree' not in values or 'fields' not in values:
+            raise ValueError(f'No tree or fields in {jplace_path}.')
+
+        fields = values['fields']
+        rows, rows_per_pquery, names, name_pquery, multiplicity, _ = placements
+        rows = rows.reshape(-1, len(fields))
+        pquery = np.repeat(np.arange(len(rows_per_pquery)), rows_per_pquery)
+        columns = {field: rows[:, i] for i, field in enumerate(fields)}
+        if 'edge_num' in columns:
+            columns['edge_num'] = columns['edge_num'].astype(np.int64)
+        return cls(JplaceTree.from_newick(values['tree']), fields, columns, pquery, names,
+                   np.asarray(name_pquery, dtype=np.int64),
+                   np.asarray(multiplicity, dtype=np.float64),
+                   version=values.get('version'), metadata=values.get('metadata'))
+
+    @property
+    def n_placements(self):
+        return len(self.pquery)
+
+    @property
+    def n_pqueries(self):
+        return int(self.name_pquery.max(initial=-1)) + 1
+
+    def best_placements(self, field='like_weight_ratio'):
+        '''
+        Return the index of the placement with the highest value of field for every pquery.
+        '''
+        order = np.lexsort((-self.columns[field], self.pquery))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = self.pquery[order][1:] != self.pquery[order][:-1]
+        return order[first]
+
+    def to_dataframe(self):
+        '''
+        Return one row per (query name, placement) with the name, its multiplicity, the
+        pquery index and all fields.
+        '''
+        name_order = np.argsort(self.name_pquery, kind='stable')
+        starts = np.searchsorted(self.name_pquery[name_order], self.pquery, side='left')
+        ends = np.searchsorted(self.name_pquery[name_order], self.pquery, side='right')
+        counts = ends - starts
+        placement_rows = np.repeat(np.arange(self.n_placements), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        name_rows = name_order[np.repeat(starts, counts) + offsets]
+        df = pd.DataFrame({'name': np.asarray(self.names, dtype=object)[name_rows],
+                           'multiplicity': self.multiplicity[name_rows],
+                           'pquery': self.pquery[placement_rows]})
+        for field in self.fields:
+            df[field] = self.columns[field][placement_rows]
+        return df
+
+
+def _scan_placements(data, start, batch_size=PLACEMENT_BATCH):
+    # Scan the placements array (starting after its '['). Every placement object has one "p"
+    # and one "n" or "nm" entry, so the i-th of each belong to the i-th pquery; they are
+    # decoded in batches, with one NumPy parse for all numbers of a batch.
+    values, rows_per_pquery, names, name_pquery, multiplicity = [], [], [], [], []
+    p_batch, named_batch = [], []
+
+    def flush():
+        numbers = b','.join(p_batch).translate(BRACKETS).replace(b'null', b'nan').decode()
+        values.append(np.fromstring(numbers, dtype=np.float64, sep=','))
+        index = len(rows_per_pquery)
+        rows_per_pquery.extend(p.count(b'[') - 1 for p in p_batch)
+        for key, entries in named_batch:
+            for entry in json.loads(b'[' + b','.join(entries) + b']'):
+                for name in entry:
+                    if key == b'nm':
+                        name, count = name
+                    else:
+                        count = 1.0
+                    names.append(name)
+                    multiplicity.append(count)
+                    name_pquery.append(index)
+                index += 1
+        p_batch.clear()
+        named_batch.clear()
+
+    depth = 0
+    end = len(data)
+    n_named = 0
+    for match in PLACEMENT_TOKEN.finditer(data, start):
+        group = match.lastgroup
+        if group == 'p':
+            p_batch.append(match.group('p'))
+        elif group == 'named':
+            key = match.group('key')
+            if not named_batch or named_batch[-1][0] != key:
+                named_batch.append((key, []))
+            named_batch[-1][1].append(match.group('named'))
+            n_named += 1
+        elif group == 'bracket':
+            token = match.group()
+            if token == b'{':
+                depth += 1
+            elif token == b'}':
+                depth -= 1
+                if len(p_batch) >= batch_size and n_named == len(p_batch):
+                    flush()
+                    n_named = 0
+            elif depth == 0:
+                end = match.end()
+                break
+    if n_named != len(p_batch):
+        raise ValueError('Every placement needs one "p" and one "n" or "nm" entry.')
+    flush()
+    return np.concatenate(values), rows_per_pquery, names, name_pquery, multiplicity, end
+
+
+def _top_level_values(data, placements_start, placements_end):
+    # Decode the small top-level values (tree, fields, version, metadata) before and after
+    # the placements, skipping over every decoded value
+    decoder = json.JSONDecoder()
+    values = {}
+    for start, end in ((0, placements_start), (placements_end, len(data))):
+        position = start
+        while True:
+            match = TOP_LEVEL_KEY.search(data, position, end)
+            if match is None:
+                break
+            length = _value_length(data, match.end())
+            key = match.group(1).decode()
+            values.setdefault(key, decoder.raw_decode(data[match.end():match.end() + length].decode())[0])
+            position = match.end() + length
+    return values
+
+
+def _value_length(data, start):
+    # Length of the JSON value starting at start (strings, numbers, arrays and objects)
+    depth = 0
+    for match in VALUE_TOKEN.finditer(data, start):
+        token = match.group()
+        if token in (b'[', b'{'):
+            depth += 1
+        elif token in (b']', b'}'):
+            if depth == 0:
+                return match.start() - start
+            depth -= 1
+            if depth == 0:
+                return match.end() - start
+        elif token == b',':
+            if depth == 0:
+                return match.start() - start
+        elif depth == 0:
+            return match.end() - start
+    return len(data) - start
+
+
+def read_jplace(jplace_path):
+    '''
+    Read a jplace file (see Jplace.from_file).
+    '''
+    return Jplace.from_file(jplace_path)
+
+
+def read_jplace_files(jplace_paths, processes=None):
+    '''
+    Read many jplace files in parallel.
+
+    Parameters:
+    - jplace_paths (dict): Sample -> path to its jplace file.
+    - processes (int, optional): Number of worker processes. Default is os.cpu_count().
+
+    Returns:
+    - dict: Sample -> Jplace.
+    '''
+    samples = list(jplace_paths)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        jplaces = executor.map(read_jplace, [jplace_paths[sample] for sample in samples])
+        return dict(zip(samples, jplaces))
+
+
+def read_jplace_dir(jplace_dir, processes=None):
+    '''
+    Read all epa_result_<SAMPLE>.jplace files of a directory in parallel.
+
+    Returns:
+    - dict: Sample -> Jplace, sorted by sample.
+    '''
+    jplace_paths = {}
+    for file_name in sorted(os.listdir(jplace_dir)):
+        match = JPLACE_PATTERN.match(file_name)
+        if match:
+            jplace_paths[match.group('sample')] = os.path.join(jplace_dir, file_name)
+    return read_jplace_files(jplace_paths, processes=processes)
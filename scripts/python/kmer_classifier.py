@@ -0,0 +1,408 @@
+# SINTAX-style k-mer classifier on the binary reference database (reference_database.py)
+#
+# An inverted k-mer index (k-mer -> records containing it, CSR layout) is built once from the
+# 2-bit packed sequences and stored in the database directory, so a database rebuild also
+# removes the outdated index. A query is classified as by vsearch --sintax: in every bootstrap
+# iteration a random subset of the query k-mers is drawn and the reference sharing most of
+# them is the top hit. At every rank the most frequent taxon among the top hits (within the
+# taxon chosen at the rank above) is assigned, its bootstrap confidence is the fraction of
+# iterations supporting it. Queries are classified in parallel worker processes.
+#
+# The classification also gives a cheap Vampyrellida prefilter: an OTU is a candidate when
+# enough top hits lie in the Vampyrellida records, so vsearch --usearch_global and the
+# eukaryote placement only need to run on the candidates.
+#
+# Usage (from scripts/python):
+#   python kmer_classifier.py --project Suthaus_2022 --marker Full18S --denoise-method RAD --sim sim_90
+
+# Imports
+import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from fasta_io import iter_fasta, write_fasta
+from reference_database import ReferenceDatabase
+from taxonomy_store import RANKS, RANK_PREFIXES
+
+# Constants
+INDEX_VERSION = 1
+KMER_LENGTH = 8  # as SINTAX
+N_BOOTSTRAPS = 100
+SUBSAMPLE_SIZE = 32  # k-mers drawn per bootstrap iteration
+CONFIDENCE_CUTOFF = 0.8  # vsearch --sintax_cutoff
+CANDIDATE_TAXON = 'Vampyrellida'
+CANDIDATE_RANK = 'Order'
+CANDIDATE_SUPPORT = 0.1  # permissive, vsearch and the placement make the final call
+INDEX_DIR = 'kmer_index_k{k}'
+INDEX_MANIFEST = 'index.json'
+BUILD_CHUNK = 4096  # records per chunk while building the index
+QUERY_CHUNK = 32  # queries per worker task
+SHIFTS = np.array([6, 4, 2, 0], dtype=np.uint8)
+# Query bases -> 2-bit codes (lower case and U accepted), 255 for anything else
+QUERY_ENCODE = np.full(256, 255, dtype=np.uint8)
+for _code, _bases in enumerate([b'Aa', b'Cc', b'Gg', b'TtUu']):
+    QUERY_ENCODE[np.frombuffer(_bases, dtype=np.uint8)] = _code
+
+
+def _window_kmers(codes, valid, owner, k):
+    '''
+    The k-mers of all windows of k valid codes that lie within one record.
+
+    Parameters:
+    - codes (np.ndarray): 2-bit codes (uint32) of the concatenated records.
+    - valid (np.ndarray): False for non-ACGT characters and padding.
+    - owner (np.ndarray): Record of every position.
+    - k (int): k-mer length.
+
+    Returns:
+    - kmers (np.ndarray): k-mer codes (uint32).
+    - records (np.ndarray): The record of every k-mer.
+    '''
+    n_windows = len(codes) - k + 1
+    if n_windows <= 0:
+        return np.empty(0, dtype=np.uint32), np.empty(0, dtype=owner.dtype)
+    invalid = np.concatenate([[0], np.cumsum(~valid)])
+    keep = (invalid[k:] == invalid[:-k]) & (owner[:n_windows] == owner[k - 1:])
+    kmers = np.zeros(n_windows, dtype=np.uint32)
+    for j in range(k):
+        kmers = (kmers << 2) | codes[j:j + n_windows]
+    return kmers[keep], owner[:n_windows][keep]
+
+
+def _record_kmers(db, start, end, k):
+    # Unique (k-mer, record) pairs of the records start:end, sorted by k-mer then record
+    lengths = np.asarray(db.record_length[start:end]).astype(np.int64)
+    byte_lengths = (lengths + 3) // 4
+    byte_start = int(db.record_offset[start])
+    packed = np.asarray(db.packed[byte_start:byte_start + int(byte_lengths.sum())])
+    codes = ((packed[:, None] >> SHIFTS) & 3).astype(np.uint32).ravel()
+    owner = np.repeat(np.arange(end - start, dtype=np.int64), 4 * byte_lengths)
+    padded_starts = 4 * (np.cumsum(byte_lengths) - byte_lengths)
+    valid = np.arange(len(codes)) - padded_starts[owner] < lengths[owner]
+    first, last = np.searchsorted(db.exception_record, [start, end])
+    valid[padded_starts[np.asarray(db.exception_record[first:last]) - start]
+          + np.asarray(db.exception_position[first:last])] = False
+    kmers, records = _window_kmers(codes, valid, owner, k)
+    keys = np.unique(kmers.astype(np.int64) * (end - start) + records)
+    return keys // (end - start), (keys % (end - start) + start).astype(np.int32)
+
+
+def index_dir(db_dir, k=KMER_LENGTH):
+    return os.path.join(db_dir, INDEX_DIR.format(k=k))
+
+
+def build_kmer_index(db_dir, k=KMER_LENGTH, force=False):
+    '''
+    Build the inverted k-mer index of a reference database (skipped while an index of the
+    current database content exists).
+
+    The records are read in chunks twice: the first pass counts the records of every k-mer,
+    the second fills the postings (record ids, ascending per k-mer) into a memory-mapped array.
+
+    Parameters:
+    - db_dir (str): Reference database directory.
+    - k (int, optional): k-mer length. Default is 8.
+    - force (bool, optional): Rebuild an up to date index.
+
+    Returns:
+    - str: 'up to date' or 'built'.
+    '''
+    db = ReferenceDatabase(db_dir)
+    directory = index_dir(db_dir, k)
+    manifest = {'format_version': INDEX_VERSION, 'k': k, 'n_records': len(db),
+                'content_sha256': db.manifest['content_sha256']}
+    manifest_path = os.path.join(directory, INDEX_MANIFEST)
+    if not force and os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as infile:
+            if json.load(infile) == manifest:
+                return 'up to date'
+
+    chunks = [(start, min(start + BUILD_CHUNK, len(db))) for start in range(0, len(db), BUILD_CHUNK)]
+    counts = np.zeros(4 ** k, dtype=np.int64)
+    for start, end in chunks:
+        counts += np.bincount(_record_kmers(db, start, end, k)[0], minlength=4 ** k)
+    offsets = np.zeros(4 ** k + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+
+    build_dir = directory + '.building'
+    shutil.rmtree(build_dir, ignore_errors=True)
+    os.makedirs(build_dir)
+    np.save(os.path.join(build_dir, 'offsets.npy'), offsets)
+    postings = np.lib.format.open_memmap(os.path.join(build_dir, 'postings.npy'), mode='w+',
+                                         dtype=np.int32, shape=(int(offsets[-1]),))
+    filled = offsets[:-1].copy()
+    for start, end in chunks:
+        kmers, records = _record_kmers(db, start, end, k)
+        chunk_counts = np.bincount(kmers, minlength=4 ** k)
+        chunk_starts = np.cumsum(chunk_counts) - chunk_counts
+        postings[filled[kmers] + np.arange(len(kmers)) - chunk_starts[kmers]] = records
+        filled += chunk_counts
+    postings.flush()
+    del postings
+    with open(os.path.join(build_dir, INDEX_MANIFEST), 'w') as outfile:
+        json.dump(manifest, outfile, indent=1)
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(build_dir, directory)
+    return 'built'
+
+
+class KmerClassifier:
+    '''
+    SINTAX-style classifier on a reference database with a built k-mer index.
+
+    Usage:
+        classifier = KmerClassifier(db_dir)
+        taxa, confidence, hits = classifier.classify('ACGT...', np.random.default_rng(0))
+    '''
+
+    def __init__(self, db_dir, k=KMER_LENGTH):
+        self.db = ReferenceDatabase(db_dir)
+        self.k = k
+        directory = index_dir(db_dir, k)
+        with open(os.path.join(directory, INDEX_MANIFEST), 'r') as infile:
+            manifest = json.load(infile)
+        if manifest.get('format_version') != INDEX_VERSION or \
+                manifest.get('content_sha256') != self.db.manifest['content_sha256']:
+            raise ValueError(f'{directory} does not match the database, run build_kmer_index.')
+        self.offsets = np.load(os.path.join(directory, 'offsets.npy'))
+        self.postings = np.load(os.path.join(directory, 'postings.npy'), mmap_mode='r')
+        self.taxonomy = self.db.taxonomy
+        # Per record, the taxon at every rank (-1 where the rank is missing)
+        self.lineages = self.taxonomy.lineages[np.asarray(self.db.record_taxon)]
+
+    def query_kmers(self, sequence):
+        '''
+        The distinct k-mers of a query sequence (str or bytes).
+        '''
+        if isinstance(sequence, str):
+            sequence = sequence.encode()
+        codes = QUERY_ENCODE[np.frombuffer(sequence, dtype=np.uint8)]
+        kmers, _ = _window_kmers(codes.astype(np.uint32), codes != 255,
+                                 np.zeros(len(codes), dtype=np.int8), self.k)
+        return np.unique(kmers)
+
+    def bootstrap_hits(self, sequence, rng, n_bootstraps=N_BOOTSTRAPS, subsample_size=SUBSAMPLE_SIZE):
+        '''
+        The top hit (record in database order, -1 without shared k-mers) of every bootstrap
+        iteration; ties go to the first record.
+        '''
+        hits = np.full(n_bootstraps, -1, dtype=np.int64)
+        kmers = self.query_kmers(sequence)
+        if not len(kmers):
+            return hits
+        starts, ends = self.offsets[kmers], self.offsets[kmers + 1]
+        for iteration, picks in enumerate(rng.integers(0, len(kmers), size=(n_bootstraps, subsample_size))):
+            records = np.concatenate([self.postings[starts[pick]:ends[pick]] for pick in picks])
+            if len(records):
+                hits[iteration] = np.bincount(records).argmax()
+        return hits
+
+    def consensus(self, hits):
+        '''
+        The assigned taxon and its bootstrap confidence at every rank: the most frequent
+        taxon among the top hits that agree with the taxa assigned at the ranks above.
+
+        Returns:
+        - taxa (np.ndarray): Taxon id per rank of RANKS (-1 below the deepest assigned rank).
+        - confidence (np.ndarray): Fraction of the bootstrap iterations supporting the taxon.
+        '''
+        taxa = np.full(len(RANKS), -1, dtype=np.int64)
+        confidence = np.zeros(len(RANKS))
+        lineages = self.lineages[hits[hits >= 0]]
+        for rank in range(len(RANKS)):
+            values = lineages[:, rank]
+            values = values[values >= 0]
+            if not len(values):
+                break
+            found, counts = np.unique(values, return_counts=True)
+            taxa[rank] = found[counts.argmax()]
+            confidence[rank] = counts.max() / len(hits)
+            lineages = lineages[lineages[:, rank] == taxa[rank]]
+        return taxa, confidence
+
+    def classify(self, sequence, rng, n_bootstraps=N_BOOTSTRAPS, subsample_size=SUBSAMPLE_SIZE):
+        '''
+        Classify one sequence.
+
+        Returns:
+        - taxa, confidence (np.ndarray): See consensus.
+        - hits (np.ndarray): The top hit of every bootstrap iteration.
+        '''
+        hits = self.bootstrap_hits(sequence, rng, n_bootstraps, subsample_size)
+        return (*self.consensus(hits), hits)
+
+    def support(self, hits, taxon_id):
+        '''
+        Fraction of the bootstrap iterations whose top hit lies in a taxon (or below it).
+        '''
+        start, end = self.db.taxon_start[taxon_id], self.db.taxon_end[taxon_id]
+        return float(np.mean((hits >= start) & (hits < end))) if len(hits) else 0.0
+
+    def taxonomy_string(self, taxa, confidence=None, cutoff=None):
+        '''
+        SINTAX taxonomy of assigned taxa ('k:Eukaryota(1.00),d:TSAR(0.97),...'); with a cutoff
+        only the ranks down to the last one reaching it, without confidences.
+        '''
+        fields = []
+        for rank, taxon in enumerate(taxa):
+            if taxon < 0 or (cutoff is not None and confidence[rank] < cutoff):
+                break
+            field = f'{RANK_PREFIXES[rank]}:{self.taxonomy.names[self.taxonomy.name_id[taxon]]}'
+            fields.append(field if cutoff is not None or confidence is None
+                          else f'{field}({confidence[rank]:.2f})')
+        return ','.join(fields)
+
+
+# Worker processes load the classifier once
+_worker_classifier = None
+
+
+def _init_worker(db_dir, k):
+    global _worker_classifier
+    _worker_classifier = KmerClassifier(db_dir, k)
+
+
+def _classify_chunk(args):
+    # Every query has its own random stream (seed, query index), so the results do not
+    # depend on the chunking or the number of processes.
+    queries, seed, n_bootstraps, subsample_size = args
+    results = []
+    for index, sequence in queries:
+        rng = np.random.default_rng([seed, index])
+        results.append(_worker_classifier.classify(sequence, rng, n_bootstraps, subsample_size))
+    return results
+
+
+def classify_sequences(sequences, db_dir, k=KMER_LENGTH, n_bootstraps=N_BOOTSTRAPS,
+                       subsample_size=SUBSAMPLE_SIZE, seed=0, processes=None, indices=None):
+    '''
+    Classify sequences in parallel (the k-mer index is built first if needed).
+
+    Parameters:
+    - sequences (list): Query sequences.
+    - db_dir (str): Reference database directory.
+    - k (int, optional): k-mer length. Default is 8.
+    - n_bootstraps (int, optional): Bootstrap iterations. Default is 100.
+    - subsample_size (int, optional): k-mers drawn per iteration. Default is 32.
+    - seed (int, optional): Seed of the bootstrap subsampling. Default is 0.
+    - processes (int, optional): Number of worker processes. Default is os.cpu_count().
+    - indices (list, optional): Index of every sequence in its random stream (seed, index).
+      Default is the position in sequences.
+
+    Returns:
+    - list: (taxa, confidence, hits) of every sequence, see KmerClassifier.classify.
+    '''
+    build_kmer_index(db_dir, k)
+    indexed = list(zip(range(len(sequences)) if indices is None else indices, sequences))
+    chunks = [(indexed[i:i + QUERY_CHUNK], seed, n_bootstraps, subsample_size)
+              for i in range(0, len(indexed), QUERY_CHUNK)]
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker,
+                             initargs=(db_dir, k)) as executor:
+        return [result for chunk in executor.map(_classify_chunk, chunks) for result in chunk]
+
+
+def prefilter_fasta_files(fasta_files, db_dir, candidates_fastas, table_files=None, taxon=CANDIDATE_TAXON,
+                          rank=CANDIDATE_RANK, min_support=CANDIDATE_SUPPORT, cutoff=CONFIDENCE_CUTOFF,
+                          seed=0, processes=None, **kwargs):
+    '''
+    Classify the records of the FASTA files of several samples and write the candidates of a
+    taxon per sample. All records are classified in one classify_sequences call (one worker
+    pool), with the same random streams as one prefilter_fasta call per sample.
+
+    Parameters:
+    - fasta_files (dict): Sample -> query FASTA file (e.g. the chimera filtered OTUs).
+    - db_dir (str): Reference database directory.
+    - candidates_fastas (dict): Sample -> output FASTA file with the candidate records.
+    - table_files (dict, optional): Sample -> output table in the vsearch --sintax --tabbedout
+      layout (query, taxonomy with confidences, strand, taxonomy down to the cutoff).
+    - taxon, rank (str, optional): Candidate taxon. Default is Vampyrellida (Order).
+    - min_support (float, optional): Fraction of the top hits that must lie in the taxon.
+    - cutoff (float, optional): Confidence cutoff of the table. Default is 0.8.
+    - seed (int, optional): Seed of the bootstrap subsampling.
+    - processes (int, optional): Number of worker processes.
+    - kwargs: k, n_bootstraps, subsample_size of classify_sequences.
+
+    Returns:
+    - dict: Sample -> number of candidates.
+
+    Raises:
+    - ValueError: If the taxon is not in the database.
+    '''
+    classifier = KmerClassifier(db_dir, kwargs.get('k', KMER_LENGTH))
+    taxon_ids = classifier.taxonomy.find(taxon, rank)
+    if not len(taxon_ids):
+        raise ValueError(f'{taxon} ({rank}) is not in the database {db_dir}.')
+
+    records = {sample: list(iter_fasta(fasta_file)) for sample, fasta_file in fasta_files.items()}
+    # Per sample query indices: the same random streams as one call per sample
+    sequences = [sequence for sample_records in records.values() for _, sequence in sample_records]
+    indices = [index for sample_records in records.values() for index in range(len(sample_records))]
+    results = classify_sequences(sequences, db_dir, seed=seed, processes=processes, indices=indices, **kwargs)
+
+    n_candidates = {}
+    start = 0
+    for sample, sample_records in records.items():
+        sample_results = results[start:start + len(sample_records)]
+        start += len(sample_records)
+        if table_files:
+            table_file = table_files[sample]
+            os.makedirs(os.path.dirname(table_file) or '.', exist_ok=True)
+            with open(table_file, 'w') as outfile:
+                for (header, _), (taxa, confidence, _) in zip(sample_records, sample_results):
+                    # Labels end at the first space, as vsearch writes them
+                    outfile.write(f'{header.split(maxsplit=1)[0]}\t{classifier.taxonomy_string(taxa, confidence)}\t+\t'
+                                  f'{classifier.taxonomy_string(taxa, confidence, cutoff)}\n')
+        candidates = [record for record, (_, _, hits) in zip(sample_records, sample_results)
+                      if sum(classifier.support(hits, taxon_id) for taxon_id in taxon_ids) >= min_support]
+        os.makedirs(os.path.dirname(candidates_fastas[sample]) or '.', exist_ok=True)
+        n_candidates[sample] = write_fasta(candidates, candidates_fastas[sample])
+    return n_candidates
+
+
+def prefilter_fasta(fasta_file, db_dir, candidates_fasta, table_file=None, **kwargs):
+    '''
+    Classify the records of one FASTA file and write the candidates of a taxon (see
+    prefilter_fasta_files for the parameters).
+
+    Returns:
+    - int: The number of candidates.
+    '''
+    return prefilter_fasta_files({None: fasta_file}, db_dir, {None: candidates_fasta},
+                                 {None: table_file} if table_file else None, **kwargs)[None]
+
+
+def main():
+    import argparse
+    from pipeline import (Layout, CHIMERA_FILTERED, KMER_CANDIDATES, KMER_TABLE, REFERENCE_DB,
+                          discover_samples)
+
+    parser = argparse.ArgumentParser(description='k-mer classification of the OTUs and '
+                                                 'Vampyrellida candidate prefilter.')
+    parser.add_argument('--project', default='Suthaus_2022')
+    parser.add_argument('--marker', default='Full18S')
+    parser.add_argument('--denoise-method', default='RAD')
+    parser.add_argument('--sim', default='sim_90')
+    parser.add_argument('--samples', nargs='*', help='default: all chimera filtered samples')
+    parser.add_argument('--min-support', type=float, default=CANDIDATE_SUPPORT,
+                        help='fraction of bootstrap top hits in Vampyrellida')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--processes', type=int)
+    args = parser.parse_args()
+
+    layout = Layout(args.project, args.marker, args.denoise_method, args.sim)
+    db_dir = layout.path(REFERENCE_DB)
+    print(f'k-mer index {build_kmer_index(db_dir)}')
+    samples = args.samples or discover_samples(os.path.dirname(layout.path(CHIMERA_FILTERED, sample='')))
+    paths = {template: {sample: layout.path(template, sample=sample) for sample in samples}
+             for template in (CHIMERA_FILTERED, KMER_CANDIDATES, KMER_TABLE)}
+    n_candidates = prefilter_fasta_files(paths[CHIMERA_FILTERED], db_dir, paths[KMER_CANDIDATES], paths[KMER_TABLE],
+                                         min_support=args.min_support, seed=args.seed, processes=args.processes)
+    for sample, count in n_candidates.items():
+        print(f'{sample}: {count} Vampyrellida candidates')
+
+
+if __name__ == '__main__':
+    main()
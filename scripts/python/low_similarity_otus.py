@@ -2,6 +2,12 @@ import pandas as pd
 import re
 from Bio import Entrez
 import time
+import os
+import sqlite3
+
+# Constants
+TAXONOMY_CACHE = os.path.join('..', 'raw_data', 'genbank_taxonomy_cache.sqlite')
+ENTREZ_BATCH_SIZE = 200  # accessions per efetch request
 
 
 def extract_data_from_filename(blast_table, pattern):
@@ -86,17 +92,164 @@ def process_hit_accession(x):
     return get_taxonomy_from_genbank(x)
 
 
-def add_taxopath_column(df):
+def entrez_fetch_taxonomies(accessions):
+    '''
+    Fetch the taxonomy lineages of a batch of GenBank accessions with one Entrez request.
+
+    Parameters:
+    - accessions (list): GenBank accession IDs (with or without version).
+
+    Returns:
+    - dict: Accession -> taxonomy lineage for every accession found in the response.
+
+    Notes:
+    - Requires Entrez.email to be set, see get_taxonomy_from_genbank.
+    '''
+    handle = Entrez.efetch(db='nucleotide',
+                           id=','.join(accessions),
+                           rettype='gb',
+                           retmode='xml')
+    records = Entrez.read(handle)
+    handle.close()
+    time.sleep(0.5)
+
+    # Match the records back to the requested IDs with and without version suffix
+    taxonomies = {}
+    for record in records:
+        accession_version = record.get('GBSeq_accession-version', '')
+        for key in (record.get('GBSeq_primary-accession'), accession_version,
+                    accession_version.split('.')[0]):
+            if key:
+                taxonomies[key] = record['GBSeq_taxonomy']
+    return {accession: taxonomies[accession] for accession in accessions
+            if accession in taxonomies}
+
+
+class TaxonomyCache:
+    '''
+    Persistent accession -> taxonomy lineage cache stored in an SQLite database.
+    '''
+
+    def __init__(self, cache_path=TAXONOMY_CACHE):
+        if cache_path != ':memory:' and os.path.dirname(cache_path):
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        self.connection = sqlite3.connect(cache_path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS taxonomy '
+                                '(accession TEXT PRIMARY KEY, taxonomy TEXT NOT NULL)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def get_many(self, accessions):
+        '''
+        Return the cached lineages (accession -> taxonomy) of the given accessions.
+        '''
+        accessions = list(accessions)
+        cached = {}
+        for i in range(0, len(accessions), 500):  # SQLite limits the number of query parameters
+            batch = accessions[i:i + 500]
+            placeholders = ','.join('?' * len(batch))
+            cached.update(self.connection.execute(
+                f'SELECT accession, taxonomy FROM taxonomy WHERE accession IN ({placeholders})',
+                batch))
+        return cached
+
+    def put_many(self, taxonomies):
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO taxonomy VALUES (?, ?)',
+                                        taxonomies.items())
+
+
+def fetch_in_halves(batch, fetcher):
+    '''
+    Fetch the lineages of a batch of accessions, splitting a failed request into halves
+    (down to single accessions), so one bad accession does not discard the whole batch.
+
+    Returns:
+    - dict: Accession -> lineage of the fetched accessions.
+    '''
+    fetched = {}
+    pending = [batch]
+    while pending:
+        part = pending.pop()
+        try:
+            fetched.update(fetcher(part))
+        except Exception as e:
+            if len(part) == 1:
+                print(f'Failed to fetch taxonomy for {part[0]}. Error: {e}')
+                continue
+            print(f'Failed to fetch taxonomy for {len(part)} accessions '
+                  f'({part[0]} ... {part[-1]}), retrying in halves. Error: {e}')
+            middle = len(part) // 2
+            pending.extend([part[middle:], part[:middle]])
+    return fetched
+
+
+def lookup_taxonomies(accessions,
+                      cache_path=TAXONOMY_CACHE,
+                      fetcher=entrez_fetch_taxonomies,
+                      batch_size=ENTREZ_BATCH_SIZE):
+    '''
+    Look up the taxonomy lineages of GenBank accessions through a persistent cache.
+
+    The accessions are deduplicated, cached lineages are reused, and the remaining ones are
+    fetched in batches of batch_size accessions per request and added to the cache. A failed
+    request is retried in halves (see fetch_in_halves) and the accessions still missing
+    afterwards are reported.
+
+    Parameters:
+    - accessions (iterable): GenBank accession IDs (may contain duplicates and missing values).
+    - cache_path (str, optional): Path to the SQLite cache (':memory:' for no persistence).
+    - fetcher (callable, optional): Function taking a list of accessions and returning a dict
+      accession -> lineage. Defaults to entrez_fetch_taxonomies; replace it to work offline.
+    - batch_size (int, optional): Number of accessions per fetcher call.
+
+    Returns:
+    - dict: Accession -> taxonomy lineage. Accessions that could not be fetched are missing.
+    '''
+    unique_accessions = list(dict.fromkeys(a for a in accessions if isinstance(a, str) and a))
+
+    with TaxonomyCache(cache_path) as cache:
+        taxonomies = cache.get_many(unique_accessions)
+        missing = [accession for accession in unique_accessions if accession not in taxonomies]
+        print(f'{len(taxonomies)} accessions found in the cache, fetching {len(missing)}.')
+
+        for i in range(0, len(missing), batch_size):
+            fetched = fetch_in_halves(missing[i:i + batch_size], fetcher)
+            cache.put_many(fetched)
+            taxonomies.update(fetched)
+
+    not_fetched = [accession for accession in missing if accession not in taxonomies]
+    if not_fetched:
+        print(f'No taxonomy for {len(not_fetched)} accessions: {", ".join(not_fetched)}')
+    return taxonomies
+
+
+def add_taxopath_column(df, cache_path=TAXONOMY_CACHE, fetcher=entrez_fetch_taxonomies):
     '''
     Add a 'Taxopath' column to a dataframe based on the 'Hit_accession' column.
 
+    The lineages are looked up once per unique accession, in batches, through the
+    persistent cache (see lookup_taxonomies).
+
     Parameters:
     - df (pandas.DataFrame): A dataframe with a 'Hit_accession' column
                              containing GenBank accession IDs.
+    - cache_path (str, optional): Path to the SQLite taxonomy cache.
+    - fetcher (callable, optional): Batch fetcher, see lookup_taxonomies.
 
     Returns:
     - pandas.DataFrame: The input dataframe augmented with a 'Taxopath' column
-                        containing taxonomy lineage for each accession ID.
+                        containing taxonomy lineage for each accession ID
+                        (None if the lineage could not be fetched).
     '''
-    df['Taxopath'] = df['Hit_accession'].apply(process_hit_accession)
+    taxonomies = lookup_taxonomies(df['Hit_accession'], cache_path=cache_path, fetcher=fetcher)
+    df['Taxopath'] = df['Hit_accession'].map(taxonomies).astype(object)
+    df['Taxopath'] = df['Taxopath'].where(df['Taxopath'].notna(), None)
     return df
@@ -0,0 +1,178 @@
+# Functions for the mol_signatures Jupyter notebook:
+# ../../notebooks/mol_signatures.ipynb
+#
+# Finds diagnostic (molecular signature) positions of clades in an alignment. The
+# alignment is encoded as an AlignmentMatrix and the character states of all clades
+# are compared with the rest of the alignment in one vectorized pass:
+# - binary position: all clade members share one character state, and the set of
+#   states outside the clade differs from it.
+# - asymmetric position: clade members have more than one state, but none of these
+#   states occurs outside the clade.
+
+# Imports
+import numpy as np
+import pandas as pd
+
+from alignment_matrix import AlignmentMatrix
+
+
+def read_taxon_file(taxon_file):
+    '''
+    Read a taxon file (sequence ID <tab> taxopath with ';' separated taxa).
+
+    Returns:
+    - dict: Sequence ID -> list of taxa (e.g. ['Vampyrellida', 'Leptophryidae', ...]).
+    '''
+    taxopaths = {}
+    with open(taxon_file, 'r') as infile:
+        for line in infile:
+            if not line.strip():
+                continue
+            seq_id, taxopath = line.rstrip('\n').split('\t')[:2]
+            taxopaths[seq_id] = [taxon for taxon in taxopath.strip().split(';') if taxon]
+    return taxopaths
+
+
+def clades_from_taxon_file(taxon_file, clades=None, rank=None):
+    '''
+    Group the sequence IDs of a taxon file into clades.
+
+    Parameters:
+    - taxon_file (str): Path to the taxon file.
+    - clades (list, optional): Only return these clades (e.g. ['Sericomyxidae', 'Leptophryidae']).
+    - rank (int, optional): Only use the taxa at this position of the taxopath
+      (e.g. 1 for families in 'Vampyrellida;Family;Genus'). Default is all positions.
+
+    Returns:
+    - dict: Clade name -> set of sequence IDs belonging to the clade.
+    '''
+    groups = {}
+    for seq_id, taxa in read_taxon_file(taxon_file).items():
+        if rank is not None:
+            taxa = taxa[rank:rank + 1]
+        for taxon in taxa:
+            if clades is None or taxon in clades:
+                groups.setdefault(taxon, set()).add(seq_id)
+    return groups
+
+
+def clades_from_patterns(seq_ids, patterns):
+    '''
+    Group sequence IDs into clades by case-insensitive substrings of the sequence names
+    (e.g. {'Sericomyxidae': 'Serico'}).
+
+    Parameters:
+    - seq_ids (list): Sequence IDs of the alignment.
+    - patterns (dict or list): Clade name -> pattern, or a list of patterns used as clade names.
+
+    Returns:
+    - dict: Clade name -> set of sequence IDs.
+    '''
+    if not isinstance(patterns, dict):
+        patterns = {pattern: pattern for pattern in patterns}
+    return {clade: {seq_id for seq_id in seq_ids if pattern.lower() in seq_id.lower()}
+            for clade, pattern in patterns.items()}
+
+
+def _row_index(alignment):
+    # Sequences can be addressed by their full header or by its first word (as in Bio.SeqIO)
+    row_index = {}
+    for i, header in enumerate(alignment.ids):
+        row_index[header] = i
+        row_index.setdefault(header.split(maxsplit=1)[0] if header.strip() else header, i)
+    return row_index
+
+
+def signature_masks(alignment, clades):
+    '''
+    Compute the binary and asymmetric signature positions of all clades at once.
+
+    Parameters:
+    - alignment (AlignmentMatrix): The encoded alignment.
+    - clades (dict): Clade name -> iterable of sequence IDs (IDs not in the alignment are ignored).
+
+    Returns:
+    - clade_names (list): The clade names in row order.
+    - binary (np.ndarray): (n_clades x n_cols) boolean array of binary positions.
+    - asymmetric (np.ndarray): (n_clades x n_cols) boolean array of asymmetric positions.
+    '''
+    clade_names = list(clades)
+    row_index = _row_index(alignment)
+
+    # Clade membership matrix (n_clades x n_seqs)
+    membership = np.zeros((len(clade_names), alignment.n_seqs), dtype=np.int32)
+    for i, clade in enumerate(clade_names):
+        rows = [row_index[seq_id] for seq_id in clades[clade] if seq_id in row_index]
+        membership[i, rows] = 1
+
+    # One-hot encoding of the character states, gaps included (n_seqs x n_symbols*n_cols)
+    symbols = alignment.symbols(include_gaps=True)
+    one_hot = (alignment.matrix[:, None, :] == symbols[None, :, None]).astype(np.int32)
+    one_hot = one_hot.reshape(alignment.n_seqs, -1)
+
+    # Number of clade members and of all sequences with each state in each column
+    in_counts = (membership @ one_hot).reshape(len(clade_names), len(symbols), alignment.n_cols)
+    total_counts = one_hot.sum(axis=0).reshape(1, len(symbols), alignment.n_cols)
+    present_in = in_counts > 0
+    present_out = (total_counts - in_counts) > 0
+
+    num_states_in = present_in.sum(axis=1)
+    binary = (num_states_in == 1) & (present_in != present_out).any(axis=1)
+    asymmetric = (num_states_in > 1) & ~(present_in & present_out).any(axis=1)
+    return clade_names, binary, asymmetric
+
+
+def find_signatures(alignment, clades):
+    '''
+    Find the molecular signature positions of all clades.
+
+    Parameters:
+    - alignment (str or AlignmentMatrix): Path to an aligned FASTA file or a loaded alignment.
+    - clades (dict): Clade name -> iterable of sequence IDs.
+
+    Returns:
+    - dict: Clade name -> (binary_positions, asymmetric_positions), lists of 0-based column indices.
+    '''
+    if not isinstance(alignment, AlignmentMatrix):
+        alignment = AlignmentMatrix.from_fasta(alignment)
+    clade_names, binary, asymmetric = signature_masks(alignment, clades)
+    return {clade: (np.flatnonzero(binary[i]).tolist(), np.flatnonzero(asymmetric[i]).tolist())
+            for i, clade in enumerate(clade_names)}
+
+
+def signatures_table(alignment, clades):
+    '''
+    Return the signature positions of all clades as a long table.
+
+    Returns:
+    - pd.DataFrame: Columns clade, position (0-based), signature ('binary' or 'asymmetric'),
+      clade_states and other_states (the character states inside and outside the clade).
+    '''
+    if not isinstance(alignment, AlignmentMatrix):
+        alignment = AlignmentMatrix.from_fasta(alignment)
+    row_index = _row_index(alignment)
+    clade_names, binary, asymmetric = signature_masks(alignment, clades)
+
+    rows = []
+    for i, clade in enumerate(clade_names):
+        in_clade = np.zeros(alignment.n_seqs, dtype=bool)
+        in_clade[[row_index[seq_id] for seq_id in clades[clade] if seq_id in row_index]] = True
+        for signature, mask in (('binary', binary[i]), ('asymmetric', asymmetric[i])):
+            for position in np.flatnonzero(mask):
+                column = alignment.matrix[:, position]
+                rows.append((clade, int(position), signature,
+                             ''.join(sorted(map(chr, set(column[in_clade])))),
+                             ''.join(sorted(map(chr, set(column[~in_clade]))))))
+
+    return pd.DataFrame(rows, columns=['clade', 'position', 'signature', 'clade_states', 'other_states'])
+
+
+def find_molecular_characters(alignment_file, reference_names):
+    '''
+    Find the binary and asymmetric positions of a single clade (reference_names).
+    Kept for the notebook; uses the vectorized search of find_signatures.
+    '''
+    reference_names = {name.lstrip('>').split()[0] for name in reference_names}
+    binary_positions, asymmetric_positions = find_signatures(alignment_file,
+                                                             {'reference': reference_names})['reference']
+    return binary_positions, asymmetric_positions
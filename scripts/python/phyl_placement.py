@@ -0,0 +1,460 @@
+# Phylogenetic placement of environmental OTUs (papara, epa-ng, raxml-ng, gappa)
+#
+# Python version of the per-sample steps in ../bash/phyl_placement_01_phylo_placement_eukaryotes.sh,
+# used by the pipeline runner (pipeline.py). The taxonomic assignment of the placements
+# (../bash/phyl_placement_02_taxassign.sh) is done by placement_assignment.py.
+# Every placement runs in its own scratch directory, so samples can be placed in parallel
+# (place_samples) and the results keep the epa_result_<SAMPLE>.jplace / log file layout.
+# The evaluated reference model (raxml-ng --evaluate) is cached by the hash of the reference
+# alignment, tree and model, so it is computed once instead of once per sample.
+# In pooled mode (place_samples_pooled) the distinct queries of all samples are placed in a
+# single run and the jplace file is split back per sample.
+#
+# Usage (from scripts/python, as phyl_placement_01_phylo_placement_eukaryotes.sh):
+#   python phyl_placement.py --project Suthaus_2022 --marker Full18S --denoise-method RAD --sim sim_90
+
+# Imports
+import fcntl
+import functools
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from fasta_io import iter_fasta, write_fasta
+
+# Constants
+PLACEMENT_MODEL = 'GTR+G'
+MODEL_CACHE_DIR = os.path.join('..', '..', 'raw_data', 'phyl_placement', 'reference_models')
+POOLED_SAMPLE = 'pooled'
+SAMPLE_TAG_SEPARATOR = '__'
+
+
+def run_logged(cmd, log_file=None, cwd=None):
+    '''
+    Run a command, appending its stdout and stderr to log_file (if given).
+
+    Raises:
+    - subprocess.CalledProcessError: If the command fails.
+    '''
+    if log_file is None:
+        return subprocess.run(cmd, cwd=cwd, check=True).returncode
+    with open(log_file, 'a') as log_f:
+        return subprocess.run(cmd, cwd=cwd, stdout=log_f, stderr=subprocess.STDOUT,
+                              text=True, check=True).returncode
+
+
+@functools.lru_cache(maxsize=None)
+def _file_sha256(path, size, mtime_ns):
+    # Memoized per (path, size, mtime), so a process hashes each reference file once
+    h = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        for block in iter(lambda: handle.read(8 * 1024 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def reference_model_key(ref_alignment, ref_tree, model=PLACEMENT_MODEL):
+    '''
+    SHA-256 of the reference alignment and tree contents and the model string.
+    '''
+    h = hashlib.sha256()
+    for path in (ref_alignment, ref_tree):
+        stat = os.stat(path)
+        h.update(_file_sha256(os.path.abspath(path), stat.st_size, stat.st_mtime_ns).encode())
+    h.update(model.encode())
+    return h.hexdigest()
+
+
+def evaluate_reference_model(ref_alignment, ref_tree, workdir, model=PLACEMENT_MODEL, threads=1,
+                             cache_dir=MODEL_CACHE_DIR):
+    '''
+    Provide reference.fasta.raxml.bestModel and reference.fasta.raxml.log in workdir
+    (which must contain reference.fasta from epa-ng --split).
+
+    The model is evaluated with raxml-ng --evaluate only if it is not in the cache yet;
+    concurrent jobs wait for the job evaluating the model (file lock) and then reuse it.
+    The cache holds <key>.raxml.bestModel and <key>.raxml.log, see reference_model_key.
+
+    Parameters:
+    - cache_dir (str, optional): Cache directory. None evaluates the model every time.
+
+    Returns:
+    - bool: True if the model was taken from the cache.
+    '''
+    evaluate = ['raxml-ng', '--evaluate', '--msa', 'reference.fasta', '--tree', ref_tree,
+                '--model', model, '--threads', str(threads)]
+    if cache_dir is None:
+        run_logged(evaluate, cwd=workdir)
+        return False
+
+    os.makedirs(cache_dir, exist_ok=True)
+    key = reference_model_key(ref_alignment, ref_tree, model)
+    cached_model = os.path.join(cache_dir, f'{key}.raxml.bestModel')
+    cached_log = os.path.join(cache_dir, f'{key}.raxml.log')
+
+    with open(os.path.join(cache_dir, f'{key}.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        hit = os.path.exists(cached_model)
+        if not hit:
+            run_logged(evaluate, cwd=workdir)
+            for suffix, cached in (('bestModel', cached_model), ('log', cached_log)):
+                shutil.copyfile(os.path.join(workdir, f'reference.fasta.raxml.{suffix}'),
+                                cached + '.tmp')
+                os.replace(cached + '.tmp', cached)
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    if hit:
+        shutil.copyfile(cached_model, os.path.join(workdir, 'reference.fasta.raxml.bestModel'))
+        shutil.copyfile(cached_log, os.path.join(workdir, 'reference.fasta.raxml.log'))
+    return hit
+
+
+def place_sample(sample, query_fasta, ref_alignment, ref_tree, jplace_dir, log_dir,
+                 threads=1, model=PLACEMENT_MODEL, scratch_dir=None, keep_workdir=False,
+                 model_cache_dir=MODEL_CACHE_DIR):
+    '''
+    Align the query sequences of one sample to the reference (papara), split the alignment
+    (epa-ng --split), evaluate the substitution model (raxml-ng --evaluate) and place the
+    queries (epa-ng).
+
+    The tools write fixed file names (papara_alignment.default, reference.fasta, query.fasta,
+    epa_result.jplace, ...), so every call runs them in its own scratch directory and only the
+    results are moved out. Several samples can therefore be placed at the same time.
+
+    Parameters:
+    - sample (str): Sample name used for the output file names.
+    - query_fasta, ref_alignment, ref_tree (str): Input files.
+    - jplace_dir, log_dir (str): Output directories.
+    - threads (int, optional): Threads for papara, raxml-ng and epa-ng. Default is 1.
+    - model (str, optional): Substitution model. Default is 'GTR+G'.
+    - scratch_dir (str, optional): Parent directory of the scratch directory. Default is the
+      system temp directory.
+    - keep_workdir (bool, optional): Keep the scratch directory (it is always kept on failure).
+    - model_cache_dir (str, optional): Reference model cache (see evaluate_reference_model).
+      None evaluates the model for every sample.
+
+    Output:
+    - <jplace_dir>/epa_result_<sample>.jplace
+    - <log_dir>/<sample>_epa_info.log, <sample>_papara_log.default,
+      <sample>_reference.fasta.raxml.bestModel, <sample>_reference.fasta.raxml.log
+
+    Returns:
+    - str: Path to the jplace file.
+    '''
+    os.makedirs(jplace_dir, exist_ok=True)
+    os.makedirs(log_dir, exist_ok=True)
+    query_fasta, ref_alignment, ref_tree = (os.path.abspath(path)
+                                            for path in (query_fasta, ref_alignment, ref_tree))
+    workdir = tempfile.mkdtemp(prefix=f'placement_{sample}_', dir=scratch_dir)
+
+    def run(cmd):
+        return run_logged(cmd, cwd=workdir)
+
+    # Aligning query sequences based on the reference alignment and tree
+    run(['papara', '-t', ref_tree, '-s', ref_alignment, '-q', query_fasta, '-r',
+         '-j', str(threads)])
+    # Splitting alignment
+    run(['epa-ng', '--split', ref_alignment, 'papara_alignment.default'])
+    # Substitution model and its parameters (cached across samples and runs)
+    if evaluate_reference_model(ref_alignment, ref_tree, workdir, model=model, threads=threads,
+                                cache_dir=model_cache_dir):
+        print(f'{sample}: reusing the cached reference model.')
+    # Phylogenetic placement
+    run(['epa-ng', '-t', ref_tree, '-s', 'reference.fasta', '-q', 'query.fasta',
+         '--model', 'reference.fasta.raxml.bestModel', '--threads', str(threads)])
+
+    # Move the log files to the log directory and the jplace file to the result directory
+    for file_name in ('epa_info.log', 'papara_log.default',
+                      'reference.fasta.raxml.bestModel', 'reference.fasta.raxml.log'):
+        shutil.move(os.path.join(workdir, file_name), os.path.join(log_dir, f'{sample}_{file_name}'))
+    jplace_path = os.path.join(jplace_dir, f'epa_result_{sample}.jplace')
+    shutil.move(os.path.join(workdir, 'epa_result.jplace'), jplace_path)
+
+    # Delete rest of the files
+    if not keep_workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return jplace_path
+
+
+def extract_clade(sample, jplace_path, clade_list_file, query_fasta, output_fasta, log_dir,
+                  clade='Vampyrellida', scratch_dir=None):
+    '''
+    Extract the query sequences placed into a clade (gappa prepare extract) and move them to
+    output_fasta (e.g. the vampyrellid OTUs of a sample after the eukaryote placement).
+    gappa runs in its own scratch directory (it writes samples/ and sequences/).
+    '''
+    os.makedirs(os.path.dirname(output_fasta) or '.', exist_ok=True)
+    workdir = tempfile.mkdtemp(prefix=f'extract_{sample}_', dir=scratch_dir)
+    run_logged(['gappa', 'prepare', 'extract',
+                '--jplace-path', os.path.abspath(jplace_path),
+                '--clade-list-file', os.path.abspath(clade_list_file),
+                '--fasta-path', os.path.abspath(query_fasta),
+                '--allow-file-overwriting',
+                '--log-file', os.path.abspath(os.path.join(log_dir, f'{sample}_extract_otus.log'))],
+               cwd=workdir)
+    shutil.move(os.path.join(workdir, 'sequences', f'{clade}.fasta'), output_fasta)
+    shutil.rmtree(workdir, ignore_errors=True)
+    return output_fasta
+
+
+def place_eukaryotes_and_vampyrellids(sample, query_fasta, euk_reference, vamp_reference,
+                                      threads=1, scratch_dir=None, model_cache_dir=MODEL_CACHE_DIR):
+    '''
+    Both placement steps of phyl_placement_01_phylo_placement_eukaryotes.sh for one sample:
+    placement on the eukaryote reference, extraction of the Vampyrellida OTUs and their
+    placement on the vampyrellid reference.
+
+    Parameters:
+    - euk_reference (dict): 'alignment', 'tree', 'clade_list', 'jplace_dir', 'log_dir' and
+      'vamp_fasta_dir' of the eukaryote step.
+    - vamp_reference (dict): 'alignment', 'tree', 'jplace_dir' and 'log_dir' of the vampyrellid step.
+
+    Returns:
+    - tuple: (eukaryote jplace, vampyrellid jplace).
+    '''
+    euk_jplace = place_sample(sample, query_fasta, euk_reference['alignment'], euk_reference['tree'],
+                              euk_reference['jplace_dir'], euk_reference['log_dir'],
+                              threads=threads, scratch_dir=scratch_dir,
+                              model_cache_dir=model_cache_dir)
+    vamp_fasta = extract_clade(sample, euk_jplace, euk_reference['clade_list'], query_fasta,
+                               os.path.join(euk_reference['vamp_fasta_dir'], f'{sample}_otu.fasta'),
+                               euk_reference['log_dir'], scratch_dir=scratch_dir)
+    vamp_jplace = place_sample(sample, vamp_fasta, vamp_reference['alignment'], vamp_reference['tree'],
+                               vamp_reference['jplace_dir'], vamp_reference['log_dir'],
+                               threads=threads, scratch_dir=scratch_dir,
+                               model_cache_dir=model_cache_dir)
+    return euk_jplace, vamp_jplace
+
+
+def place_samples(queries, euk_reference, vamp_reference, processes=None, threads_per_job=None,
+                  scratch_dir=None, model_cache_dir=MODEL_CACHE_DIR):
+    '''
+    Run place_eukaryotes_and_vampyrellids for many samples on a process pool.
+
+    Parameters:
+    - queries (dict): Sample name -> query FASTA (e.g. the chimera filtered OTUs).
+    - processes (int, optional): Number of samples placed at the same time.
+      Default is os.cpu_count() // threads_per_job.
+    - threads_per_job (int, optional): Threads of every job. Default is
+      os.cpu_count() // processes (at least 1).
+
+    Returns:
+    - dict: Sample -> (eukaryote jplace, vampyrellid jplace) for the successful samples.
+      Failed samples are reported and left out.
+    '''
+    cores = os.cpu_count() or 1
+    if threads_per_job is None:
+        threads_per_job = max(cores // (processes or min(len(queries), cores) or 1), 1)
+    if processes is None:
+        processes = max(cores // threads_per_job, 1)
+
+    results = {}
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = {executor.submit(place_eukaryotes_and_vampyrellids, sample, query_fasta,
+                                   euk_reference, vamp_reference, threads_per_job, scratch_dir,
+                                   model_cache_dir): sample
+                   for sample, query_fasta in queries.items()}
+        for future in as_completed(futures):
+            sample = futures[future]
+            try:
+                results[sample] = future.result()
+                print(f'Placement of sample {sample} done.')
+            except Exception as e:
+                print(f'Placement of sample {sample} failed: {e}')
+    return results
+
+
+def pool_queries(queries, output_fasta):
+    '''
+    Merge the query sequences of several samples into one FASTA file.
+
+    Every distinct sequence is written once, tagged with the sample and name of its first
+    occurrence ('<sample>__<name>'), so OTUs shared across samples are placed only once.
+
+    Parameters:
+    - queries (dict): Sample name -> query FASTA.
+    - output_fasta (str): Path to the pooled FASTA file.
+
+    Returns:
+    - dict: Pooled query name -> list of (sample, original name) it stands for.
+    '''
+    pooled_names = {}
+    members = {}
+    records = []
+    for sample, query_fasta in queries.items():
+        for header, sequence in iter_fasta(query_fasta):
+            name = header.split(maxsplit=1)[0] if header.strip() else header
+            pooled_name = pooled_names.get(sequence.upper())
+            if pooled_name is None:
+                pooled_name = f'{sample}{SAMPLE_TAG_SEPARATOR}{name}'
+                pooled_names[sequence.upper()] = pooled_name
+                members[pooled_name] = []
+                records.append((pooled_name, sequence))
+            members[pooled_name].append((sample, name))
+    write_fasta(records, output_fasta)
+    return members
+
+
+def split_jplace(jplace_path, members, samples, jplace_dir):
+    '''
+    Split a pooled jplace file into epa_result_<SAMPLE>.jplace files.
+
+    Every placement of a pooled query is copied to each sample the query stands for (see
+    pool_queries), with its original name; tree, fields, version and metadata are kept.
+
+    Returns:
+    - dict: Sample -> path to its jplace file.
+    '''
+    with open(jplace_path, 'r') as jplace_file:
+        jplace = json.load(jplace_file)
+
+    placements = {sample: [] for sample in samples}
+    for placement in jplace['placements']:
+        # Names with ('nm') or without ('n') multiplicities
+        named = placement['nm'] if 'nm' in placement else [(name, None) for name in placement['n']]
+        for pooled_name, multiplicity in named:
+            for sample, name in members.get(pooled_name, []):
+                if multiplicity is None:
+                    placements[sample].append({'p': placement['p'], 'n': [name]})
+                else:
+                    placements[sample].append({'p': placement['p'], 'nm': [[name, multiplicity]]})
+
+    os.makedirs(jplace_dir, exist_ok=True)
+    jplace_paths = {}
+    for sample in samples:
+        jplace_paths[sample] = os.path.join(jplace_dir, f'epa_result_{sample}.jplace')
+        with open(jplace_paths[sample], 'w') as outfile:
+            json.dump(dict(jplace, placements=placements[sample]), outfile, indent=1)
+    return jplace_paths
+
+
+def place_pooled(queries, ref_alignment, ref_tree, jplace_dir, log_dir, threads=1,
+                 model=PLACEMENT_MODEL, scratch_dir=None, model_cache_dir=MODEL_CACHE_DIR):
+    '''
+    Place the queries of all samples with a single papara + epa-ng run and split the result
+    back into per-sample jplace files.
+
+    Queries are placed independently of each other, so the placements are the same as in
+    per-sample runs, but the reference is loaded only once. The logs of the pooled run are
+    written as <log_dir>/pooled_*.
+
+    Returns:
+    - dict: Sample -> path to epa_result_<SAMPLE>.jplace.
+    '''
+    workdir = tempfile.mkdtemp(prefix='pooled_queries_', dir=scratch_dir)
+    pooled_fasta = os.path.join(workdir, 'pooled_queries.fasta')
+    members = pool_queries(queries, pooled_fasta)
+    print(f'Pooled {sum(map(len, members.values()))} queries of {len(queries)} samples '
+          f'into {len(members)} distinct sequences.')
+    if not members:
+        shutil.rmtree(workdir, ignore_errors=True)
+        return {}
+
+    pooled_jplace = place_sample(POOLED_SAMPLE, pooled_fasta, ref_alignment, ref_tree, workdir,
+                                 log_dir, threads=threads, model=model, scratch_dir=scratch_dir,
+                                 model_cache_dir=model_cache_dir)
+    jplace_paths = split_jplace(pooled_jplace, members, list(queries), jplace_dir)
+    shutil.rmtree(workdir, ignore_errors=True)
+    return jplace_paths
+
+
+def place_samples_pooled(queries, euk_reference, vamp_reference, threads=None, processes=None,
+                         scratch_dir=None, model_cache_dir=MODEL_CACHE_DIR):
+    '''
+    Pooled version of place_samples: one eukaryote placement for all samples, the Vampyrellida
+    extraction per sample (process pool) and one vampyrellid placement for all samples.
+
+    Parameters:
+    - threads (int, optional): Threads of the pooled placements. Default is os.cpu_count().
+    - processes (int, optional): Number of parallel extractions. Default is os.cpu_count().
+
+    Returns:
+    - dict: Sample -> (eukaryote jplace, vampyrellid jplace) for the successful samples.
+    '''
+    threads = threads or os.cpu_count() or 1
+    euk_jplaces = place_pooled(queries, euk_reference['alignment'], euk_reference['tree'],
+                               euk_reference['jplace_dir'], euk_reference['log_dir'],
+                               threads=threads, scratch_dir=scratch_dir,
+                               model_cache_dir=model_cache_dir)
+
+    vamp_queries = {}
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = {executor.submit(extract_clade, sample, euk_jplaces[sample],
+                                   euk_reference['clade_list'], query_fasta,
+                                   os.path.join(euk_reference['vamp_fasta_dir'], f'{sample}_otu.fasta'),
+                                   euk_reference['log_dir'], 'Vampyrellida', scratch_dir): sample
+                   for sample, query_fasta in queries.items() if sample in euk_jplaces}
+        for future in as_completed(futures):
+            sample = futures[future]
+            try:
+                vamp_queries[sample] = future.result()
+            except Exception as e:
+                print(f'Extraction of the vampyrellids of sample {sample} failed: {e}')
+
+    vamp_jplaces = place_pooled(vamp_queries, vamp_reference['alignment'], vamp_reference['tree'],
+                                vamp_reference['jplace_dir'], vamp_reference['log_dir'],
+                                threads=threads, scratch_dir=scratch_dir,
+                                model_cache_dir=model_cache_dir)
+    return {sample: (euk_jplaces[sample], vamp_jplaces[sample]) for sample in vamp_jplaces}
+
+
+def main():
+    import argparse
+    from pipeline import (Layout, discover_samples, CHIMERA_FILTERED, EUK_REFERENCE, VAMP_REFERENCE,
+                          JPLACE_DIR, PLACEMENT_LOGS, VAMP_FASTA)
+
+    parser = argparse.ArgumentParser(description='Phylogenetic placement of the eukaryote and '
+                                                 'vampyrellid OTUs of all samples in parallel.')
+    parser.add_argument('--project', default='Suthaus_2022')
+    parser.add_argument('--marker', default='Full18S')
+    parser.add_argument('--denoise-method', default='RAD')
+    parser.add_argument('--sim', default='sim_90')
+    parser.add_argument('--processes', type=int, help='samples placed at the same time')
+    parser.add_argument('--threads', type=int, help='threads per sample')
+    parser.add_argument('--scratch-dir', help='parent directory of the per-sample scratch directories')
+    parser.add_argument('--model-cache-dir', default=MODEL_CACHE_DIR, help='reference model cache')
+    parser.add_argument('--no-model-cache', action='store_true',
+                        help='evaluate the reference model for every sample')
+    parser.add_argument('--pooled', action='store_true',
+                        help='place the queries of all samples in one run per step')
+    args = parser.parse_args()
+
+    layout = Layout(args.project, args.marker, args.denoise_method, args.sim)
+    query_dir = os.path.dirname(layout.path(CHIMERA_FILTERED, sample=''))
+    queries = {sample: layout.path(CHIMERA_FILTERED, sample=sample)
+               for sample in discover_samples(query_dir)}
+    print(f'Samples used: {" ".join(queries)}')
+
+    euk_reference = {
+        'alignment': layout.path(EUK_REFERENCE + '/reference_alignment.phy'),
+        'tree': layout.path('{raw_data}/phyl_placement/reference_trees/eukaryotes/'
+                            'reference_tree_2022/T2.raxml.bestTree'),
+        'clade_list': layout.path(EUK_REFERENCE + '/taxon_vamp.tsv'),
+        'jplace_dir': layout.path(JPLACE_DIR + '/eukaryotes'),
+        'log_dir': layout.path(PLACEMENT_LOGS + '/eukaryotes'),
+        'vamp_fasta_dir': os.path.dirname(layout.path(VAMP_FASTA, sample=''))
+    }
+    vamp_reference = {
+        'alignment': layout.path(VAMP_REFERENCE + '/reference_alignment.phy'),
+        'tree': layout.path('{raw_data}/phyl_placement/reference_trees/vampyrellida/'
+                            'reference_tree_2023/T2.raxml.bestTree'),
+        'jplace_dir': layout.path(JPLACE_DIR + '/vampyrellida'),
+        'log_dir': layout.path(PLACEMENT_LOGS + '/vampyrellida')
+    }
+    model_cache_dir = None if args.no_model_cache else args.model_cache_dir
+    if args.pooled:
+        place_samples_pooled(queries, euk_reference, vamp_reference, threads=args.threads,
+                             processes=args.processes, scratch_dir=args.scratch_dir,
+                             model_cache_dir=model_cache_dir)
+    else:
+        place_samples(queries, euk_reference, vamp_reference, processes=args.processes,
+                      threads_per_job=args.threads, scratch_dir=args.scratch_dir,
+                      model_cache_dir=model_cache_dir)
+
+
+if __name__ == '__main__':
+    main()
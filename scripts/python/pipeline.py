@@ -0,0 +1,647 @@
+# Incremental runner for the per-sample steps of the ../bash pipeline scripts
+#
+# The steps of tax_assign_03_cluster_otu.sh, tax_assign_04_chimera_filt.sh,
+# tax_assign_05_taxassign.sh and phyl_placement_0*.sh are modelled as a DAG over the
+# PROJECT/MARKER/DENOISE_METHOD/SIM directory layout. For every (step, sample) job a
+# SHA-256 hash of the input file contents, the parameters and the command is recorded in
+# an SQLite state file. A job is skipped while its hash is unchanged and its outputs
+# exist, so adding a sample or changing one parameter only reruns the affected jobs.
+# Independent samples run concurrently within a core budget.
+#
+# Usage (from scripts/python):
+#   python pipeline.py --project Suthaus_2022 --marker Full18S --denoise-method RAD --sim sim_90
+
+# Imports
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import kmer_classifier
+import phyl_placement
+import placement_assignment
+import placement_summary
+import reference_database
+import vamp_extraction
+
+# Constants
+RAW_DATA = os.path.join('..', '..', 'raw_data')
+RESULTS = os.path.join('..', '..', 'results')
+STATE_FILE = 'pipeline_state.sqlite'
+HASH_BLOCK_SIZE = 8 * 1024 * 1024  # 8 MB per read when hashing input files
+
+
+class Layout:
+    '''
+    The PROJECT/MARKER/DENOISE_METHOD/SIM directory layout of one pipeline run.
+
+    Path templates are formatted with the fields raw_data, results, project, marker,
+    denoise_method and sim (plus sample and the step parameters for job paths), e.g.
+    '{raw_data}/clustered/{project}/{marker}/{denoise_method}/{sim}/{sample}_otu.fasta'.
+    '''
+
+    def __init__(self, project, marker, denoise_method, sim, raw_data=RAW_DATA, results=RESULTS):
+        self.fields = {
+            'project': project,
+            'marker': marker,
+            'denoise_method': denoise_method,
+            'sim': sim,
+            'raw_data': raw_data,
+            'results': results
+        }
+
+    def path(self, template, **fields):
+        return os.path.normpath(template.format(**self.fields, **fields))
+
+    @property
+    def state_path(self):
+        '''
+        The state file of this run, e.g. ../../raw_data/pipeline_state/Suthaus_2022/Full18S/RAD/sim_90/...
+        '''
+        return self.path(os.path.join('{raw_data}', 'pipeline_state', '{project}', '{marker}',
+                                      '{denoise_method}', '{sim}', STATE_FILE))
+
+
+class Step:
+    '''
+    One step of the pipeline.
+
+    Parameters:
+    - name (str): Step name (unique within the pipeline).
+    - inputs (dict): Input name -> path template. Per-sample steps use '{sample}' in their
+      templates; for aggregate steps (per_sample=False) a template with '{sample}' is expanded
+      to the list of paths of all samples.
+    - outputs (dict): Output name -> path template ('{sample}' templates of aggregate steps
+      are expanded like the inputs).
+    - command (list, optional): Command line templates, formatted with the layout fields,
+      sample, params, threads and the resolved inputs/outputs (e.g. '{inputs[fasta]}').
+    - function (callable, optional): Called as function(job) instead of a command.
+    - params (dict, optional): Parameters; they are part of the job hash. String parameters
+      may be path templates.
+    - depends_on (list, optional): Names of the steps this step depends on.
+    - threads (int, optional): Number of cores the job uses. Default is 1.
+    - per_sample (bool, optional): One job per sample (True) or one job for all samples.
+    - exclusive (bool, optional): Never run two jobs of this step at the same time (e.g. tools
+      writing fixed file names into the working directory).
+    - log (str, optional): Path template of a log file for the stdout/stderr of the command.
+    '''
+
+    def __init__(self, name, inputs, outputs, command=None, function=None, params=None,
+                 depends_on=(), threads=1, per_sample=True, exclusive=False, log=None):
+        if (command is None) == (function is None):
+            raise ValueError(f'Step {name}: give either a command or a function.')
+        self.name = name
+        self.inputs = inputs
+        self.outputs = outputs
+        self.command = command
+        self.function = function
+        self.params = params or {}
+        self.depends_on = list(depends_on)
+        self.threads = threads
+        self.per_sample = per_sample
+        self.exclusive = exclusive
+        self.log = log
+
+
+class Job:
+    '''
+    A step applied to one sample (or to all samples for aggregate steps), with resolved paths.
+    '''
+
+    def __init__(self, step, layout, sample, samples):
+        self.step = step
+        self.layout = layout
+        self.sample = sample
+        self.threads = step.threads
+        fields = dict(step.params, sample=sample)
+        # String parameters can be path templates as well (e.g. log directories)
+        self.params = {key: layout.path(value, **fields) if isinstance(value, str) and '{' in value
+                       else value for key, value in step.params.items()}
+        self.inputs = {key: self._expand(layout, template, fields, samples) for key, template in step.inputs.items()}
+        self.outputs = {key: self._expand(layout, template, fields, samples) for key, template in step.outputs.items()}
+        self.log = layout.path(step.log, **fields) if step.log else None
+
+    def _expand(self, layout, template, fields, samples):
+        # Aggregate steps get the paths of all samples for a '{sample}' template
+        if self.sample is None and '{sample}' in template:
+            return {s: layout.path(template, **dict(fields, sample=s)) for s in samples}
+        return layout.path(template, **fields)
+
+    @property
+    def key(self):
+        return (self.step.name, self.sample or '')
+
+    def __repr__(self):
+        return f'{self.step.name}[{self.sample}]' if self.sample else self.step.name
+
+    def input_paths(self):
+        return _paths(self.inputs)
+
+    def output_paths(self):
+        return _paths(self.outputs)
+
+    def format_command(self, threads):
+        fields = dict(self.layout.fields, **self.params, sample=self.sample, threads=threads,
+                      inputs=self.inputs, outputs=self.outputs)
+        return [part.format(**fields) for part in self.step.command]
+
+    def digest(self, state):
+        '''
+        SHA-256 over the step definition, the parameters and the content of all inputs.
+        The number of threads is not included, it does not change the results.
+        '''
+        h = hashlib.sha256()
+        definition = {
+            'step': self.step.name,
+            'command': self.step.command,
+            'function': getattr(self.step.function, '__qualname__', None),
+            'params': self.params,
+            'outputs': self.outputs
+        }
+        h.update(json.dumps(definition, sort_keys=True, default=str).encode())
+        for path in sorted(self.input_paths()):
+            h.update(path.encode())
+            h.update(state.file_digest(path).encode())
+        return h.hexdigest()
+
+    def outputs_exist(self):
+        return all(os.path.exists(path) for path in self.output_paths())
+
+
+def _paths(files):
+    # The paths of resolved inputs or outputs (aggregate steps hold dicts of sample -> path)
+    for value in files.values():
+        if isinstance(value, dict):
+            yield from value.values()
+        else:
+            yield value
+
+
+class PipelineState:
+    '''
+    Persistent job hashes and input file digests stored in an SQLite database.
+
+    File digests are cached by (path, size, mtime), so unchanged inputs are hashed only once.
+    '''
+
+    def __init__(self, state_path):
+        if state_path != ':memory:' and os.path.dirname(state_path):
+            os.makedirs(os.path.dirname(state_path), exist_ok=True)
+        self.connection = sqlite3.connect(state_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS jobs '
+                                    '(step TEXT, sample TEXT, digest TEXT NOT NULL, '
+                                    'PRIMARY KEY (step, sample))')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS files '
+                                    '(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, '
+                                    'digest TEXT NOT NULL)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def file_digest(self, path):
+        '''
+        Return the SHA-256 digest of a file ('missing' if it does not exist).
+        '''
+        if not os.path.exists(path):
+            return 'missing'
+        stat = os.stat(path)
+        with self.lock:
+            row = self.connection.execute('SELECT size, mtime_ns, digest FROM files WHERE path = ?',
+                                          (path,)).fetchone()
+        if row and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return row[2]
+
+        h = hashlib.sha256()
+        with open(path, 'rb') as handle:
+            while True:
+                block = handle.read(HASH_BLOCK_SIZE)
+                if not block:
+                    break
+                h.update(block)
+        digest = h.hexdigest()
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                                    (path, stat.st_size, stat.st_mtime_ns, digest))
+        return digest
+
+    def job_digest(self, key):
+        with self.lock:
+            row = self.connection.execute('SELECT digest FROM jobs WHERE step = ? AND sample = ?',
+                                          key).fetchone()
+        return row[0] if row else None
+
+    def set_job_digest(self, key, digest):
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?)', (*key, digest))
+
+
+class CoreBudget:
+    '''
+    Counting semaphore for cores; a job takes as many cores as it uses threads
+    (at most the whole budget).
+    '''
+
+    def __init__(self, cores):
+        self.cores = cores
+        self.free = cores
+        self.condition = threading.Condition()
+
+    def acquire(self, n):
+        n = min(n, self.cores)
+        with self.condition:
+            self.condition.wait_for(lambda: self.free >= n)
+            self.free -= n
+        return n
+
+    def release(self, n):
+        with self.condition:
+            self.free += n
+            self.condition.notify_all()
+
+
+def discover_samples(directory, suffix='.fasta'):
+    '''
+    Sample names from the file names of a directory, as in the bash scripts
+    (e.g. 'NH1_18S_asv.fasta' -> 'NH1_18S').
+    '''
+    return sorted({'_'.join(file_name.split('.')[0].split('_')[:2])
+                   for file_name in os.listdir(directory) if file_name.endswith(suffix)})
+
+
+def build_jobs(steps, layout, samples):
+    '''
+    Create the jobs of all steps and their dependencies.
+
+    Returns:
+    - jobs (dict): Job key -> Job.
+    - dependencies (dict): Job key -> set of job keys it depends on.
+    '''
+    by_name = {step.name: step for step in steps}
+    jobs = {}
+    dependencies = {}
+    for step in steps:
+        for sample in (samples if step.per_sample else [None]):
+            job = Job(step, layout, sample, samples)
+            deps = set()
+            for name in step.depends_on:
+                dep_step = by_name[name]
+                if not dep_step.per_sample:
+                    deps.add((name, ''))
+                elif step.per_sample:
+                    deps.add((name, sample))
+                else:
+                    deps.update((name, s) for s in samples)
+            jobs[job.key] = job
+            dependencies[job.key] = deps
+    return jobs, dependencies
+
+
+def execute_job(job, threads):
+    '''
+    Run the command or function of a job (output directories are created first).
+    '''
+    for path in job.output_paths():
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    job.threads = threads
+    if job.step.function is not None:
+        job.step.function(job)
+        return
+    cmd = job.format_command(threads)
+    if job.log:
+        os.makedirs(os.path.dirname(job.log) or '.', exist_ok=True)
+        phyl_placement.run_logged(cmd, job.log)
+    else:
+        subprocess.run(cmd, check=True)
+
+
+def run_pipeline(steps, layout, samples=None, cores=None, state_path=None, force=(),
+                 dry_run=False):
+    '''
+    Run the pipeline, skipping jobs whose inputs, parameters and command are unchanged.
+
+    Parameters:
+    - steps (list): The Step objects (in any order).
+    - layout (Layout): The directory layout of the run.
+    - samples (list, optional): Sample names. Default is discover_samples on the input
+      directory of the first step.
+    - cores (int, optional): Core budget shared by all running jobs. Default is os.cpu_count().
+    - state_path (str, optional): Path to the SQLite state file. Default is layout.state_path.
+    - force (iterable, optional): Names of steps to rerun regardless of their hash.
+    - dry_run (bool, optional): Only report which jobs would run.
+
+    Returns:
+    - dict: Job -> status ('done', 'skipped', 'would run', 'failed' or 'blocked').
+    '''
+    cores = cores or os.cpu_count()
+    force = set(force)
+    if samples is None:
+        first_input = next(iter(steps[0].inputs.values()))
+        samples = discover_samples(os.path.dirname(layout.path(first_input, sample='')))
+    print(f'Samples used: {" ".join(samples)}')
+
+    jobs, dependencies = build_jobs(steps, layout, samples)
+    status = {}
+    budget = CoreBudget(cores)
+    step_locks = {step.name: threading.Lock() for step in steps if step.exclusive}
+
+    def run(job):
+        digest = job.digest(state)
+        if job.step.name not in force and job.outputs_exist() and state.job_digest(job.key) == digest:
+            return 'skipped'
+        if dry_run:
+            return 'would run'
+        lock = step_locks.get(job.step.name)
+        if lock:
+            lock.acquire()
+        threads = budget.acquire(job.threads)
+        try:
+            print(f'Running {job!r} ({threads} threads)')
+            execute_job(job, threads)
+        finally:
+            budget.release(threads)
+            if lock:
+                lock.release()
+        state.set_job_digest(job.key, digest)
+        return 'done'
+
+    with PipelineState(state_path or layout.state_path) as state, \
+            ThreadPoolExecutor(max_workers=max(cores, 1)) as executor:
+        pending = dict(dependencies)
+        running = {}
+        while pending or running:
+            for key in [key for key, deps in pending.items()
+                        if all(status.get(dep) in ('done', 'skipped', 'would run') for dep in deps)]:
+                running[executor.submit(run, jobs[key])] = key
+                del pending[key]
+            for key in [key for key, deps in pending.items()
+                        if any(status.get(dep) in ('failed', 'blocked') for dep in deps)]:
+                status[key] = 'blocked'
+                del pending[key]
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                key = running.pop(future)
+                try:
+                    status[key] = future.result()
+                except Exception as e:
+                    print(f'{jobs[key]!r} failed: {e}')
+                    status[key] = 'failed'
+
+    summary = {jobs[key]: status.get(key, 'blocked') for key in jobs}
+    counts = {}
+    for value in summary.values():
+        counts[value] = counts.get(value, 0) + 1
+    print('Jobs: ' + ', '.join(f'{count} {value}' for value, count in sorted(counts.items())))
+    return summary
+
+
+# Python steps
+
+def kmer_index(job):
+    kmer_classifier.build_kmer_index(job.params['db_dir'], job.params['k'])
+
+
+def kmer_prefilter(job):
+    # SINTAX-style classification of all samples with one worker pool; only the Vampyrellida
+    # candidates go on to vsearch and placement
+    kmer_classifier.prefilter_fasta_files(job.inputs['fasta'], job.params['db_dir'], job.outputs['fasta'],
+                                          job.outputs['table'], min_support=job.params['min_support'],
+                                          k=job.params['k'], processes=job.threads)
+
+
+def extract_vamp_sequences(job):
+    '''
+    Pull out the OTUs assigned to Vampyrellida (blast6 tables) from the sequences of all
+    samples in one pass per file (replaces grep | awk | seqtk subseq per sample), plus the
+    pooled all_samples.fasta of the create_phyl_tree notebook.
+    '''
+    samples = list(job.inputs['fasta'])
+    vamp_extraction.extract_samples(job.inputs['fasta'], job.inputs['blast6'],
+                                    {sample: job.layout.path(VAMP_SPECIFIC, sample=sample) for sample in samples},
+                                    pooled_file=job.outputs['pooled'], taxon=job.params['taxon'],
+                                    processes=job.threads)
+
+
+def place_eukaryotes(job):
+    phyl_placement.place_sample(job.sample, job.inputs['fasta'], job.inputs['ref_alignment'],
+                                job.inputs['ref_tree'], os.path.dirname(job.outputs['jplace']),
+                                job.params['log_dir'], threads=job.threads,
+                                model=job.params['model'])
+    phyl_placement.extract_clade(job.sample, job.outputs['jplace'], job.inputs['clade_list'],
+                                 job.inputs['fasta'], job.outputs['vamp_fasta'],
+                                 job.params['log_dir'])
+
+
+def place_vampyrellids(job):
+    phyl_placement.place_sample(job.sample, job.inputs['fasta'], job.inputs['ref_alignment'],
+                                job.inputs['ref_tree'], os.path.dirname(job.outputs['jplace']),
+                                job.params['log_dir'], threads=job.threads,
+                                model=job.params['model'])
+
+
+def assign_vampyrellids(job):
+    # In-process assignment (placement_assignment) instead of a gappa examine assign run
+    placement_assignment.assign_jplace_files({job.sample: job.inputs['jplace']}, job.inputs['taxon_file'],
+                                             os.path.dirname(job.outputs['per_query']))
+
+
+def reference_db(job):
+    reference_database.build_and_export(job.inputs['pr2'], job.inputs['vamp'], job.params['db_dir'],
+                                        job.outputs['fasta'])
+
+
+def summary_table(job):
+    # Sample labels as in the notebooks ('NH1_18S' -> 'NH1')
+    per_query_files = {sample.split('_')[0]: path for sample, path in job.inputs['per_query'].items()}
+    placement_summary.write_summary_table(placement_summary.summary_table(per_query_files),
+                                          job.outputs['table'])
+
+
+# Steps of the bash scripts (paths and parameters as in ../bash)
+
+CLUSTERED = '{raw_data}/clustered/{project}/{marker}/{denoise_method}/{sim}/{sample}_otu.fasta'
+CHIMERA_FILTERED = '{raw_data}/chimera_filtered/{project}/{marker}/{denoise_method}/{sim}/{sample}_otu.fasta'
+TAX_ASSIGN_DIR = '{results}/tax_assignment_vsearch/{project}/{marker}/{sim}/{denoise_method}'
+PLACEMENT_LOGS = '{raw_data}/phyl_placement/jplace_log_files/{project}/{marker}/{denoise_method}/{sim}'
+JPLACE_DIR = '{results}/phyl_placement/jplace/{project}/{marker}/{denoise_method}/{sim}'
+VAMP_FASTA = '{results}/phyl_placement/vamp_specific/{project}/{marker}/{denoise_method}/{sim}/{sample}_otu.fasta'
+PER_QUERY_DIR = '{results}/phyl_placement/tax_assignment/{project}/{marker}/{denoise_method}/{sim}/vampyrella'
+EUK_REFERENCE = '{raw_data}/reference_alignments/vamp_phylo_placement/eukaryotes/reference_alignment_2022'
+VAMP_REFERENCE = '{raw_data}/reference_alignments/vamp_phylo_placement/vampyrellida/reference_alignment_2023'
+PR2_SOURCE = '{raw_data}/reference_alignments/pr2_v5/pr2_version_5.0.0_SSU_UTAX.fasta'
+VAMP_CURATION = ('{raw_data}/reference_alignments/vamp/'
+                 '2023_VAMPYRELLIDA_SSU_annotated_PR2_AM_AS_not_aligned_version.fasta')
+REFERENCE_DB = '{raw_data}/reference_alignments/pr2_v5/pr2_version_5.0.0_SSU_UTAX_plus_vamp_2023.refdb'
+REFERENCE_DB_FASTA = '{raw_data}/reference_alignments/pr2_v5/pr2_version_5.0.0_SSU_UTAX_plus_vamp_2023.fasta'
+VAMP_SPECIFIC = TAX_ASSIGN_DIR + '/vamp_specific/{sample}_otu.fasta'
+KMER_CANDIDATES = TAX_ASSIGN_DIR + '/kmer_candidates/{sample}_otu.fasta'
+KMER_TABLE = TAX_ASSIGN_DIR + '/kmer_sintax/{sample}.sintax'
+
+
+def default_steps(threshold=0.90, identity=0.6, threads=6, placement_threads=4, prefilter=False,
+                  min_support=kmer_classifier.CANDIDATE_SUPPORT):
+    '''
+    The steps of tax_assign_03 - 05 and phyl_placement_01, 02 and 05.
+
+    Parameters:
+    - threshold (float, optional): vsearch --cluster_fast --id. Default is 0.90.
+    - identity (float, optional): vsearch --usearch_global --id. Default is 0.6.
+    - threads (int, optional): Threads per vsearch job. Default is 6.
+    - placement_threads (int, optional): Threads per placement job. Default is 4.
+    - prefilter (bool, optional): Run vsearch --usearch_global and the eukaryote placement
+      only on the Vampyrellida candidates of the k-mer classifier. The blast6 tables then
+      only hold the candidates (not enough for taxonomic_composition_tables). Default is False.
+    - min_support (float, optional): Prefilter support, see kmer_classifier.prefilter_fasta_files.
+    '''
+    otus = KMER_CANDIDATES if prefilter else CHIMERA_FILTERED
+    otu_step = 'kmer_prefilter' if prefilter else 'chimera_filt'
+    steps = [
+        # tax_assign_03_cluster_otu.sh
+        Step('cluster_otu',
+             inputs={'fasta': '{raw_data}/denoised/{project}/{marker}/{denoise_method}/{sample}_asv.fasta'},
+             outputs={'fasta': CLUSTERED},
+             command=['vsearch', '--cluster_fast', '{inputs[fasta]}', '--id', '{threshold}',
+                      '--threads', '{threads}', '--consout', '{outputs[fasta]}'],
+             params={'threshold': threshold},
+             threads=threads),
+        # tax_assign_04_chimera_filt.sh
+        Step('chimera_filt',
+             inputs={'fasta': CLUSTERED},
+             outputs={'fasta': CHIMERA_FILTERED},
+             command=['vsearch', '--uchime_denovo', '{inputs[fasta]}', '--threads', '{threads}',
+                      '--nonchimeras', '{outputs[fasta]}'],
+             depends_on=['cluster_otu'],
+             threads=threads),
+        # modify_pr2_database.ipynb (binary database, the FASTA file is exported from it)
+        Step('reference_db',
+             inputs={'pr2': PR2_SOURCE, 'vamp': VAMP_CURATION},
+             outputs={'fasta': REFERENCE_DB_FASTA, 'manifest': REFERENCE_DB + '/manifest.json'},
+             function=reference_db,
+             params={'db_dir': REFERENCE_DB},
+             per_sample=False),
+        # tax_assign_05_taxassign.sh
+        Step('tax_assign',
+             inputs={'fasta': otus, 'db': REFERENCE_DB_FASTA},
+             outputs={'blast6': TAX_ASSIGN_DIR + '/blast/blast6_{sample}.tab'},
+             command=['vsearch', '--usearch_global', '{inputs[fasta]}', '--dbmask', 'none',
+                      '--qmask', 'none', '--db', '{inputs[db]}', '--id', '{identity}',
+                      '--iddef', '3', '--threads', '{threads}', '--blast6out', '{outputs[blast6]}'],
+             params={'identity': identity},
+             depends_on=[otu_step, 'reference_db'],
+             threads=threads),
+        # One job for all samples, the per-sample files are written to VAMP_SPECIFIC
+        Step('extract_vamp',
+             inputs={'blast6': TAX_ASSIGN_DIR + '/blast/blast6_{sample}.tab',
+                     'fasta': otus},
+             outputs={'pooled': TAX_ASSIGN_DIR + '/vamp_specific/' + vamp_extraction.POOLED_FILE},
+             function=extract_vamp_sequences,
+             params={'taxon': vamp_extraction.TAXON},
+             depends_on=['tax_assign'],
+             threads=threads,
+             per_sample=False),
+        # phyl_placement_01_phylo_placement_eukaryotes.sh, step 1
+        Step('placement_eukaryotes',
+             inputs={'fasta': otus,
+                     'ref_alignment': EUK_REFERENCE + '/reference_alignment.phy',
+                     'ref_tree': '{raw_data}/phyl_placement/reference_trees/eukaryotes/'
+                                 'reference_tree_2022/T2.raxml.bestTree',
+                     'clade_list': EUK_REFERENCE + '/taxon_vamp.tsv'},
+             outputs={'jplace': JPLACE_DIR + '/eukaryotes/epa_result_{sample}.jplace',
+                      'vamp_fasta': VAMP_FASTA},
+             function=place_eukaryotes,
+             params={'model': 'GTR+G', 'log_dir': PLACEMENT_LOGS + '/eukaryotes'},
+             depends_on=[otu_step],
+             threads=placement_threads),
+        # phyl_placement_01_phylo_placement_eukaryotes.sh, step 2
+        Step('placement_vampyrellids',
+             inputs={'fasta': VAMP_FASTA,
+                     'ref_alignment': VAMP_REFERENCE + '/reference_alignment.phy',
+                     'ref_tree': '{raw_data}/phyl_placement/reference_trees/vampyrellida/'
+                                 'reference_tree_2023/T2.raxml.bestTree'},
+             outputs={'jplace': JPLACE_DIR + '/vampyrellida/epa_result_{sample}.jplace'},
+             function=place_vampyrellids,
+             params={'model': 'GTR+G', 'log_dir': PLACEMENT_LOGS + '/vampyrellida'},
+             depends_on=['placement_eukaryotes'],
+             threads=placement_threads),
+        # phyl_placement_02_taxassign.sh
+        Step('assign_vampyrellids',
+             inputs={'jplace': JPLACE_DIR + '/vampyrellida/epa_result_{sample}.jplace',
+                     'taxon_file': VAMP_REFERENCE + '/taxon_file.tsv'},
+             outputs={'per_query': PER_QUERY_DIR + '/{sample}_per_query.tsv',
+                      'profile': PER_QUERY_DIR + '/{sample}_profile.tsv'},
+             function=assign_vampyrellids,
+             depends_on=['placement_vampyrellids']),
+        # phyl_placement_05_create_summary_tables.sh (CSV, as read by the tax_assignment_downstream notebook)
+        Step('summary_table',
+             inputs={'per_query': PER_QUERY_DIR + '/{sample}_per_query.tsv'},
+             outputs={'table': PER_QUERY_DIR + '/tax_assign.csv'},
+             function=summary_table,
+             depends_on=['assign_vampyrellids'],
+             per_sample=False)
+    ]
+    if prefilter:
+        steps[3:3] = [
+            Step('kmer_index',
+                 inputs={'manifest': REFERENCE_DB + '/manifest.json'},
+                 outputs={'manifest': REFERENCE_DB + '/kmer_index_k{k}/index.json'},
+                 function=kmer_index,
+                 params={'db_dir': REFERENCE_DB, 'k': kmer_classifier.KMER_LENGTH},
+                 depends_on=['reference_db'],
+                 per_sample=False),
+            Step('kmer_prefilter',
+                 inputs={'fasta': CHIMERA_FILTERED,
+                         'index': REFERENCE_DB + '/kmer_index_k{k}/index.json'},
+                 outputs={'fasta': KMER_CANDIDATES, 'table': KMER_TABLE},
+                 function=kmer_prefilter,
+                 params={'db_dir': REFERENCE_DB, 'k': kmer_classifier.KMER_LENGTH,
+                         'min_support': min_support},
+                 depends_on=['chimera_filt', 'kmer_index'],
+                 threads=threads,
+                 per_sample=False)
+        ]
+    return steps
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Incremental runner of the OTU clustering, '
+                                                 'taxonomic assignment and placement steps.')
+    parser.add_argument('--project', default='Suthaus_2022')
+    parser.add_argument('--marker', default='Full18S')
+    parser.add_argument('--denoise-method', default='RAD')
+    parser.add_argument('--sim', default='sim_90')
+    parser.add_argument('--threshold', type=float, default=0.90, help='vsearch clustering --id')
+    parser.add_argument('--identity', type=float, default=0.6, help='vsearch assignment --id')
+    parser.add_argument('--prefilter', action='store_true',
+                        help='run vsearch and the placement only on the k-mer Vampyrellida candidates')
+    parser.add_argument('--cores', type=int, default=os.cpu_count(), help='core budget')
+    parser.add_argument('--samples', nargs='*', help='default: all samples of the input directory')
+    parser.add_argument('--steps', nargs='*', help='only run these steps (and skip the others)')
+    parser.add_argument('--force', nargs='*', default=[], help='rerun these steps')
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    layout = Layout(args.project, args.marker, args.denoise_method, args.sim)
+    steps = default_steps(threshold=args.threshold, identity=args.identity, prefilter=args.prefilter)
+    if args.steps:
+        steps = [step for step in steps if step.name in args.steps]
+        for step in steps:
+            step.depends_on = [name for name in step.depends_on if name in args.steps]
+    run_pipeline(steps, layout, samples=args.samples, cores=args.cores, force=args.force,
+                 dry_run=args.dry_run)
+
+
+if __name__ == '__main__':
+    main()
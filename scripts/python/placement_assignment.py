@@ -0,0 +1,335 @@
+# Taxonomic assignment of placed queries from jplace files (gappa examine assign in Python)
+#
+# The reference tree is labelled once (LabelIndex): every leaf gets its taxopath from the
+# taxon file, every inner node the lowest common taxopath of its children, and every edge the
+# labels of its proximal (parent) and distal (child) node. The like weight ratio (LWR) of a
+# placement is split between these two labels by its position on the edge (distal_length /
+# branch length goes to the proximal label), and accumulated up the taxonomy (aLWR).
+# All placements of all samples are assigned in one vectorized pass, and the
+# <SAMPLE>_per_query.tsv and <SAMPLE>_profile.tsv files have the gappa layout and row order
+# (LWR, fract, aLWR, afract, taxopath; fract = LWR / labelled LWR of the query or sample).
+# Nodes whose children share no taxon have no label: as in gappa, the LWR of such an edge
+# end is left out (with a warning), or reported as UNASSIGNED with --unassigned.
+#
+# Usage (from scripts/python, replaces ../bash/phyl_placement_02_taxassign.sh):
+#   python placement_assignment.py --project Suthaus_2022 --marker Full18S --denoise-method RAD --sim sim_90
+
+# Imports
+import os
+
+import numpy as np
+import pandas as pd
+
+from jplace import read_jplace, read_jplace_dir, read_jplace_files
+from mol_signatures import read_taxon_file
+
+# Constants
+TAXOPATH_SEPARATOR = ';'
+FLOAT_FORMAT = '%.4g'  # gappa writes 4 significant digits
+PER_QUERY_COLUMNS = ['name', 'LWR', 'fract', 'aLWR', 'afract', 'taxopath']
+UNASSIGNED = 'unassigned'  # taxopath of the LWR on unlabelled nodes
+
+
+class LabelIndex:
+    '''
+    Taxonomy of the taxon file and taxopath labels of the reference tree edges.
+
+    Attributes:
+    - taxopaths (list): ';' joined taxopaths in taxonomy preorder (children in the order
+      of the taxon file), indexed by taxon id.
+    - ancestors (list): Per taxon id, the ids of the taxon and all its ancestors.
+    - proximal, distal (np.ndarray): Per edge number, the taxon id of the node above and
+      below the edge (-1 if the node has no common taxopath).
+    - unassigned (int): Id of the UNASSIGNED pseudo taxon (the last taxon id).
+    - lineage_ranks (np.ndarray): (n_ranks x n_taxa) the ancestor of every taxon id per
+      rank (0 = top rank, -1 below the rank of the taxon).
+    - branch_length (np.ndarray): Per edge number, the branch length.
+    '''
+
+    def __init__(self, tree, taxopaths):
+        # Taxonomy trie in first appearance order, then numbered in preorder
+        taxopaths = {name: tuple(path) for name, path in taxopaths.items()}
+        children = {(): []}
+        for path in taxopaths.values():
+            for depth in range(1, len(path) + 1):
+                if path[:depth] not in children:
+                    children[path[:depth]] = []
+                    children[path[:depth - 1]].append(path[:depth])
+        preorder = []
+        stack = list(reversed(children[()]))
+        while stack:
+            path = stack.pop()
+            preorder.append(path)
+            stack.extend(reversed(children[path]))
+        taxon_ids = {path: i for i, path in enumerate(preorder)}
+        self.taxopaths = [TAXOPATH_SEPARATOR.join(path) for path in preorder]
+        self.ancestors = [[taxon_ids[path[:depth]] for depth in range(len(path), 0, -1)]
+                          for path in preorder]
+        # Pseudo taxon of the LWR on unlabelled nodes (last id)
+        self.unassigned = len(preorder)
+        self.taxopaths.append(UNASSIGNED)
+        self.ancestors.append([self.unassigned])
+        # Per rank (0 = top), the ancestor of every taxon id at that rank (-1 below its own rank)
+        self.lineage_ranks = np.full((max(map(len, self.ancestors)), self.n_taxa), -1, dtype=np.int64)
+        for taxon, lineage in enumerate(self.ancestors):
+            self.lineage_ranks[:len(lineage), taxon] = lineage[::-1]
+
+        # Node labels (postorder: the children are labelled before their parent)
+        missing = [name for name, leaf in zip(tree.names, tree.is_leaf) if leaf and name not in taxopaths]
+        if missing:
+            raise ValueError(f'{len(missing)} reference sequences are not in the taxon file '
+                             f'(e.g. {missing[0]}).')
+        labels = [None] * tree.n_nodes
+        for node in range(tree.n_nodes):
+            if tree.is_leaf[node]:
+                labels[node] = taxopaths[tree.names[node]]
+        for node in range(tree.n_nodes - 1):
+            parent = tree.parent[node]
+            labels[parent] = labels[node] if labels[parent] is None else _common_prefix(labels[parent], labels[node])
+        node_taxa = np.array([taxon_ids.get(label, -1) for label in labels], dtype=np.int64)
+
+        n_edges = tree.edge_num.max(initial=-1) + 1
+        self.proximal = np.full(n_edges, -1, dtype=np.int64)
+        self.distal = np.full(n_edges, -1, dtype=np.int64)
+        self.branch_length = np.zeros(n_edges)
+        has_edge = (tree.edge_num >= 0) & (tree.parent >= 0)
+        edges = tree.edge_num[has_edge]
+        self.proximal[edges] = node_taxa[tree.parent[has_edge]]
+        self.distal[edges] = node_taxa[has_edge]
+        self.branch_length[edges] = tree.branch_length[has_edge]
+
+    @classmethod
+    def from_files(cls, tree, taxon_file):
+        return cls(tree, read_taxon_file(taxon_file))
+
+    @property
+    def n_taxa(self):
+        return len(self.taxopaths)
+
+    def split_placements(self, edge_num, lwr, distal_length):
+        '''
+        Split the LWR of every placement between the labels of its edge. The share of an
+        unlabelled node is given the UNASSIGNED pseudo taxon (and flagged as unlabelled).
+
+        Returns:
+        - taxa (np.ndarray): (2 x n_placements) taxon ids (proximal, distal).
+        - weights (np.ndarray): (2 x n_placements) LWR of the proximal and distal label.
+        - unlabelled (np.ndarray): (2 x n_placements) mask of the unlabelled nodes.
+        '''
+        branch_length = self.branch_length[edge_num]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            proximal_ratio = np.where(branch_length > 0,
+                                      np.clip(distal_length / branch_length, 0, 1), 0.0)
+        proximal_ratio = np.nan_to_num(proximal_ratio)
+        taxa = np.stack([self.proximal[edge_num], self.distal[edge_num]])
+        weights = np.stack([lwr * proximal_ratio, lwr * (1 - proximal_ratio)])
+        unlabelled = taxa < 0
+        taxa[unlabelled] = self.unassigned
+        return taxa, weights, unlabelled
+
+    def accumulate(self, groups, taxa, weights, order):
+        '''
+        Sum the weights per (group, taxon) and up the taxonomy.
+
+        Only the (group, taxon) pairs that are reached are kept, so the cost grows with the
+        number of placements instead of n_groups x n_taxa.
+
+        Parameters:
+        - groups, taxa, weights (np.ndarray): Group, taxon id and LWR of every label share.
+        - order (np.ndarray): Position of every label share in the jplace files.
+
+        Returns:
+        - groups, taxa (np.ndarray): The (group, taxon) pairs with a non-zero aLWR, sorted by
+          group and then in the order of gappa: the taxonomy of every group is built in the
+          order its taxa are first reached, and written in preorder.
+        - lwr, alwr (np.ndarray): Their assigned and accumulated LWR.
+        - totals (np.ndarray): Per group, the total labelled LWR (indexed by group).
+        '''
+        totals = np.bincount(groups, weights=weights)
+
+        # Every taxon adds its LWR to itself and all its ancestors
+        lineage_lengths = np.array([len(lineage) for lineage in self.ancestors], dtype=np.int64)
+        lineages = np.concatenate(self.ancestors) if self.ancestors else np.empty(0, dtype=np.int64)
+        lineage_starts = np.cumsum(lineage_lengths) - lineage_lengths
+        repeats = lineage_lengths[taxa]
+        within = np.arange(repeats.sum()) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+        ancestor_taxa = lineages[np.repeat(lineage_starts[taxa], repeats) + within]
+        ancestor_groups = np.repeat(groups, repeats)
+        own = within == 0
+
+        keys, inverse = np.unique(ancestor_groups * self.n_taxa + ancestor_taxa, return_inverse=True)
+        alwr = np.bincount(inverse, weights=np.repeat(weights, repeats), minlength=len(keys))
+        lwr = np.bincount(inverse[own], weights=weights, minlength=len(keys))
+        never = np.iinfo(np.int64).max
+        reached = np.full(len(keys), never)
+        np.minimum.at(reached, inverse, np.repeat(np.where(weights > 0, order, never), repeats))
+        nonzero = alwr > 0
+        keys, lwr, alwr, reached = keys[nonzero], lwr[nonzero], alwr[nonzero], reached[nonzero]
+        groups, taxa = keys // self.n_taxa, keys % self.n_taxa
+
+        # Sort key of a row: when its lineage (root first) was reached, padded with -1 so
+        # that a taxon comes before its descendants
+        first_reached = np.full((len(self.lineage_ranks), len(keys)), -1, dtype=np.int64)
+        for rank, rank_ancestors in enumerate(self.lineage_ranks):
+            ancestor = rank_ancestors[taxa]
+            has_rank = ancestor >= 0
+            ancestor_keys = groups[has_rank] * self.n_taxa + ancestor[has_rank]
+            first_reached[rank, has_rank] = reached[np.searchsorted(keys, ancestor_keys)]
+        rows = np.lexsort([*first_reached[::-1], groups])
+        return groups[rows], taxa[rows], lwr[rows], alwr[rows], totals
+
+
+def _common_prefix(first, second):
+    length = 0
+    for a, b in zip(first, second):
+        if a != b:
+            break
+        length += 1
+    return first[:length]
+
+
+def _assignment_table(label_index, groups, taxa, lwr, alwr, totals):
+    # One row per (group, taxon) from LabelIndex.accumulate, fractions of the group total
+    group_totals = totals[groups]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fract = np.where(group_totals > 0, lwr / group_totals, 0.0)
+        afract = np.where(group_totals > 0, alwr / group_totals, 0.0)
+    return pd.DataFrame({'group': groups, 'LWR': lwr, 'fract': fract, 'aLWR': alwr, 'afract': afract,
+                         'taxopath': np.asarray(label_index.taxopaths, dtype=object)[taxa]})
+
+
+def assign_jplaces(jplaces, label_index=None, taxon_file=None, unassigned=False):
+    '''
+    Assign the queries of several samples in one pass.
+
+    Parameters:
+    - jplaces (dict): Sample -> Jplace (all placed on the same reference tree).
+    - label_index (LabelIndex, optional): The labelled reference tree. Built from the tree
+      of the first sample and taxon_file if not given.
+    - taxon_file (str, optional): gappa taxon file (needed without label_index).
+    - unassigned (bool, optional): Report the LWR on unlabelled nodes as an UNASSIGNED row
+      (and include it in fract/afract). Default is False: it is left out, as gappa does.
+
+    Returns:
+    - per_query (dict): Sample -> DataFrame with the columns of <SAMPLE>_per_query.tsv.
+    - profiles (dict): Sample -> DataFrame with the columns of <SAMPLE>_profile.tsv.
+
+    Raises:
+    - ValueError: If the samples were not placed on the same reference tree.
+    '''
+    samples = list(jplaces)
+    reference = jplaces[samples[0]].tree
+    for sample in samples[1:]:
+        tree = jplaces[sample].tree
+        if not (np.array_equal(tree.edge_num, reference.edge_num) and tree.names == reference.names):
+            raise ValueError(f'{sample} was placed on another reference tree than {samples[0]}.')
+    if label_index is None:
+        label_index = LabelIndex.from_files(reference, taxon_file)
+
+    # All pqueries of all samples get one global index
+    offsets = np.cumsum([0] + [jplaces[sample].n_pqueries for sample in samples])
+    pquery_sample = np.repeat(np.arange(len(samples)), np.diff(offsets))
+    pquery = np.concatenate([jplaces[sample].pquery + offset for sample, offset in zip(samples, offsets)])
+    column = {field: np.concatenate([jplaces[sample].columns[field] for sample in samples])
+              for field in ('edge_num', 'like_weight_ratio', 'distal_length')}
+    taxa, weights, unlabelled = label_index.split_placements(column['edge_num'], column['like_weight_ratio'],
+                                                             column['distal_length'])
+    unlabelled &= weights > 0
+    if unlabelled.any():
+        placed = unlabelled.any(axis=0)
+        print(f'Warning: {np.count_nonzero(placed)} placements ({len(np.unique(pquery[placed]))} queries) '
+              f'have LWR on unlabelled nodes; it is '
+              f'{f"reported as {UNASSIGNED!r}" if unassigned else "left out of the assignment (as in gappa)"}.')
+    taxa, weights = taxa.ravel(), weights.ravel()
+    groups = np.concatenate([pquery, pquery])
+    placement = np.arange(len(pquery))
+    order = np.concatenate([2 * placement, 2 * placement + 1])
+    if not unassigned:
+        labelled = ~unlabelled.ravel()
+        taxa, weights, groups, order = taxa[labelled], weights[labelled], groups[labelled], order[labelled]
+
+    # Per query and per sample (profile)
+    query_rows = _assignment_table(label_index, *label_index.accumulate(groups, taxa, weights, order))
+    profile_rows = _assignment_table(label_index,
+                                     *label_index.accumulate(pquery_sample[groups], taxa, weights, order))
+
+    per_query, profiles = {}, {}
+    query_rows['sample'] = pquery_sample[query_rows['group']]
+    for i, sample in enumerate(samples):
+        jplace = jplaces[sample]
+        # One block of rows per query name
+        names = pd.DataFrame({'name': jplace.names, 'group': jplace.name_pquery + offsets[i]})
+        rows = query_rows[query_rows['sample'] == i]
+        per_query[sample] = names.merge(rows, on='group', how='inner')[PER_QUERY_COLUMNS]
+        profiles[sample] = profile_rows[profile_rows['group'] == i][PER_QUERY_COLUMNS[1:]].reset_index(drop=True)
+    return per_query, profiles
+
+
+def write_assignment(per_query, profile, sample, out_dir):
+    '''
+    Write <sample>_per_query.tsv and <sample>_profile.tsv to out_dir.
+
+    Returns:
+    - str: Path to the per query file.
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    per_query_file = os.path.join(out_dir, f'{sample}_per_query.tsv')
+    per_query.to_csv(per_query_file, sep='\t', index=False, float_format=FLOAT_FORMAT)
+    profile.to_csv(os.path.join(out_dir, f'{sample}_profile.tsv'), sep='\t', index=False,
+                   float_format=FLOAT_FORMAT)
+    return per_query_file
+
+
+def assign_jplace_files(jplace_paths, taxon_file, out_dir, processes=None, unassigned=False):
+    '''
+    Assign the queries of all samples (replaces one gappa examine assign run per sample).
+
+    The jplace files are read in parallel, the reference tree is labelled once and all
+    placements are assigned in one pass.
+
+    Parameters:
+    - jplace_paths (dict): Sample -> path to its jplace file.
+    - taxon_file (str): gappa taxon file of the reference tree.
+    - out_dir (str): Output directory of the <SAMPLE>_per_query.tsv and <SAMPLE>_profile.tsv files.
+    - processes (int, optional): Number of processes reading the jplace files.
+    - unassigned (bool, optional): Report the LWR on unlabelled nodes as an UNASSIGNED row
+      (see assign_jplaces).
+
+    Returns:
+    - dict: Sample -> path to its per query file.
+    '''
+    if len(jplace_paths) == 1:
+        jplaces = {sample: read_jplace(path) for sample, path in jplace_paths.items()}
+    else:
+        jplaces = read_jplace_files(jplace_paths, processes=processes)
+    per_query, profiles = assign_jplaces(jplaces, taxon_file=taxon_file, unassigned=unassigned)
+    return {sample: write_assignment(per_query[sample], profiles[sample], sample, out_dir)
+            for sample in jplaces}
+
+
+def main():
+    import argparse
+    from pipeline import Layout, JPLACE_DIR, PER_QUERY_DIR, VAMP_REFERENCE
+
+    parser = argparse.ArgumentParser(description='Taxonomic assignment of the vampyrellid placements '
+                                                 'of all samples in one pass.')
+    parser.add_argument('--project', default='Suthaus_2022')
+    parser.add_argument('--marker', default='Full18S')
+    parser.add_argument('--denoise-method', default='RAD')
+    parser.add_argument('--sim', default='sim_90')
+    parser.add_argument('--processes', type=int, help='jplace files read at the same time')
+    parser.add_argument('--unassigned', action='store_true',
+                        help=f'report the LWR on unlabelled nodes as {UNASSIGNED!r} instead of leaving it out')
+    args = parser.parse_args()
+
+    layout = Layout(args.project, args.marker, args.denoise_method, args.sim)
+    jplaces = read_jplace_dir(layout.path(JPLACE_DIR + '/vampyrellida'), processes=args.processes)
+    print(f'Samples used: {" ".join(jplaces)}')
+    per_query, profiles = assign_jplaces(jplaces, taxon_file=layout.path(VAMP_REFERENCE + '/taxon_file.tsv'),
+                                         unassigned=args.unassigned)
+    for sample in jplaces:
+        write_assignment(per_query[sample], profiles[sample], sample, layout.path(PER_QUERY_DIR))
+
+
+if __name__ == '__main__':
+    main()
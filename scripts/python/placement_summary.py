@@ -0,0 +1,163 @@
+# Summary table of the phylogenetic placement assignments of all samples
+#
+# Python version of ../bash/phyl_placement_05_create_summary_tables.sh and of the table
+# preparation in the tax_assignment_downstream notebook. All <SAMPLE>_per_query.tsv files are
+# read in parallel into one table, and the best assignment of every query is selected with a
+# single groupby: the deepest taxopath, and among equally deep taxopaths the highest LWR.
+# The taxopath is split into one (categorical) column per rank, so the table can be written
+# as CSV / TSV or, with pyarrow installed, as Parquet. The default stays tax_assign.csv: it is
+# read with pd.read_csv by the tax_assignment_downstream notebook, and pyarrow is not in
+# requirements.txt.
+#
+# Usage (from scripts/python):
+#   python placement_summary.py --project Suthaus_2022 --marker Full18S --denoise-method RAD --sim sim_90
+
+# Imports
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+# Constants
+TAX_LEVELS = ['order', 'family', 'genus', 'species']
+UNASSIGNED = 'unassigned'
+FAMILY_LABELS = {'Vampyrellida_clade_PurpleVamp': 'PurpleVamp'}
+PER_QUERY_SUFFIX = '_per_query.tsv'
+SUMMARY_COLUMNS = ['otu', 'confidence', 'sample'] + TAX_LEVELS
+
+
+def _read_per_query(path):
+    return pd.read_csv(path, sep='\t', usecols=['name', 'LWR', 'taxopath'],
+                       dtype={'name': str, 'LWR': float, 'taxopath': str})
+
+
+def read_per_query_files(per_query_files, processes=None):
+    '''
+    Read the (name, LWR, taxopath) columns of many per_query.tsv files in parallel.
+
+    Parameters:
+    - per_query_files (dict): Sample label -> path to its per_query.tsv file.
+    - processes (int, optional): Number of worker processes. Default is os.cpu_count().
+
+    Returns:
+    - pd.DataFrame: The rows of all samples with a categorical 'sample' column.
+    '''
+    samples = list(per_query_files)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        tables = list(executor.map(_read_per_query, [per_query_files[sample] for sample in samples]))
+    dataframe = pd.concat(tables, ignore_index=True)
+    dataframe['sample'] = pd.Categorical.from_codes(
+        np.repeat(np.arange(len(samples)), [len(table) for table in tables]), categories=samples)
+    return dataframe
+
+
+def best_assignments(dataframe):
+    '''
+    Keep the deepest taxopath of every query of every sample (the highest LWR among equally
+    deep taxopaths). UNASSIGNED rows (placement_assignment --unassigned) rank below every
+    taxopath, so they are only kept for queries without any assigned LWR.
+
+    Returns:
+    - pd.DataFrame: One row per (sample, name), in the row order of the input.
+    '''
+    depth = (dataframe['taxopath'].str.count(';') + 1).where(dataframe['taxopath'] != UNASSIGNED, 0)
+    order = np.lexsort((dataframe['LWR'].to_numpy(), depth.to_numpy()))
+    best = dataframe.iloc[order].groupby(['sample', 'name'], observed=True, sort=False).tail(1)
+    return best.sort_index()
+
+
+def split_taxopaths(taxopaths):
+    '''
+    Split taxopaths into one categorical column per rank of TAX_LEVELS; missing ranks are
+    UNASSIGNED.
+
+    Returns:
+    - dict: Rank -> pd.Categorical aligned with taxopaths.
+    '''
+    ranks = (pd.Series(taxopaths, dtype=object).reset_index(drop=True)
+             .str.split(';', n=len(TAX_LEVELS) - 1, expand=True)
+             .reindex(columns=range(len(TAX_LEVELS))))
+    ranks = ranks.where(ranks.notna() & (ranks != ''), UNASSIGNED)
+    return {level: pd.Categorical(ranks[i]) for i, level in enumerate(TAX_LEVELS)}
+
+
+def summary_table(per_query_files, processes=None):
+    '''
+    Build the summary table (otu, confidence, sample, order, family, genus, species) of the
+    placement assignments of all samples, as tax_assign.csv of the tax_assignment_downstream
+    notebook.
+
+    Parameters:
+    - per_query_files (dict): Sample label -> path to its per_query.tsv file.
+    - processes (int, optional): Number of processes reading the files.
+
+    Returns:
+    - pd.DataFrame: One row per query and sample; confidence is the LWR of the selected taxopath.
+    '''
+    best = best_assignments(read_per_query_files(per_query_files, processes=processes))
+    table = pd.DataFrame({'otu': best['name'].to_numpy(),
+                          'confidence': best['LWR'].to_numpy(),
+                          'sample': best['sample'].array})
+    for level, values in split_taxopaths(best['taxopath']).items():
+        table[level] = values
+    table['family'] = table['family'].cat.rename_categories(
+        lambda family: FAMILY_LABELS.get(family, family))
+    return table[SUMMARY_COLUMNS]
+
+
+def write_summary_table(table, output_file):
+    '''
+    Write the summary table; the format follows the file extension (.parquet, .csv,
+    otherwise tab separated).
+
+    Returns:
+    - str: output_file.
+    '''
+    if os.path.dirname(output_file):
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    extension = os.path.splitext(output_file)[1].lower()
+    if extension == '.parquet':
+        table.to_parquet(output_file, index=False)
+    else:
+        table.to_csv(output_file, sep=',' if extension == '.csv' else '\t', index=False)
+    return output_file
+
+
+def per_query_files_in_dir(directory):
+    '''
+    Find the <SAMPLE>_per_query.tsv files of a directory; the sample label is the part of
+    the file name before the first '_' (e.g. 'NH1_18S_per_query.tsv' -> 'NH1').
+
+    Returns:
+    - dict: Sample label -> path, sorted by file name.
+    '''
+    return {file_name.split('_')[0]: os.path.join(directory, file_name)
+            for file_name in sorted(os.listdir(directory)) if file_name.endswith(PER_QUERY_SUFFIX)}
+
+
+def main():
+    import argparse
+    from pipeline import Layout, PER_QUERY_DIR
+
+    parser = argparse.ArgumentParser(description='Summary table of the placement assignments '
+                                                 'of all samples.')
+    parser.add_argument('--project', default='Suthaus_2022')
+    parser.add_argument('--marker', default='Full18S')
+    parser.add_argument('--denoise-method', default='RAD')
+    parser.add_argument('--sim', default='sim_90')
+    parser.add_argument('--output', help='output table (.csv, .tsv or .parquet); '
+                                         'default is tax_assign.csv in the assignment directory')
+    parser.add_argument('--processes', type=int, help='files read at the same time')
+    args = parser.parse_args()
+
+    layout = Layout(args.project, args.marker, args.denoise_method, args.sim)
+    per_query_dir = layout.path(PER_QUERY_DIR)
+    per_query_files = per_query_files_in_dir(per_query_dir)
+    print(f'Samples used: {" ".join(per_query_files)}')
+    table = summary_table(per_query_files, processes=args.processes)
+    write_summary_table(table, args.output or os.path.join(per_query_dir, 'tax_assign.csv'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+# Single-pass, taxon-stratified subsampling of a UTAX reference database (e.g. PR2)
+#
+# Python version of the subset_pr2_database notebook in one pass over the FASTA file:
+# 1. Records outside the length limits are skipped.
+# 2. Records whose ID is in the exclusion list (hash set) or whose ID contains one of the
+#    excluded substrings (Aho-Corasick automaton, e.g. 'k:Bacteria') are skipped.
+# 3. Up to `limit` records are kept per taxon of the chosen rank (e.g. 'f' for family), either
+#    the first ones (as the notebook) or a seeded reservoir sample. Only the kept records are
+#    held in memory.
+# Excluded records do not use up the places of their taxon. The output is written per taxon
+# (in the order the taxa first appear), wrapped as Bio.SeqIO.write does.
+#
+# Usage (from scripts/python):
+#   python pr2_subsample.py pr2_version_4.14.0_SSU_UTAX.fasta subset.fasta --rank f --limit 1 \
+#       --max-length 3000 --exclude-ids seqs_to_remove.txt --exclude-substrings k:Bacteria k:Archaea
+
+# Imports
+import random
+from collections import deque
+
+from fasta_io import iter_fasta, write_fasta
+from taxonomy_store import TAX_SEPARATOR
+
+# Constants
+SAMPLING_METHODS = ('reservoir', 'first')
+FASTA_LINE_WIDTH = 60  # as Bio.SeqIO.write
+
+
+class AhoCorasick:
+    '''
+    Aho-Corasick automaton for "does the text contain any of the patterns" checks.
+
+    The goto and failure links are resolved into one transition table, so every character of
+    the text costs one dictionary lookup whatever the number of patterns.
+    '''
+
+    def __init__(self, patterns):
+        patterns = [pattern for pattern in patterns if pattern]
+        goto = [{}]
+        accepting = [False]
+        for pattern in patterns:
+            state = 0
+            for char in pattern:
+                if char not in goto[state]:
+                    goto.append({})
+                    accepting.append(False)
+                    goto[state][char] = len(goto) - 1
+                state = goto[state][char]
+            accepting[state] = True
+
+        # Breadth-first: the failure state of every state is resolved before its children
+        self.transitions = [dict(goto[0])]
+        self.transitions.extend({} for _ in range(len(goto) - 1))
+        failure = [0] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            accepting[state] = accepting[state] or accepting[failure[state]]
+            transitions = dict(self.transitions[failure[state]])
+            for char, child in goto[state].items():
+                failure[child] = self.transitions[failure[state]].get(char, 0) if state else 0
+                transitions[char] = child
+                queue.append(child)
+            self.transitions[state] = transitions
+        self.accepting = accepting
+        self.n_patterns = len(patterns)
+
+    def __bool__(self):
+        return self.n_patterns > 0
+
+    def search(self, text):
+        '''
+        True if text contains any of the patterns.
+        '''
+        transitions, accepting = self.transitions, self.accepting
+        state = 0
+        for char in text:
+            state = transitions[state].get(char, 0)
+            if accepting[state]:
+                return True
+        return False
+
+
+def rank_value(header, rank):
+    '''
+    The value of a UTAX rank in a header ('f' -> 'Vampyrellidae' for '...,f:Vampyrellidae,...'),
+    or None if the header has no such rank.
+    '''
+    _, _, taxonomy = header.partition(TAX_SEPARATOR)
+    prefix = rank + ':'
+    for field in taxonomy.split(','):
+        if field.startswith(prefix):
+            return field[len(prefix):] or None
+    return None
+
+
+def read_id_list(path):
+    '''
+    Read one ID (or substring) per line, ignoring empty lines.
+    '''
+    with open(path, 'r') as infile:
+        return [line.strip() for line in infile if line.strip()]
+
+
+def subsample_fasta(input_fasta, output_fasta, rank='f', limit=1, max_length=None, min_length=None,
+                    exclude_ids=(), exclude_substrings=(), sampling='reservoir', seed=0,
+                    line_width=FASTA_LINE_WIDTH):
+    '''
+    Keep up to `limit` records per taxon of a rank in one pass over a UTAX FASTA file.
+
+    Parameters:
+    - input_fasta (str): UTAX FASTA file (plain or gzipped).
+    - output_fasta (str): Output FASTA file.
+    - rank (str, optional): UTAX rank prefix to stratify by ('k', 'd', 'p', 'c', 'o', 'f', 'g'
+      or 's'). Default is 'f' (family).
+    - limit (int, optional): Records kept per taxon. Default is 1.
+    - max_length, min_length (int, optional): Sequence length limits (inclusive).
+    - exclude_ids (iterable, optional): Record IDs (first word of the header) to skip.
+    - exclude_substrings (iterable, optional): Skip records whose ID contains any of these.
+    - sampling (str, optional): 'reservoir' (seeded random sample) or 'first' (the first
+      records of every taxon). Default is 'reservoir'.
+    - seed (int, optional): Seed of the reservoir sampling. Default is 0.
+    - line_width (int, optional): Wrap the sequences to this width (None: no wrapping).
+
+    Returns:
+    - dict: Record counts ('read', 'length', 'excluded', 'no_rank', 'written') and 'taxa'.
+
+    Raises:
+    - ValueError: For an unknown sampling method.
+    '''
+    if sampling not in SAMPLING_METHODS:
+        raise ValueError(f'Invalid sampling {sampling!r} (allowed: {", ".join(SAMPLING_METHODS)}).')
+    exclude_ids = set(exclude_ids)
+    automaton = AhoCorasick(exclude_substrings)
+    rng = random.Random(seed)
+    counts = {'read': 0, 'length': 0, 'excluded': 0, 'no_rank': 0}
+    reservoirs = {}  # taxon -> [records seen, [(position, header, sequence), ...]]
+
+    for position, (header, sequence) in enumerate(iter_fasta(input_fasta)):
+        counts['read'] += 1
+        if (max_length is not None and len(sequence) > max_length) or \
+                (min_length is not None and len(sequence) < min_length):
+            counts['length'] += 1
+            continue
+        record_id = header.split(maxsplit=1)[0] if header else header
+        if record_id in exclude_ids or (automaton and automaton.search(record_id)):
+            counts['excluded'] += 1
+            continue
+        taxon = rank_value(header, rank)
+        if taxon is None:
+            counts['no_rank'] += 1
+            continue
+
+        reservoir = reservoirs.setdefault(taxon, [0, []])
+        reservoir[0] += 1
+        if len(reservoir[1]) < limit:
+            reservoir[1].append((position, header, sequence))
+        elif sampling == 'reservoir':
+            # Algorithm R: the n-th record replaces a kept one with probability limit / n
+            slot = rng.randrange(reservoir[0])
+            if slot < limit:
+                reservoir[1][slot] = (position, header, sequence)
+
+    counts['written'] = write_fasta(((header, sequence) for _, kept in reservoirs.values()
+                                     for _, header, sequence in sorted(kept)),
+                                    output_fasta, line_width=line_width)
+    counts['taxa'] = len(reservoirs)
+    return counts
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Taxon-stratified subsample of a UTAX reference '
+                                                 'database in one pass.')
+    parser.add_argument('input_fasta')
+    parser.add_argument('output_fasta')
+    parser.add_argument('--rank', default='f', help='UTAX rank prefix to stratify by (default: f)')
+    parser.add_argument('--limit', type=int, default=1, help='records kept per taxon (default: 1)')
+    parser.add_argument('--max-length', type=int)
+    parser.add_argument('--min-length', type=int)
+    parser.add_argument('--exclude-ids', help='file with one record ID per line')
+    parser.add_argument('--exclude-substrings', nargs='*', default=[],
+                        help='skip records whose ID contains any of these')
+    parser.add_argument('--sampling', choices=SAMPLING_METHODS, default='reservoir')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    counts = subsample_fasta(args.input_fasta, args.output_fasta, rank=args.rank, limit=args.limit,
+                             max_length=args.max_length, min_length=args.min_length,
+                             exclude_ids=read_id_list(args.exclude_ids) if args.exclude_ids else (),
+                             exclude_substrings=args.exclude_substrings, sampling=args.sampling,
+                             seed=args.seed)
+    print(f'{counts["written"]} of {counts["read"]} records written ({counts["taxa"]} taxa; skipped: '
+          f'{counts["length"]} length, {counts["excluded"]} excluded, {counts["no_rank"]} without rank)')
+
+
+if __name__ == '__main__':
+    main()
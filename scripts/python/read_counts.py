@@ -0,0 +1,164 @@
+# Fast read/sequence counting for (gzipped) FASTQ and FASTA files
+#
+# Files are decompressed in large blocks and records are counted on the raw bytes
+# (bytes.count runs in C), so no Python-level loop over lines is needed. Many files
+# are counted in parallel on a process pool.
+
+# Imports
+import os
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+
+# Constants
+BLOCK_SIZE = 8 * 1024 * 1024  # 8 MB of compressed/raw data per read
+
+
+def iter_blocks(file_path, block_size=BLOCK_SIZE):
+    '''
+    Yield the (decompressed) content of a file in large byte blocks.
+    Files ending with '.gz' are decompressed with zlib (multi-member gzip supported).
+    '''
+    with open(file_path, 'rb') as handle:
+        if not file_path.endswith('.gz'):
+            while True:
+                block = handle.read(block_size)
+                if not block:
+                    return
+                yield block
+
+        decompressor = zlib.decompressobj(wbits=31)
+        while True:
+            chunk = handle.read(block_size)
+            if not chunk:
+                break
+            while chunk:
+                yield decompressor.decompress(chunk)
+                if decompressor.eof:
+                    # The next gzip member (e.g. from concatenated files) starts here
+                    chunk = decompressor.unused_data
+                    decompressor = zlib.decompressobj(wbits=31)
+                else:
+                    chunk = b''
+        yield decompressor.flush()
+
+
+def count_lines(file_path, block_size=BLOCK_SIZE):
+    '''
+    Return the number of lines in a (gzipped) file. A last line without a
+    trailing newline is counted as well.
+    '''
+    num_lines = 0
+    last_byte = b'\n'
+    for block in iter_blocks(file_path, block_size):
+        if block:
+            num_lines += block.count(b'\n')
+            last_byte = block[-1:]
+    if last_byte != b'\n':
+        num_lines += 1
+    return num_lines
+
+
+def count_fasta_sequences(file_path, block_size=BLOCK_SIZE):
+    '''
+    Return the number of records (header lines starting with '>') in a (gzipped) FASTA file.
+    '''
+    num_seqs = 0
+    last_byte = b'\n'
+    for block in iter_blocks(file_path, block_size):
+        if not block:
+            continue
+        num_seqs += block.count(b'\n>')
+        # A header at the very beginning of the file or of this block
+        if last_byte == b'\n' and block[:1] == b'>':
+            num_seqs += 1
+        last_byte = block[-1:]
+    return num_seqs
+
+
+def count_reads(file_path, file_format=None):
+    '''
+    Count the reads/sequences in a FASTQ or FASTA file (plain or gzipped).
+
+    Parameters:
+    - file_path (str): Path to the read/sequence file.
+    - file_format (str, optional): 'fastq' or 'fasta'. If None, the format is guessed
+      from the file name ('.fasta', '.fa', '.fna' -> fasta, everything else -> fastq).
+
+    Returns:
+    - int: The number of reads (FASTQ: lines / 4) or sequences (FASTA).
+    '''
+    if file_format is None:
+        name = file_path[:-3] if file_path.endswith('.gz') else file_path
+        file_format = 'fasta' if name.endswith(('.fasta', '.fa', '.fna')) else 'fastq'
+    if file_format == 'fastq':
+        return count_lines(file_path) // 4
+    if file_format == 'fasta':
+        return count_fasta_sequences(file_path)
+    raise ValueError("Invalid value for 'file_format'. Choose 'fastq' or 'fasta'.")
+
+
+def count_reads_parallel(file_paths, file_format=None, processes=None):
+    '''
+    Count the reads of many files on a process pool.
+
+    Returns:
+    - dict: File path -> number of reads.
+    '''
+    file_paths = list(file_paths)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        counts = executor.map(count_reads, file_paths, [file_format] * len(file_paths))
+        return dict(zip(file_paths, counts))
+
+
+def sample_name_from_path(file_path):
+    '''
+    Derive the sample name from a raw read file name, e.g. 'A3_21R.hifi_reads.fastq.gz' -> 'A3'.
+    '''
+    return os.path.basename(file_path).split('.')[0].split('_')[0]
+
+
+def run_name_from_dir(directory):
+    '''
+    Derive the run/cell column name from a read directory,
+    e.g. '../raw_data/PacBio/Suthaus_2022_Full18S/cell1/' -> 'Full18S_cell1'.
+    '''
+    parts = os.path.normpath(directory).split(os.sep)
+    return parts[-2].split('_')[-1] + '_' + parts[-1]
+
+
+def read_count_table(directories, extension='.fastq.gz', file_format=None, processes=None):
+    '''
+    Build a per-sample / per-cell table of read counts.
+
+    All files with the given extension in all directories are counted together on one
+    process pool, so the slowest directory does not serialize the others.
+
+    Parameters:
+    - directories (list or dict): Read directories (e.g. .../Suthaus_2022_Full18S/cell1/).
+      A dict maps column names to directories; for a list the column names are derived
+      with run_name_from_dir.
+    - extension (str, optional): Extension of the files to count. Default is '.fastq.gz'.
+    - file_format (str, optional): 'fastq' or 'fasta', see count_reads.
+    - processes (int, optional): Number of worker processes. Default is os.cpu_count().
+
+    Returns:
+    - pd.DataFrame: Samples as rows, runs/cells as columns, read counts as values
+      (NaN where a sample is missing in a run).
+    '''
+    if not isinstance(directories, dict):
+        directories = {run_name_from_dir(directory): directory for directory in directories}
+
+    file_runs = {}
+    for run_name, directory in directories.items():
+        for file_name in sorted(os.listdir(directory)):
+            if file_name.endswith(extension):
+                file_runs[os.path.join(directory, file_name)] = run_name
+
+    counts = count_reads_parallel(file_runs, file_format=file_format, processes=processes)
+
+    num_read_data = {run_name: {} for run_name in directories}
+    for file_path, num_reads in counts.items():
+        num_read_data[file_runs[file_path]][sample_name_from_path(file_path)] = num_reads
+
+    return pd.DataFrame.from_dict(num_read_data)
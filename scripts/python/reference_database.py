@@ -0,0 +1,375 @@
+# Prebuilt binary PR2 + curated Vampyrellida reference database
+#
+# Python version of the modify_pr2_database notebook: the PR2 records without 'vampyrellida'
+# in their header are combined with the curated vampyrellid records (headers rewritten from
+# 'ID|...|family|genus|species' to UTAX). Instead of a FASTA file the build writes a directory
+# with
+# - 2-bit packed sequences (A, C, G, T; every other character is kept as an exception),
+# - the parsed taxonomy (taxonomy_store.TaxonomyStore) and the header of every record,
+# - per-taxon record ranges: the records are sorted by their taxopath, so the records of
+#   every taxon (and its descendants) are one contiguous range,
+# - manifest.json with the SHA-256 of the source files and a digest per group of records
+#   (taxa at GROUP_RANK).
+# The build is skipped while the source files are unchanged. Otherwise only the groups whose
+# records changed are packed again, the others are copied from the previous build. The
+# vsearch FASTA file is exported from the database (in source order, wrapped as SeqIO does).
+#
+# Usage (from scripts/python):
+#   python reference_database.py --project Suthaus_2022 --marker Full18S --denoise-method RAD --sim sim_90
+
+# Imports
+import hashlib
+import json
+import os
+import shutil
+from collections import Counter
+
+import numpy as np
+
+from fasta_io import BUFFER_SIZE, iter_fasta
+from taxonomy_store import RANKS, TaxonomyStore
+
+# Constants
+FORMAT_VERSION = 1
+MANIFEST_FILE = 'manifest.json'
+TAXONOMY_FILE = 'taxonomy.npz'
+ARRAYS = ['packed', 'record_offset', 'record_length', 'record_taxon', 'source_order', 'header_blob',
+          'header_offset', 'exception_record', 'exception_position', 'exception_char',
+          'taxon_start', 'taxon_end']
+GROUP_RANK = 'Order'
+EXCLUDED_TAXON = b'vampyrellida'  # PR2 records replaced by the curated vampyrellid records
+VAMP_TAXONOMY = 'k:Eukaryota,d:TSAR,p:Rhizaria-Cercozoa,c:Endomyxa,o:Vampyrellida'
+FASTA_LINE_WIDTH = 60  # as Bio.SeqIO.write
+HASH_BLOCK_SIZE = 8 * 1024 * 1024
+ENCODE = np.full(256, 255, dtype=np.uint8)
+ENCODE[np.frombuffer(b'ACGT', dtype=np.uint8)] = np.arange(4, dtype=np.uint8)
+# Packed byte -> its 4 bases
+DECODE = np.frombuffer(b'ACGT', dtype=np.uint8)[
+    (np.arange(256)[:, None] >> np.array([6, 4, 2, 0])) & 3].astype(np.uint8)
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        while True:
+            block = handle.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+def _source_info(path, previous=None):
+    # Size, mtime and SHA-256 of a source file; the digest is reused while size and mtime match
+    stat = os.stat(path)
+    info = {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if previous and all(previous.get(key) == info[key] for key in ('path', 'size', 'mtime_ns')):
+        info['sha256'] = previous['sha256']
+    else:
+        info['sha256'] = file_sha256(path)
+    return info
+
+
+def read_source_records(pr2_fasta, vamp_fasta):
+    '''
+    The records of the combined database, in source order: the PR2 records without
+    'vampyrellida' in their header, then the curated vampyrellid records with UTAX headers.
+
+    Returns:
+    - list: (header, sequence) tuples of bytes.
+    '''
+    records = [(header, sequence) for header, sequence in iter_fasta(pr2_fasta, as_bytes=True)
+               if EXCLUDED_TAXON not in header.lower()]
+    for header, sequence in iter_fasta(vamp_fasta, as_bytes=True):
+        parts = header.decode().split('|')
+        taxonomy = f'{VAMP_TAXONOMY},f:{parts[2]},g:{parts[3]},s:{parts[4]}'
+        records.append((f'{parts[0]};tax={taxonomy}'.encode(), sequence))
+    return records
+
+
+def pack_sequences(sequences):
+    '''
+    2-bit pack sequences; every record starts at a byte boundary.
+
+    Returns:
+    - packed (np.ndarray): uint8 array of the packed bases.
+    - byte_lengths (np.ndarray): Packed bytes per record.
+    - exceptions (tuple): (record, position, character) arrays of the non-ACGT characters.
+    '''
+    lengths = np.array([len(sequence) for sequence in sequences], dtype=np.int64)
+    byte_lengths = (lengths + 3) // 4
+    codes = ENCODE[np.frombuffer(b''.join(sequences), dtype=np.uint8)]
+    records = np.repeat(np.arange(len(sequences)), lengths)
+    starts = np.cumsum(lengths) - lengths
+    positions = np.arange(len(codes)) - starts[records]
+
+    is_exception = codes == 255
+    exceptions = (records[is_exception].astype(np.int32), positions[is_exception].astype(np.int32),
+                  np.frombuffer(b''.join(sequences), dtype=np.uint8)[is_exception].copy())
+
+    padded = np.zeros(4 * int(byte_lengths.sum()), dtype=np.uint8)
+    padded[4 * (np.cumsum(byte_lengths) - byte_lengths)[records] + positions] = np.where(is_exception, 0, codes)
+    quads = padded.reshape(-1, 4)
+    packed = (quads[:, 0] << 6) | (quads[:, 1] << 4) | (quads[:, 2] << 2) | quads[:, 3]
+    return packed.astype(np.uint8), byte_lengths, exceptions
+
+
+def _blob(strings):
+    # Concatenated bytes and the (n + 1) offsets
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(string) for string in strings])
+    return np.frombuffer(b''.join(strings), dtype=np.uint8), offsets
+
+
+class ReferenceDatabase:
+    '''
+    Read access to a built reference database (arrays are memory-mapped).
+
+    Usage:
+        db = ReferenceDatabase(db_dir)
+        vampyrellida = db.taxonomy.find('Vampyrellida', 'Order')[0]
+        db.export_fasta('vamp.fasta', records=db.taxon_records(vampyrellida))
+    '''
+
+    def __init__(self, db_dir):
+        self.db_dir = db_dir
+        with open(os.path.join(db_dir, MANIFEST_FILE), 'r') as infile:
+            self.manifest = json.load(infile)
+        if self.manifest.get('format_version') != FORMAT_VERSION:
+            raise ValueError(f'{db_dir} has format version {self.manifest.get("format_version")}, '
+                             f'expected {FORMAT_VERSION}.')
+        for name in ARRAYS:
+            setattr(self, name, np.load(os.path.join(db_dir, f'{name}.npy'), mmap_mode='r'))
+        self.taxonomy = TaxonomyStore.load(os.path.join(db_dir, TAXONOMY_FILE))
+
+    def __len__(self):
+        return len(self.record_length)
+
+    def header(self, record):
+        return bytes(self.header_blob[self.header_offset[record]:self.header_offset[record + 1]]).decode()
+
+    def sequence(self, record):
+        '''
+        The sequence of a record (index in database order) as bytes.
+        '''
+        offset = self.record_offset[record]
+        length = int(self.record_length[record])
+        bases = DECODE[self.packed[offset:offset + (length + 3) // 4]].ravel()[:length]
+        first, last = np.searchsorted(self.exception_record, [record, record + 1])
+        if last > first:
+            bases = bases.copy()
+            bases[self.exception_position[first:last]] = self.exception_char[first:last]
+        return bases.tobytes()
+
+    def taxon_records(self, taxon_id):
+        '''
+        The records of a taxon and its descendants (indices in database order).
+        '''
+        return np.arange(self.taxon_start[taxon_id], self.taxon_end[taxon_id])
+
+    def export_fasta(self, output_file, records=None, line_width=FASTA_LINE_WIDTH):
+        '''
+        Write records as FASTA (default: all records in source order, as the notebook wrote
+        pr2_version_5.0.0_SSU_UTAX_plus_vamp_2023.fasta).
+
+        Returns:
+        - int: The number of records written.
+        '''
+        records = self.source_order if records is None else records
+        with open(output_file, 'wb', buffering=BUFFER_SIZE) as outfile:
+            for record in records:
+                sequence = self.sequence(record)
+                if line_width:
+                    sequence = b'\n'.join(sequence[i:i + line_width]
+                                          for i in range(0, len(sequence), line_width))
+                outfile.write(b'>' + self.header(record).encode() + b'\n' + sequence + b'\n')
+        return len(records)
+
+
+def _sorted_records(store, taxon_ids):
+    # Database order: by the taxon names at every rank (missing ranks first), then source order.
+    # Names instead of taxon ids keep the order of a group the same in every build.
+    name_order = np.empty(len(store.names) + 1, dtype=np.int64)
+    name_order[np.argsort(np.array(store.names, dtype=object), kind='stable')] = np.arange(len(store.names))
+    name_order[-1] = -1
+    lineages = store.lineages[taxon_ids]
+    rank_keys = np.where(lineages >= 0, name_order[store.name_id[lineages]], -1)
+    keys = [np.arange(len(taxon_ids))] + [rank_keys[:, rank] for rank in reversed(range(len(RANKS)))]
+    return np.lexsort(keys), rank_keys
+
+
+def _group_digests(records, order, group_keys):
+    # Group boundaries (database order) and the SHA-256 of the records of every group
+    boundaries = np.flatnonzero(np.any(group_keys[1:] != group_keys[:-1], axis=1)) + 1
+    starts = np.concatenate([[0], boundaries]) if len(order) else np.empty(0, dtype=np.int64)
+    ends = np.concatenate([boundaries, [len(order)]]) if len(order) else np.empty(0, dtype=np.int64)
+    digests = []
+    for start, end in zip(starts, ends):
+        h = hashlib.sha256()
+        for record in order[start:end]:
+            header, sequence = records[record]
+            h.update(header + b'\n' + sequence + b'\n')
+        digests.append(h.hexdigest())
+    return starts, ends, digests
+
+
+def _group_name(store, taxon_id, group_rank):
+    # Taxopath down to the group rank, e.g. 'Eukaryota;TSAR;Rhizaria-Cercozoa;Endomyxa;Vampyrellida'
+    lineage = store.lineages[taxon_id, :group_rank + 1]
+    return ';'.join(store.names[store.name_id[taxon]] for taxon in lineage if taxon >= 0)
+
+
+def build_reference_database(pr2_fasta, vamp_fasta, db_dir, force=False):
+    '''
+    Build (or update) the binary reference database.
+
+    Parameters:
+    - pr2_fasta (str): PR2 UTAX FASTA file.
+    - vamp_fasta (str): Curated vampyrellid FASTA file ('ID|...|family|genus|species' headers).
+    - db_dir (str): Database directory.
+    - force (bool, optional): Rebuild even if the source files did not change.
+
+    Returns:
+    - dict: Build summary ('status': 'up to date' or 'built', groups 'packed' and 'reused').
+    '''
+    previous = None
+    if os.path.exists(os.path.join(db_dir, MANIFEST_FILE)):
+        try:
+            previous = ReferenceDatabase(db_dir)
+        except (ValueError, OSError, KeyError):
+            previous = None
+    previous_sources = previous.manifest['sources'] if previous else {}
+    sources = {'pr2': _source_info(pr2_fasta, previous_sources.get('pr2')),
+               'vampyrellida': _source_info(vamp_fasta, previous_sources.get('vampyrellida'))}
+    if previous and not force and all(sources[role]['sha256'] == previous_sources.get(role, {}).get('sha256')
+                                      for role in sources):
+        return {'status': 'up to date', 'packed': 0, 'reused': len(previous.manifest['groups'])}
+
+    records = read_source_records(pr2_fasta, vamp_fasta)
+    store = TaxonomyStore()
+    _, taxon_ids = store.add_headers([header.decode() for header, _ in records])
+    order, rank_keys = _sorted_records(store, taxon_ids)
+    group_rank = RANKS.index(GROUP_RANK)
+    group_keys = rank_keys[order, :group_rank + 1]
+    starts, ends, digests = _group_digests(records, order, group_keys)
+    group_names = [_group_name(store, taxon_ids[order[start]], group_rank) for start in starts]
+    name_counts = Counter(group_names)
+    group_names = [f'{name}#{digest[:12]}' if name_counts[name] > 1 else name
+                   for name, digest in zip(group_names, digests)]
+
+    # Pack the changed groups, copy the unchanged ones from the previous build
+    previous_groups = {group['digest']: group for group in previous.manifest['groups'].values()} \
+        if previous else {}
+    parts, n_packed = [], 0
+    for start, end, digest in zip(starts, ends, digests):
+        old = previous_groups.get(digest)
+        if old is not None:
+            old_records = np.arange(old['start'], old['end'])
+            first, last = np.searchsorted(previous.exception_record, [old['start'], old['end']])
+            byte_start = previous.record_offset[old['start']] if len(old_records) else 0
+            byte_lengths = (previous.record_length[old_records].astype(np.int64) + 3) // 4
+            packed = np.asarray(previous.packed[byte_start:byte_start + byte_lengths.sum()])
+            exceptions = (np.asarray(previous.exception_record[first:last]) - old['start'],
+                          np.asarray(previous.exception_position[first:last]),
+                          np.asarray(previous.exception_char[first:last]))
+        else:
+            packed, byte_lengths, exceptions = pack_sequences([records[i][1] for i in order[start:end]])
+            n_packed += 1
+        parts.append((start, packed, byte_lengths, exceptions))
+
+    n_records = len(order)
+    byte_lengths = np.concatenate([part[2] for part in parts]) if parts else np.empty(0, dtype=np.int64)
+    record_offset = np.cumsum(byte_lengths) - byte_lengths
+    arrays = {
+        'packed': np.concatenate([part[1] for part in parts]) if parts else np.empty(0, dtype=np.uint8),
+        'record_offset': record_offset.astype(np.int64),
+        'record_length': np.array([len(records[i][1]) for i in order], dtype=np.int32),
+        'record_taxon': taxon_ids[order].astype(np.int32),
+        'source_order': np.argsort(order).astype(np.int32),
+        'exception_record': np.concatenate([part[3][0] + part[0] for part in parts]).astype(np.int32)
+        if parts else np.empty(0, dtype=np.int32),
+        'exception_position': np.concatenate([part[3][1] for part in parts]).astype(np.int32)
+        if parts else np.empty(0, dtype=np.int32),
+        'exception_char': np.concatenate([part[3][2] for part in parts]).astype(np.uint8)
+        if parts else np.empty(0, dtype=np.uint8),
+    }
+    arrays['header_blob'], arrays['header_offset'] = _blob([records[i][0] for i in order])
+
+    # Records of every taxon: one contiguous range in database order
+    taxon_start = np.zeros(store.n_taxa, dtype=np.int64)
+    taxon_end = np.zeros(store.n_taxa, dtype=np.int64)
+    taxon_end[0] = n_records
+    record_lineages = store.lineages[arrays['record_taxon']]
+    for rank in range(len(RANKS)):
+        taxa, first, counts = np.unique(record_lineages[:, rank], return_index=True, return_counts=True)
+        valid = taxa >= 0
+        taxon_start[taxa[valid]] = first[valid]
+        taxon_end[taxa[valid]] = first[valid] + counts[valid]
+    arrays['taxon_start'], arrays['taxon_end'] = taxon_start, taxon_end
+
+    manifest = {
+        'format_version': FORMAT_VERSION,
+        'sources': sources,
+        'group_rank': GROUP_RANK,
+        'n_records': n_records,
+        'content_sha256': hashlib.sha256(''.join(digests).encode()).hexdigest(),
+        'groups': {name: {'digest': digest, 'start': int(start), 'end': int(end)}
+                   for name, digest, start, end in zip(group_names, digests, starts, ends)}
+    }
+
+    # Write into a new directory and swap it in, so readers never see a partial database
+    build_dir = db_dir.rstrip(os.sep) + '.building'
+    shutil.rmtree(build_dir, ignore_errors=True)
+    os.makedirs(build_dir)
+    for name in ARRAYS:
+        np.save(os.path.join(build_dir, f'{name}.npy'), arrays[name])
+    store.save(os.path.join(build_dir, TAXONOMY_FILE))
+    with open(os.path.join(build_dir, MANIFEST_FILE), 'w') as outfile:
+        json.dump(manifest, outfile, indent=1)
+    del previous
+    if os.path.exists(db_dir):
+        old_dir = db_dir.rstrip(os.sep) + '.old'
+        shutil.rmtree(old_dir, ignore_errors=True)
+        os.replace(db_dir, old_dir)
+        os.replace(build_dir, db_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+    else:
+        os.replace(build_dir, db_dir)
+    return {'status': 'built', 'packed': n_packed, 'reused': len(digests) - n_packed}
+
+
+def build_and_export(pr2_fasta, vamp_fasta, db_dir, fasta_file, force=False):
+    '''
+    Update the database and export the vsearch FASTA file if the database changed or the
+    FASTA file is missing.
+
+    Returns:
+    - dict: Build summary of build_reference_database.
+    '''
+    summary = build_reference_database(pr2_fasta, vamp_fasta, db_dir, force=force)
+    if summary['status'] == 'built' or not os.path.exists(fasta_file):
+        ReferenceDatabase(db_dir).export_fasta(fasta_file)
+    return summary
+
+
+def main():
+    import argparse
+    from pipeline import Layout, PR2_SOURCE, VAMP_CURATION, REFERENCE_DB, REFERENCE_DB_FASTA
+
+    parser = argparse.ArgumentParser(description='Build the binary PR2 + Vampyrellida reference '
+                                                 'database and export its FASTA file.')
+    parser.add_argument('--project', default='Suthaus_2022')
+    parser.add_argument('--marker', default='Full18S')
+    parser.add_argument('--denoise-method', default='RAD')
+    parser.add_argument('--sim', default='sim_90')
+    parser.add_argument('--force', action='store_true', help='rebuild all groups')
+    args = parser.parse_args()
+
+    layout = Layout(args.project, args.marker, args.denoise_method, args.sim)
+    summary = build_and_export(layout.path(PR2_SOURCE), layout.path(VAMP_CURATION),
+                               layout.path(REFERENCE_DB), layout.path(REFERENCE_DB_FASTA), force=args.force)
+    print(f'Database {summary["status"]}: {summary["packed"]} groups packed, {summary["reused"]} reused')
+
+
+if __name__ == '__main__':
+    main()
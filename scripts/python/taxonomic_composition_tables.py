@@ -1,101 +1,132 @@
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
 
+from taxonomy_store import RANKS, TaxonomyStore
+
+# Constants
+TAX_RANKS = RANKS
+OTU_PATTERN = re.compile(r'^(?:centroid=)?(?P<OTU>[^;]*);seqs=(?P<OTU_Num>\d+)')
+
 
 def adjust_suthaus_2020_df(dataframe):
     '''
     Adjusts the dataframe based on the format of Suthaus (2020) to make it more interpretable and organized.
 
     This function performs multiple transformations:
-    1. Removes the prefix 'centroid=' from the first column.
-    2. Splits the first column into two separate columns ('OTU' and 'OTU_Num').
-    3. Extracts a number representing the number of sequences from the 'OTU_Num' column.
-    4. Drops the original first column.
-    5. Extracts taxonomic hierarchy information (from 'Kingdom' to 'Species') from the second column.
-    6. Drops the original second column.
-    7. Extracts alignment information ('Pident' and 'Length') from subsequent columns.
-    8. Rename the deep sea samples so they will appear next to each other on the plot.
-    9. Rearranges the columns for better readability.
+    1. Extracts the OTU name ('OTU') and the number of sequences ('OTU_Num') from the first column
+       (e.g. 'centroid=seq10_41;seqs=5').
+    2. Extracts the reference ID and the taxonomic hierarchy (from 'Kingdom' to 'Species') from the
+       second column (UTAX header). The header is parsed once per unique reference with a single
+       compiled regular expression and the ranks are stored as categorical columns.
+    3. Extracts alignment information ('Pident' and 'Length') from the third and fourth columns.
+    4. Rename the deep sea samples so they will appear next to each other on the plot.
+    5. Returns the columns OTU, OTU_Num, Reference_ID, Kingdom ... Species, Pident, Length, Sample.
 
     Parameters:
     - dataframe : pd.DataFrame
-        A dataframe based on the Suthaus (2020) format containing taxonomic and alignment data.
+        A dataframe based on the Suthaus (2020) format containing taxonomic and alignment data
+        (the blast6 columns followed by a 'Sample' column).
 
     Returns:
     - pd.DataFrame
         A transformed dataframe with extracted and organized columns.
     '''
-    # Replace 'centroid=' with an empty string in the first column
-    dataframe[dataframe.columns[0]] = dataframe[
-        dataframe.columns[0]].str.replace('centroid=', '', regex=False)
-    # Split the first column based on the ';' delimiter
-    dataframe[['OTU', 'OTU_Num'
-               ]] = dataframe[dataframe.columns[0]].str.split(';', expand=True)
-    # Extract only the number from the 'OTU_Num' column (after 'seqs=')
-    dataframe['OTU_Num'] = dataframe['OTU_Num'].str.split('=').str[1].astype(
-        int)
-    # Drop the original column
-    dataframe = dataframe.drop(columns=dataframe.columns[0])
-    # Create a reference ID column
-    dataframe['Reference_ID'] = dataframe[1].str.split(';').str[0]
-    # Creating a Kingdom columm
-    dataframe['Kingdom'] = dataframe[1].str.split(':').str[1].str.split(
-        ',').str[0]
-    # Creating a Domain columm
-    dataframe['Domain'] = dataframe[1].str.split(':').str[2].str.split(
-        ',').str[0]
-    # Creating a Phyllum columm
-    dataframe['Phyllum'] = dataframe[1].str.split(':').str[3].str.split(
-        ',').str[0]
-    # Creating a Class columm
-    dataframe['Class'] = dataframe[1].str.split(':').str[4].str.split(
-        ',').str[0]
-    # Creating an Order columm
-    dataframe['Order'] = dataframe[1].str.split(':').str[5].str.split(
-        ',').str[0]
-    # Creating a Family columm
-    dataframe['Family'] = dataframe[1].str.split(':').str[6].str.split(
-        ',').str[0]
-    # Creating a Genus columm
-    dataframe['Genus'] = dataframe[1].str.split(':').str[7].str.split(
-        ',').str[0]
-    # Creating a Species columm
-    dataframe['Species'] = dataframe[1].str.split(':').str[8].str.split(
-        ',').str[0]
-    # Dropping the original column
-    dataframe = dataframe.drop(columns=dataframe.columns[0])
+    # OTU name and number of sequences from e.g. 'centroid=seq10_41;seqs=5'
+    otus = dataframe.iloc[:, 0].str.extract(OTU_PATTERN)
+
+    # Parse each unique reference header once and broadcast the result to all rows
+    codes, references = pd.factorize(dataframe.iloc[:, 1])
+    taxonomy = parse_utax_references(references)
+
+    adjusted = pd.DataFrame({'OTU': otus['OTU'].values,
+                             'OTU_Num': otus['OTU_Num'].astype(int).values},
+                            index=dataframe.index)
+    for column in ['Reference_ID'] + TAX_RANKS:
+        adjusted[column] = taxonomy[column].take(codes)
     # Creating a pident (percentage of identical positions) column
-    dataframe['Pident'] = dataframe[2]
+    adjusted['Pident'] = dataframe.iloc[:, 2].astype(float)
     # Creating a length (alignment length (sequence overlap)) column
-    dataframe['Length'] = dataframe[3]
-    # Drop unnecessary columns
-    dataframe = dataframe.drop(
-        dataframe.columns[[0, 1, 2, 3, 4, 5, 6, 7, 8, 9]], axis=1)
+    adjusted['Length'] = dataframe.iloc[:, 3].astype(int)
     # Rename the deep sea samples so they will appear next to each other on the plot
-    dataframe['Sample'] = dataframe['Sample'].replace({
+    adjusted['Sample'] = dataframe['Sample'].replace({
         'A3':
         'deep_sea_A3',
         'X17007':
         'deep_sea_X17007'
     })
-    # Rearrange the columns
-    cols = [col for col in dataframe if col != 'Sample'] + ['Sample']
-    dataframe = dataframe[cols]
+    return adjusted
+
+
+def parse_utax_references(references):
+    '''
+    Parse UTAX reference headers ('<ID>;tax=k:...,d:...,p:...,c:...,o:...,f:...,g:...,s:...').
+
+    Every distinct taxonomy is parsed once into a TaxonomyStore and the rank columns are
+    built from its integer name ids. Organelle suffixes such as ':plas' are dropped from
+    the taxon names.
+
+    Parameters:
+    - references (array-like): Unique reference headers.
+
+    Returns:
+    - dict: 'Reference_ID' and every rank of TAX_RANKS -> pd.Categorical aligned with references.
+    '''
+    store = TaxonomyStore()
+    reference_ids, taxon_ids = store.add_headers(list(references))
+    return {'Reference_ID': pd.Categorical(reference_ids), **store.rank_columns(taxon_ids, TAX_RANKS)}
+
+
+def _read_blast6(path):
+    dataframe = pd.read_csv(path, sep='\t', header=None)
+    # Sample name from e.g. 'blast6_A3_18S.tab'
+    dataframe['Sample'] = os.path.basename(path).split('_')[1]
     return dataframe
 
 
+def load_blast6_tables(directory, adjust=True, processes=None):
+    '''
+    Read every 'blast6_*.tab' file of a directory (in parallel) into one dataframe.
+
+    Parameters:
+    - directory (str): Directory with the vsearch blast6 tables.
+    - adjust (bool, optional): Apply adjust_suthaus_2020_df to the combined table. Default is True.
+    - processes (int, optional): Number of worker processes. Default is os.cpu_count().
+
+    Returns:
+    - pd.DataFrame: The combined (and adjusted) table of all samples.
+    '''
+    paths = [os.path.join(directory, file_name) for file_name in sorted(os.listdir(directory))
+             if file_name.startswith('blast6_') and file_name.endswith('.tab')]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        tables = list(executor.map(_read_blast6, paths))
+    dataframe = pd.concat(tables, ignore_index=True)
+    return adjust_suthaus_2020_df(dataframe) if adjust else dataframe
+
+
 def prepare_data_for_plotting(dataframe,
                               taxonomic_level,
                               threshold_percentage=5,
-                              grouping='unique_otus'):
+                              grouping='unique_otus',
+                              sparse=False):
     '''
     Prepare data for taxonomic composition plotting.
 
+    Taxa below the threshold are collapsed into 'Others' for all samples at once with
+    masked sums (no loop over the samples), so tables pooled across projects with
+    hundreds of samples and thousands of taxa stay fast.
+
     Parameters:
     - filtered_samples (pd.DataFrame): The filtered data containing taxonomic information.
     - taxonomic_level (str): The taxonomic level for the analysis (e.g., "Domain", "Phylum").
     - threshold_percentage (int, optional): The threshold below which taxa are grouped into 'Others'. Default is 5%.
     - grouping (str, optional): How to group the data. Options: 'unique_otus' or 'abundances'. Default is 'unique_otus'.
+    - sparse (bool, optional): Build the sample x taxon counts as a scipy.sparse matrix and return a
+      sparse-backed pivot table (use pivot_table.sparse.to_dense() before plotting). Default is False.
 
     Returns:
     - pivot_table (pd.DataFrame): The modified pivot table for plotting.
@@ -106,48 +137,80 @@ def prepare_data_for_plotting(dataframe,
     filtered_samples = dataframe[(dataframe['Sample'] != 'Mock') &
                                  (dataframe[taxonomic_level] != 'Bacteria_X')]
 
-    # Pivot table to get counts of sequences for each domain per sample
-    if grouping == 'abundances':
-        pivot_table = filtered_samples.groupby(
-            ['Sample', taxonomic_level])['OTU_Num'].sum().unstack(fill_value=0)
-    elif grouping == 'unique_otus':
-        pivot_table = filtered_samples.groupby(
-            ['Sample', taxonomic_level])['OTU'].nunique().unstack(fill_value=0)
-    else:
+    if grouping not in ('abundances', 'unique_otus'):
         raise ValueError(
             "Invalid value for 'grouping'. Choose 'unique_otus' or 'abundances'."
         )
 
-    # Calculate proportions within each sample
-    proportions = pivot_table.divide(pivot_table.sum(axis=1), axis=0) * 100
+    if sparse:
+        return _prepare_sparse(filtered_samples, taxonomic_level, threshold_percentage, grouping)
 
-    # Determine which entries fall below the threshold
-    small_entries = proportions < threshold_percentage
+    # Pivot table to get counts of sequences for each domain per sample
+    grouped = filtered_samples.groupby(['Sample', taxonomic_level], observed=True)
+    if grouping == 'abundances':
+        pivot_table = grouped['OTU_Num'].sum().unstack(fill_value=0)
+    else:
+        pivot_table = grouped['OTU'].nunique().unstack(fill_value=0)
+    pivot_table.columns = pivot_table.columns.astype(object)
 
-    # Create 'Others' column
-    pivot_table['Others'] = 0
+    counts = pivot_table.to_numpy()
+    small_entries = _small_entries(counts, counts.sum(axis=1), threshold_percentage)
 
-    for sample in pivot_table.index:
-        # Mask for the current sample's small entries
-        mask = small_entries.loc[sample]
+    # Sum up the small groups into 'Others' and zero them out, for all samples at once
+    others = np.where(small_entries, counts, 0).sum(axis=1)
+    pivot_table = pd.DataFrame(np.where(small_entries, 0, counts),
+                               index=pivot_table.index,
+                               columns=pivot_table.columns)
 
-        # Sum up small groups into 'Others' for the current sample
-        pivot_table.at[sample,
-                       'Others'] = pivot_table.loc[sample,
-                                                   mask.index[mask]].sum()
+    # Add the 'Others' column labelled with the threshold percentage
+    pivot_table[f'Others (Taxa below {threshold_percentage}%)'] = others
 
-        # Zero out the original small group values for the current sample
-        pivot_table.loc[sample, mask.index[mask]] = 0
+    # Identify columns to exclude from the legend (taxa consistently "small" across all samples)
+    excluded_columns = pivot_table.columns[:-1][small_entries.all(axis=0)].tolist()
 
-    # Rename the 'Others' column to include the threshold percentage
-    others_label = f'Others (Taxa below {threshold_percentage}%)'
-    pivot_table.rename(columns={'Others': others_label}, inplace=True)
+    return pivot_table, excluded_columns
 
-    # Identify columns to exclude from the legend
-    excluded_columns = small_entries.all(
-        axis=0)  # Find taxa that are consistently "small" across all samples
-    excluded_columns = excluded_columns[excluded_columns].index.tolist()
 
+def _small_entries(counts, totals, threshold_percentage):
+    # Proportions within each sample below the threshold (samples without counts give NaN -> False)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return counts / totals[:, None] * 100 < threshold_percentage
+
+
+def _prepare_sparse(filtered_samples, taxonomic_level, threshold_percentage, grouping):
+    from scipy import sparse
+
+    if grouping == 'unique_otus':
+        filtered_samples = filtered_samples.drop_duplicates(['Sample', taxonomic_level, 'OTU'])
+    filtered_samples = filtered_samples.dropna(subset=['Sample', taxonomic_level])
+    sample_codes, samples = pd.factorize(filtered_samples['Sample'], sort=True)
+    taxon_codes, taxa = pd.factorize(filtered_samples[taxonomic_level], sort=True)
+    values = filtered_samples['OTU_Num'].to_numpy() if grouping == 'abundances' \
+        else np.ones(len(filtered_samples), dtype=np.int64)
+
+    # Duplicate (sample, taxon) entries are summed when converting to CSR
+    counts = sparse.coo_matrix((values, (sample_codes, taxon_codes)),
+                               shape=(len(samples), len(taxa))).tocsr()
+    totals = np.asarray(counts.sum(axis=1)).ravel()
+
+    # Only stored (non-zero) entries can be small; zeros stay zero either way
+    rows = np.repeat(np.arange(counts.shape[0]), np.diff(counts.indptr))
+    small = counts.data / totals[rows] * 100 < threshold_percentage
+    others = np.bincount(rows[small], weights=counts.data[small], minlength=counts.shape[0])
+    counts.data[small] = 0
+    counts.eliminate_zeros()
+
+    # A taxon is small in every sample if none of its stored entries is large (and it has
+    # zero counts, i.e. 0% < threshold, everywhere else)
+    large_taxa = np.zeros(len(taxa), dtype=bool)
+    large_taxa[counts.indices] = True
+    excluded_columns = taxa[~large_taxa].tolist() if threshold_percentage > 0 else []
+
+    pivot_table = pd.DataFrame.sparse.from_spmatrix(counts,
+                                                    index=pd.Index(samples, name='Sample'),
+                                                    columns=pd.Index(taxa, name=taxonomic_level))
+    pivot_table[f'Others (Taxa below {threshold_percentage}%)'] = pd.arrays.SparseArray(
+        others.astype(counts.dtype), fill_value=0)
     return pivot_table, excluded_columns
 
 
@@ -0,0 +1,263 @@
+# Interned taxonomy of UTAX headers (PR2 '<ID>;tax=k:...,d:...,p:...,c:...,o:...,f:...,g:...,s:...')
+#
+# Every distinct taxonomy string is parsed once into a rank-indexed trie. Taxa get integer ids
+# (0 is the root, a parent always has a smaller id than its children) and taxon names are
+# interned, so a reference only carries one integer. Rank lookups, "is descendant of
+# Vampyrellida" checks and per-rank grouping are then array operations on the lineage matrix
+# (taxon id x rank -> id of the ancestor at that rank). The store is saved as a .npz file and
+# reloaded without parsing any header.
+#
+# Usage:
+#   store, reference_ids, taxon_ids = read_utax_taxonomy('pr2_version_5.0.0_SSU_UTAX.fasta')
+#   vampyrellida = store.find('Vampyrellida', 'Order')[0]
+#   vamp_references = np.asarray(reference_ids)[store.is_descendant(taxon_ids, vampyrellida)]
+#   store.save('pr2_taxonomy.npz')
+
+# Imports
+import numpy as np
+import pandas as pd
+
+from fasta_io import open_fasta
+
+# Constants
+RANKS = ['Kingdom', 'Domain', 'Phyllum', 'Class', 'Order', 'Family', 'Genus', 'Species']
+RANK_PREFIXES = 'kdpcofgs'  # UTAX rank prefix of each rank in RANKS
+TAX_SEPARATOR = ';tax='
+FORMAT_VERSION = 1
+
+
+def split_utax_header(header):
+    '''
+    Split a UTAX header into the reference ID and the taxonomy string
+    ('AB000001.1.1795_U;tax=k:Eukaryota,...' -> ('AB000001.1.1795_U', 'k:Eukaryota,...')).
+    Headers without taxonomy get an empty taxonomy string.
+    '''
+    reference_id, _, taxonomy = header.strip().partition(TAX_SEPARATOR)
+    return reference_id, taxonomy.rstrip(';')
+
+
+class TaxonomyStore:
+    '''
+    Rank-indexed trie of UTAX taxonomies with integer taxon ids and interned names.
+
+    Attributes:
+    - names (list): Interned taxon names, indexed by name id.
+    - parent, rank, name_id (np.ndarray): Per taxon id, the parent taxon, the rank index
+      (into RANKS) and the name id (all -1 for the root, taxon 0).
+    - lineages (np.ndarray): (n_taxa x n_ranks) ids of the ancestor (or the taxon itself)
+      at every rank, -1 where a rank is missing.
+    '''
+
+    def __init__(self):
+        self.names = []
+        self._name_ids = {}
+        self._parent = [-1]
+        self._rank = [-1]
+        self._name_id = [-1]
+        self._children = {}  # (parent, rank, name id) -> taxon id
+        self._taxonomies = {}  # taxonomy string -> taxon id, so every string is parsed once
+        self._arrays = None
+
+    @property
+    def n_taxa(self):
+        return len(self._parent)
+
+    def _intern(self, name):
+        name_id = self._name_ids.get(name)
+        if name_id is None:
+            name_id = self._name_ids[name] = len(self.names)
+            self.names.append(name)
+        return name_id
+
+    def add_taxonomy(self, taxonomy):
+        '''
+        Add a taxonomy string ('k:Eukaryota,d:TSAR,...') and return the id of its deepest taxon.
+        Organelle suffixes such as ':plas' are dropped and missing ranks are skipped.
+        '''
+        taxon = self._taxonomies.get(taxonomy)
+        if taxon is not None:
+            return taxon
+        taxon = 0
+        for field in taxonomy.split(','):
+            prefix, _, name = field.partition(':')
+            name = name.split(':', 1)[0]
+            rank = RANK_PREFIXES.find(prefix)
+            if rank < 0 or len(prefix) != 1 or not name:
+                continue
+            key = (taxon, rank, self._intern(name))
+            child = self._children.get(key)
+            if child is None:
+                child = self._children[key] = len(self._parent)
+                self._parent.append(taxon)
+                self._rank.append(rank)
+                self._name_id.append(key[2])
+                self._arrays = None
+            taxon = child
+        self._taxonomies[taxonomy] = taxon
+        return taxon
+
+    def add_headers(self, headers):
+        '''
+        Add UTAX headers (with or without the leading '>').
+
+        Returns:
+        - reference_ids (list): The reference ID of every header.
+        - taxon_ids (np.ndarray): The deepest taxon of every header.
+        '''
+        reference_ids, taxon_ids = [], []
+        for header in headers:
+            reference_id, taxonomy = split_utax_header(header.lstrip('>'))
+            reference_ids.append(reference_id)
+            taxon_ids.append(self.add_taxonomy(taxonomy))
+        return reference_ids, np.array(taxon_ids, dtype=np.int32)
+
+    def _array(self, key):
+        if self._arrays is None:
+            parent = np.array(self._parent, dtype=np.int32)
+            rank = np.array(self._rank, dtype=np.int8)
+            # Parents are processed before their children (their rank is lower)
+            lineages = np.full((len(parent), len(RANKS)), -1, dtype=np.int32)
+            for rank_index in range(len(RANKS)):
+                taxa = np.flatnonzero(rank == rank_index)
+                lineages[taxa] = lineages[parent[taxa]]
+                lineages[taxa, rank_index] = taxa
+            self._arrays = {'parent': parent, 'rank': rank,
+                            'name_id': np.array(self._name_id, dtype=np.int32), 'lineages': lineages}
+        return self._arrays[key]
+
+    @property
+    def parent(self):
+        return self._array('parent')
+
+    @property
+    def rank(self):
+        return self._array('rank')
+
+    @property
+    def name_id(self):
+        return self._array('name_id')
+
+    @property
+    def lineages(self):
+        return self._array('lineages')
+
+    def find(self, name, rank=None):
+        '''
+        Ids of the taxa with the given name (optionally only at the given rank name).
+        '''
+        name_id = self._name_ids.get(name, -2)
+        mask = self.name_id == name_id
+        if rank is not None:
+            mask &= self.rank == RANKS.index(rank)
+        return np.flatnonzero(mask)
+
+    def at_rank(self, taxon_ids, rank):
+        '''
+        The ancestor of every taxon at the given rank name (-1 if the rank is missing).
+        '''
+        return self.lineages[np.asarray(taxon_ids), RANKS.index(rank)]
+
+    def is_descendant(self, taxon_ids, ancestor):
+        '''
+        Boolean mask of the taxa that are the ancestor taxon or lie below it.
+        '''
+        if ancestor == 0:
+            return np.ones(len(taxon_ids), dtype=bool)
+        return self.lineages[np.asarray(taxon_ids), self.rank[ancestor]] == ancestor
+
+    def taxon_names(self, taxon_ids):
+        '''
+        Names of the taxa (None for -1 and the root).
+        '''
+        names = np.array(self.names + [None], dtype=object)
+        return names[self.name_id[np.asarray(taxon_ids)]]
+
+    def taxopath(self, taxon_id, separator=';'):
+        '''
+        The names from the highest rank down to the taxon, joined with separator.
+        '''
+        lineage = self.lineages[taxon_id]
+        return separator.join(self.names[self.name_id[taxon]] for taxon in lineage if taxon >= 0)
+
+    def rank_columns(self, taxon_ids, ranks=None):
+        '''
+        One categorical column per rank (NaN where the rank is missing), built from the
+        integer name ids. The categories are sorted by name, as pd.Categorical(strings) sorts them.
+
+        Returns:
+        - dict: Rank name -> pd.Categorical aligned with taxon_ids.
+        '''
+        taxon_ids = np.asarray(taxon_ids)
+        columns = {}
+        for rank in ranks or RANKS:
+            ancestors = self.at_rank(taxon_ids, rank)
+            name_ids = np.where(ancestors >= 0, self.name_id[ancestors], -1)
+            used, codes = np.unique(name_ids, return_inverse=True)
+            offset = int(used[0] < 0) if len(used) else 0
+            names = np.array(self.names, dtype=object)[used[offset:]]
+            order = np.argsort(names, kind='stable')
+            # Code of every used name id (in np.unique order) in the sorted categories
+            lookup = np.full(len(used), -1, dtype=np.int64)
+            lookup[offset + order] = np.arange(len(order))
+            columns[rank] = pd.Categorical.from_codes(lookup[codes.ravel()],
+                                                      categories=pd.Index(names[order]))
+        return columns
+
+    def save(self, path):
+        '''
+        Save the store as an uncompressed .npz file (names as one newline separated buffer).
+        '''
+        taxonomies = list(self._taxonomies)
+        np.savez(path, version=FORMAT_VERSION,
+                 parent=self.parent, rank=self.rank, name_id=self.name_id,
+                 names=np.frombuffer('\n'.join(self.names).encode(), dtype=np.uint8),
+                 taxonomies=np.frombuffer('\n'.join(taxonomies).encode(), dtype=np.uint8),
+                 taxonomy_ids=np.array([self._taxonomies[taxonomy] for taxonomy in taxonomies],
+                                       dtype=np.int32))
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Load a store written by save.
+
+        Raises:
+        - ValueError: If the file was written by another version of the store.
+        '''
+        with np.load(path) as data:
+            if int(data['version']) != FORMAT_VERSION:
+                raise ValueError(f'{path} has store version {int(data["version"])}, '
+                                 f'expected {FORMAT_VERSION}.')
+            store = cls()
+            names = data['names'].tobytes().decode()
+            store.names = names.split('\n') if names else []
+            store._name_ids = {name: i for i, name in enumerate(store.names)}
+            store._parent = data['parent'].tolist()
+            store._rank = data['rank'].tolist()
+            store._name_id = data['name_id'].tolist()
+            taxonomies = data['taxonomies'].tobytes().decode()
+            store._taxonomies = dict(zip(taxonomies.split('\n') if taxonomies else [],
+                                         data['taxonomy_ids'].tolist()))
+        store._children = {(parent, rank, name_id): taxon for taxon, (parent, rank, name_id)
+                           in enumerate(zip(store._parent, store._rank, store._name_id)) if taxon}
+        return store
+
+
+def read_utax_taxonomy(fasta_path, store=None):
+    '''
+    Parse the headers of a UTAX FASTA file (e.g. PR2) into a taxonomy store; the
+    sequences are skipped.
+
+    Parameters:
+    - fasta_path (str): Path to the FASTA file (plain or gzipped).
+    - store (TaxonomyStore, optional): Store to add to. Default is a new store.
+
+    Returns:
+    - store (TaxonomyStore): The taxonomy store.
+    - reference_ids (list): Reference ID of every record, in file order.
+    - taxon_ids (np.ndarray): Deepest taxon of every record.
+    '''
+    store = store or TaxonomyStore()
+    with open_fasta(fasta_path) as handle:
+        headers = [line[1:].decode().rstrip() for line in handle if line.startswith(b'>')]
+    reference_ids, taxon_ids = store.add_headers(headers)
+    return store, reference_ids, taxon_ids
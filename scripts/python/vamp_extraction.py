@@ -0,0 +1,129 @@
+# Extraction of the OTUs assigned to a taxon (vsearch blast6 tables) from all samples at once
+#
+# Python version of the 'PULLING OUT THE VAMP SEQS' part of ../bash/tax_assign_05_taxassign.sh
+# (grep | awk > ids.txt; seqtk subseq per sample) and of the merging cell of the
+# create_phyl_tree notebook. The blast6 tables of all samples are read into one hash map
+# (OTU ID -> samples assigned to the taxon), then the FASTA file of every sample is streamed
+# once in a worker process and its matching records (exact ID lookups, as seqtk subseq) go to
+# the per-sample output. The records of all samples are also written to one pooled file
+# (all_samples.fasta), with the sample label appended to the headers as in the notebook.
+#
+# Usage (from scripts/python):
+#   python vamp_extraction.py --project Suthaus_2022 --marker Full18S --denoise-method RAD --sim sim_90
+
+# Imports
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from fasta_io import iter_fasta, write_fasta
+
+# Constants
+TAXON = 'Vampyrellida'
+POOLED_FILE = 'all_samples.fasta'
+POOL_EXCLUDE = ('Mock',)  # samples left out of the pooled file (as in create_phyl_tree)
+
+
+def read_blast6_ids(blast6_files, taxon=TAXON):
+    '''
+    Read the blast6 tables of all samples into one hash map of the queries whose hit
+    contains the taxon (as grep 'Vampyrellida' | awk '{print $1}').
+
+    Parameters:
+    - blast6_files (dict): Sample -> path to its blast6 table.
+    - taxon (str, optional): Taxon name searched in the lines. Default is 'Vampyrellida'.
+
+    Returns:
+    - dict: OTU ID -> set of the samples in which it is assigned to the taxon.
+    '''
+    samples_of = {}
+    for sample, path in blast6_files.items():
+        with open(path, 'r') as blast6:
+            for line in blast6:
+                if taxon in line:
+                    samples_of.setdefault(line.split('\t', 1)[0], set()).add(sample)
+    return samples_of
+
+
+def _extract_sample(args):
+    # Stream one FASTA file, write the records with an ID in ids and return them
+    fasta_file, output_file, ids = args
+    records = [(header, sequence) for header, sequence in iter_fasta(fasta_file)
+               if header.split(maxsplit=1)[0] in ids]
+    os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+    write_fasta(records, output_file)
+    return records
+
+
+def pooled_header(header, sample):
+    '''
+    Header of a record in the pooled file: ';' replaced by '_' (RAxML-ng does not accept
+    semicolons) and the sample label appended ('otu1;size=3', 'NH1_18S' -> 'otu1_size=3_NH1').
+    '''
+    return header.strip().replace(';', '_') + '_' + sample.split('_')[0]
+
+
+def extract_samples(fasta_files, blast6_files, output_files, pooled_file=None, taxon=TAXON,
+                    label_pooled=True, pool_exclude=POOL_EXCLUDE, processes=None):
+    '''
+    Extract the OTUs assigned to a taxon from the FASTA files of all samples.
+
+    Parameters:
+    - fasta_files (dict): Sample -> path to its OTU FASTA file.
+    - blast6_files (dict): Sample -> path to its blast6 table.
+    - output_files (dict): Sample -> path to its output FASTA file.
+    - pooled_file (str, optional): FASTA file with the records of all samples (in sample order).
+    - taxon (str, optional): Taxon name searched in the blast6 lines. Default is 'Vampyrellida'.
+    - label_pooled (bool, optional): Relabel the pooled headers (see pooled_header). Default is True.
+    - pool_exclude (tuple, optional): Prefixes of samples left out of the pooled file.
+    - processes (int, optional): Number of worker processes. Default is os.cpu_count().
+
+    Returns:
+    - dict: Sample -> number of records extracted.
+    '''
+    samples_of = read_blast6_ids(blast6_files, taxon)
+    samples = list(fasta_files)
+    ids = {sample: set() for sample in samples}
+    for otu_id, otu_samples in samples_of.items():
+        for sample in otu_samples:
+            if sample in ids:
+                ids[sample].add(otu_id)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        extracted = list(executor.map(_extract_sample, [(fasta_files[sample], output_files[sample], ids[sample])
+                                                        for sample in samples]))
+    if pooled_file:
+        os.makedirs(os.path.dirname(pooled_file) or '.', exist_ok=True)
+        write_fasta(((pooled_header(header, sample) if label_pooled else header, sequence)
+                     for sample, records in zip(samples, extracted) if not sample.startswith(pool_exclude)
+                     for header, sequence in records), pooled_file)
+    return {sample: len(records) for sample, records in zip(samples, extracted)}
+
+
+def main():
+    import argparse
+    from pipeline import Layout, CHIMERA_FILTERED, TAX_ASSIGN_DIR, VAMP_SPECIFIC, discover_samples
+
+    parser = argparse.ArgumentParser(description='Extract the OTUs assigned to a taxon from all samples.')
+    parser.add_argument('--project', default='Suthaus_2022')
+    parser.add_argument('--marker', default='Full18S')
+    parser.add_argument('--denoise-method', default='RAD')
+    parser.add_argument('--sim', default='sim_90')
+    parser.add_argument('--taxon', default=TAXON)
+    parser.add_argument('--samples', nargs='*', help='default: all chimera filtered samples')
+    parser.add_argument('--processes', type=int)
+    args = parser.parse_args()
+
+    layout = Layout(args.project, args.marker, args.denoise_method, args.sim)
+    samples = args.samples or discover_samples(os.path.dirname(layout.path(CHIMERA_FILTERED, sample='')))
+    print(f'Samples used: {" ".join(samples)}')
+    counts = extract_samples(
+        {sample: layout.path(CHIMERA_FILTERED, sample=sample) for sample in samples},
+        {sample: layout.path(TAX_ASSIGN_DIR + '/blast/blast6_{sample}.tab', sample=sample) for sample in samples},
+        {sample: layout.path(VAMP_SPECIFIC, sample=sample) for sample in samples},
+        pooled_file=os.path.join(os.path.dirname(layout.path(VAMP_SPECIFIC, sample='')), POOLED_FILE),
+        taxon=args.taxon, processes=args.processes)
+    for sample, count in counts.items():
+        print(f'{sample}: {count} {args.taxon} OTUs')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+# Tests of the asynchronous BLAST batch of blastn.py against a local stand-in of the
+# BLAST URL API (http.server): CMD=Put returns a RID, CMD=Get&FORMAT_OBJECT=SearchInfo
+# the status of a RID and CMD=Get&FORMAT_TYPE=XML its results. The poll delays are scaled
+# down to a fraction of a second.
+
+# Imports
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'scripts', 'python'))
+
+import blastn  # noqa: E402
+
+# Constants
+MIN_POLL_DELAY = 0.05
+MAX_POLL_DELAY = 0.2
+BLAST_XML = ('<?xml version="1.0"?>\n<BlastOutput><BlastOutput_iterations><Iteration>'
+             '<Iteration_query-def>{rid}</Iteration_query-def>'
+             '</Iteration></BlastOutput_iterations></BlastOutput>\n')
+
+
+class BlastServer(ThreadingHTTPServer):
+    '''
+    Stand-in of the BLAST URL API.
+
+    Attributes:
+    - waits (dict): RID -> number of SearchInfo requests answered with WAITING before READY.
+      RIDs that are not in waits are UNKNOWN (expired).
+    - failed (set): Queries whose searches end as FAILED.
+    - status (dict): RID -> status once it has stopped waiting (READY or FAILED).
+    - submitted (list): The submitted queries, in order.
+    - polls (dict): RID -> times of its SearchInfo requests.
+    - fetched (list): RIDs whose XML was downloaded.
+    '''
+
+    def __init__(self, waits_per_search=0):
+        super().__init__(('127.0.0.1', 0), BlastRequestHandler)
+        self.waits_per_search = waits_per_search
+        self.waits = {}
+        self.failed = set()
+        self.status = {}
+        self.submitted = []
+        self.polls = {}
+        self.fetched = []
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/Blast.cgi'
+
+
+class BlastRequestHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        params = self._params()
+        server = self.server
+        with server.lock:
+            server.submitted.append(params['QUERY'])
+            rid = f'RID{len(server.submitted)}'
+            server.waits[rid] = server.waits_per_search
+            server.status[rid] = 'FAILED' if params['QUERY'] in server.failed else 'READY'
+        self._reply(f'<!--QBlastInfoBegin\n    RID = {rid}\n    RTOE = 0\nQBlastInfoEnd\n-->\n')
+
+    def do_GET(self):
+        params = self._params()
+        server = self.server
+        rid = params['RID']
+        with server.lock:
+            if params.get('FORMAT_OBJECT') == 'SearchInfo':
+                server.polls.setdefault(rid, []).append(time.monotonic())
+                if rid not in server.waits:
+                    status = 'UNKNOWN'
+                elif server.waits[rid] > 0:
+                    server.waits[rid] -= 1
+                    status = 'WAITING'
+                else:
+                    status = server.status.get(rid, 'READY')
+                self._reply(f'<!--QBlastInfoBegin\n    Status={status}\nQBlastInfoEnd\n-->\n')
+            else:
+                server.fetched.append(rid)
+                self._reply(BLAST_XML.format(rid=rid))
+
+    def log_message(self, format, *args):
+        pass
+
+    def _params(self):
+        return {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+
+    def _reply(self, text):
+        body = text.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def blast_server():
+    servers = []
+
+    def start(**kwargs):
+        server = BlastServer(**kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def _run_batch(sequences, output_dir, server, **kwargs):
+    return blastn.run_blast_batch(sequences, str(output_dir), base_url=server.url, submit_interval=0,
+                                  min_poll_delay=MIN_POLL_DELAY, max_poll_delay=MAX_POLL_DELAY, **kwargs)
+
+
+def _checkpoint(output_dir):
+    with open(os.path.join(output_dir, blastn.CHECKPOINT_FILE), 'r') as checkpoint:
+        return [tuple(line.rstrip('\n').split('\t')) for line in checkpoint]
+
+
+def test_batch_writes_xml_and_checkpoint(blast_server, tmp_path):
+    server = blast_server()
+    sequences = {'otu1': 'ACGT', 'otu2': 'GGCC', 'otu3': 'TTAA'}
+    results = _run_batch(sequences, tmp_path, server, max_in_flight=2)
+
+    assert results == {header: str(tmp_path / f'{header}.xml') for header in sequences}
+    assert sorted(server.submitted) == sorted(sequences.values())
+    assert blastn.read_checkpoint(str(tmp_path / blastn.CHECKPOINT_FILE)) == (set(sequences), {})
+    for header in sequences:
+        assert '<BlastOutput_iterations>' in (tmp_path / f'{header}.xml').read_text()
+    assert not list(tmp_path.glob('*.tmp'))
+
+
+def test_poll_delay_backs_off_up_to_max(blast_server, tmp_path):
+    server = blast_server(waits_per_search=5)
+    _run_batch({'otu1': 'ACGT'}, tmp_path, server)
+
+    polls = server.polls['RID1']
+    assert len(polls) == 6  # 5 x WAITING, then READY
+    expected = [min(MIN_POLL_DELAY * blastn.POLL_BACKOFF ** i, MAX_POLL_DELAY) for i in range(1, 6)]
+    gaps = [later - earlier for earlier, later in zip(polls, polls[1:])]
+    for gap, delay in zip(gaps, expected):
+        assert gap >= delay * 0.9
+    assert max(gaps) < MAX_POLL_DELAY + 0.5  # capped at max_poll_delay
+
+
+def test_resume_from_checkpoint(blast_server, tmp_path):
+    server = blast_server()
+    server.waits['RUNNING'] = 1  # submitted before the restart, still known to the server
+    with open(tmp_path / blastn.CHECKPOINT_FILE, 'w') as checkpoint:
+        checkpoint.write('otu1\tOLD\tsubmitted\n'
+                         'otu1\tOLD\tdone\n'
+                         'otu2\tRUNNING\tsubmitted\n'
+                         'otu3\tEXPIRED\tsubmitted\n'
+                         'otu4\tPARTIAL')  # line cut off by a crash
+    sequences = {'otu1': 'ACGT', 'otu2': 'GGCC', 'otu3': 'TTAA', 'otu4': 'CCGG'}
+    results = _run_batch(sequences, tmp_path, server)
+
+    # otu1 is skipped, otu2 resumes its RID, the expired otu3 and the unrecorded otu4 are submitted
+    assert set(results) == {'otu2', 'otu3', 'otu4'}
+    assert sorted(server.submitted) == ['CCGG', 'TTAA']
+    assert 'OLD' not in server.polls
+    assert len(server.polls['RUNNING']) == 2
+    assert sorted(server.fetched) == sorted(['RUNNING', 'RID1', 'RID2'])
+    rows = _checkpoint(tmp_path)
+    assert ('otu3', 'EXPIRED', 'unknown') in rows
+    assert ('otu2', 'RUNNING', 'done') in rows
+    assert ('otu4', 'PARTIAL') in rows  # the cut off line does not swallow the next one
+    assert [status for header, *_, status in rows if header == 'otu4'][1:] == ['submitted', 'done']
+    assert blastn.read_checkpoint(str(tmp_path / blastn.CHECKPOINT_FILE)) == (set(sequences), {})
+
+    # A second restart has nothing left to do
+    assert _run_batch(sequences, tmp_path, server) == {}
+
+
+def test_failed_search_is_reported(blast_server, tmp_path):
+    server = blast_server()
+    server.failed.add('GGCC')
+    results = _run_batch({'otu1': 'ACGT', 'otu2': 'GGCC'}, tmp_path, server)
+
+    assert results['otu1'] == str(tmp_path / 'otu1.xml')
+    assert isinstance(results['otu2'], ValueError)
+    assert [(header, status) for header, _, status in _checkpoint(tmp_path) if header == 'otu2'] == \
+        [('otu2', 'submitted'), ('otu2', 'failed')]
+    assert blastn.read_checkpoint(str(tmp_path / blastn.CHECKPOINT_FILE)) == ({'otu1'}, {})
@@ -0,0 +1,78 @@
+# Regression test of gblocks_engine against the Gblocks 0.91b grid search outputs
+#
+# results/phyl_trees/.../alignments/grid_search holds the trimmed alignment and the log of
+# every grid point of the create_phyl_tree notebook (vamp_mafft_gblocks_grid_<b5>_<i>).
+# The grid is rebuilt from the 'Parameters used' blocks of the logs and evaluated with one
+# gblocks_grid call; every grid point must select the same columns as Gblocks.
+
+# Imports
+import os
+import re
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'scripts', 'python'))
+
+from alignment_matrix import AlignmentMatrix  # noqa: E402
+from create_phyl_tree import read_gblocks_parameters  # noqa: E402
+from gblocks_engine import gblocks_grid  # noqa: E402
+
+# Constants
+ALIGNMENTS_DIR = os.path.join(os.path.dirname(__file__), '..', 'results', 'phyl_trees', 'Suthaus_2022',
+                              'Full18S', 'RAD', 'sim_90', 'alignments')
+GRID_DIR = os.path.join(ALIGNMENTS_DIR, 'grid_search')
+GRID_NAME = 'vamp_mafft_gblocks_grid'
+B5_VALUES = ['n', 'h', 'a']
+
+pytestmark = pytest.mark.skipif(not os.path.isdir(GRID_DIR), reason='no grid search results')
+
+
+def _grid_files():
+    # (b5, i) -> path without extension, for every stored grid point
+    pattern = re.compile(rf'^{GRID_NAME}_([nha])_(\d+)\.log$')
+    matches = (pattern.match(file_name) for file_name in os.listdir(GRID_DIR))
+    return {(match.group(1), int(match.group(2))): os.path.join(GRID_DIR, match.group(0)[:-len('.log')])
+            for match in matches if match}
+
+
+def _gblocks_summary(log_file):
+    # Number of positions and blocks Gblocks selected
+    with open(log_file, 'r') as infile:
+        match = re.search(r'Gblocks alignment:\s+(\d+) positions .* in (\d+) selected block', infile.read())
+    return int(match.group(1)), int(match.group(2))
+
+
+@pytest.fixture(scope='module')
+def grid():
+    files = _grid_files()
+    n_iterations = len(files) // len(B5_VALUES)
+    assert sorted(files) == sorted((b5, i) for b5 in B5_VALUES for i in range(n_iterations))
+
+    # b1 - b4 of iteration i are the same for every b5
+    parameters = {point: read_gblocks_parameters(path + '.log') for point, path in files.items()}
+    values = {name: [parameters['n', i][name] for i in range(n_iterations)] for name in ('b1', 'b2', 'b3', 'b4')}
+    for (b5, i), used in parameters.items():
+        assert used == dict({name: values[name][i] for name in values}, b5=b5)
+
+    alignment = AlignmentMatrix.from_fasta(os.path.join(ALIGNMENTS_DIR, 'vamp_mafft.fasta'))
+    grid_df, masks = gblocks_grid(alignment, values['b1'], values['b2'], values['b3'], values['b4'],
+                                  B5_VALUES)
+    return files, alignment, grid_df, masks
+
+
+def test_grid_has_all_points(grid):
+    files, _, grid_df, _ = grid
+    assert len(files) == 30
+    assert sorted(zip(grid_df['b5_value'], grid_df['iteration_num'])) == sorted(files)
+
+
+def test_grid_matches_gblocks(grid):
+    files, alignment, grid_df, masks = grid
+    for row, mask in zip(grid_df.itertuples(index=False), masks):
+        path = files[row.b5_value, row.iteration_num]
+        assert (row.positions, row.blocks) == _gblocks_summary(path + '.log'), path
+        gblocks = AlignmentMatrix.from_fasta(path + '.fasta')
+        assert gblocks.ids == alignment.ids, path
+        assert np.array_equal(alignment.select_columns(mask).matrix, gblocks.matrix), path
@@ -0,0 +1,56 @@
+# Regression test of placement_assignment against the committed gappa examine assign outputs
+#
+# The taxon file is rebuilt from the leaf names of the reference tree, the same way as in
+# ../notebooks/phyl_placement_creating_taxonomic_files.ipynb (name <tab> ';' joined fields
+# after the accession), and every sample must give the gappa files byte for byte.
+
+# Imports
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'scripts', 'python'))
+
+from jplace import read_jplace  # noqa: E402
+import placement_assignment  # noqa: E402
+
+# Constants
+RESULTS = os.path.join(os.path.dirname(__file__), '..', 'results', 'phyl_placement')
+SUBDIR = os.path.join('Suthaus_2022', 'Full18S', 'RAD', 'sim_90')
+JPLACE_DIR = os.path.join(RESULTS, 'jplace', SUBDIR, 'vampyrellida')
+GAPPA_DIR = os.path.join(RESULTS, 'tax_assignment', SUBDIR, 'vampyrella')
+SAMPLES = ['Mock_18S', 'NH1_18S', 'NH4_18S', 'Sim17_18S', 'Sim22_18S', 'Th38_18S', 'X17007_18S']
+# gappa labels the inner nodes around AY941200 (Vampyrellidae;Leptophryidae...) in a way no
+# consensus of the leaf taxopaths reproduces; only Th16 has placements on these edges
+DIVERGING_SAMPLES = ['Th16_18S']
+
+pytestmark = pytest.mark.skipif(not os.path.isdir(JPLACE_DIR), reason='no jplace results')
+
+
+@pytest.fixture(scope='module')
+def assignment_dir(tmp_path_factory):
+    out_dir = tmp_path_factory.mktemp('tax_assignment')
+    jplace_paths = {sample: os.path.join(JPLACE_DIR, f'epa_result_{sample}.jplace')
+                    for sample in SAMPLES + DIVERGING_SAMPLES}
+    tree = read_jplace(jplace_paths[SAMPLES[0]]).tree
+    taxon_file = out_dir / 'taxon_file.tsv'
+    with open(taxon_file, 'w') as fp:
+        for name, leaf in zip(tree.names, tree.is_leaf):
+            if leaf:
+                fp.write(f'{name}\t{";".join(name.split("|")[1:])}\n')
+    placement_assignment.assign_jplace_files(jplace_paths, str(taxon_file), str(out_dir))
+    return out_dir
+
+
+def _read_lines(path):
+    with open(path, 'r') as infile:
+        return infile.read().splitlines()
+
+
+@pytest.mark.parametrize('kind', ['per_query', 'profile'])
+@pytest.mark.parametrize('sample', SAMPLES + [pytest.param(sample, marks=pytest.mark.xfail(strict=True))
+                                              for sample in DIVERGING_SAMPLES])
+def test_matches_gappa(assignment_dir, sample, kind):
+    assert (_read_lines(assignment_dir / f'{sample}_{kind}.tsv')
+            == _read_lines(os.path.join(GAPPA_DIR, f'{sample}_{kind}.tsv')))